@@ -0,0 +1,169 @@
+"""
+Idempotent, parallel writing of the AF3 input files of a screen or complex folder, shared by bulkalphafold3.py and generate_protein_complex_combinations.py.
+
+Inputs are serialized compactly and written by a pool of processes. A job manifest (`<folder>_af3_inputs_manifest.json`, beside the folder) records every job's input file,
+name, chains, token count, number of seeds, content hash, and the size and modification time of the written file. An input is only rewritten if its content
+hash changed or the file was modified or removed since, so regenerating a screen leaves unchanged inputs (and their modification times) untouched.
+Inputs of jobs that are no longer generated (e.g. after lowering `max_combined_seq_length`) are removed, so the folder holds exactly the jobs of the manifest.
+The manifest is not written into the folder, since AF3 loads every `*.json` file of its input directory as an input.
+"""
+
+import os
+import re
+import json
+import hashlib
+from multiprocessing import Pool
+from constants import PROCESS_COUNT
+
+MANIFEST_SUFFIX = "_af3_inputs_manifest.json"
+# manifest location of earlier versions, inside the input folder (removed when the inputs are written again)
+LEGACY_MANIFEST_FILE = "af3_inputs_manifest.json"
+MANIFEST_VERSION = 1
+
+# Heavy atom counts of common ligands and modified residues of the PDB Chemical Component Dictionary (CCD): AF3 tokenizes ligands and modified residues
+# with one token per heavy atom instead of one token per residue
+CCD_HEAVY_ATOMS = {
+    # nucleotides and cofactors
+    "ATP": 31, "ADP": 27, "AMP": 23, "ANP": 31, "GTP": 32, "GDP": 28, "GNP": 32, "GSP": 32,
+    "NAD": 44, "NAP": 48, "FAD": 53, "FMN": 31, "SAM": 27, "SAH": 26, "COA": 48, "ACO": 51, "HEM": 43, "PLP": 16,
+    # ions
+    "MG": 1, "MN": 1, "ZN": 1, "CA": 1, "FE": 1, "FE2": 1, "CU": 1, "NI": 1, "CO": 1, "NA": 1, "K": 1, "CL": 1, "SO4": 5, "PO4": 5,
+    # sugars, lipids and crystallization additives
+    "NAG": 15, "MAN": 12, "BMA": 12, "GLC": 12, "GAL": 12, "FUC": 11, "CLR": 28, "PLM": 18, "MYR": 16, "OLA": 20, "GOL": 6, "EDO": 4, "PEG": 7, "ACT": 4,
+    # modified residues
+    "SEP": 11, "TPO": 12, "PTR": 17, "MLY": 12, "M3L": 13, "ALY": 13, "HYP": 9, "MSE": 9, "CSO": 8,
+}
+# atoms of a SMILES string: bracket atoms, and the two-letter and one-letter (aromatic in lower case) atoms of the organic subset
+SMILES_ATOM_PATTERN = re.compile(r"\[([^\]]*)\]|Br|Cl|[BCNOPSFI]|[bcnops]")
+SMILES_BRACKET_ELEMENT_PATTERN = re.compile(r"\d*([A-Z][a-z]?|[a-z]+)")
+
+_unknown_ccd_codes = set()
+
+
+def _get_smiles_heavy_atoms(smiles):
+    heavy_atoms = 0
+    for match in SMILES_ATOM_PATTERN.finditer(smiles):
+        # explicit hydrogens (e.g. [H], [2H]) are not tokenized
+        bracket = match.group(1)
+        heavy_atoms += bracket is None or SMILES_BRACKET_ELEMENT_PATTERN.match(bracket).group(1) != "H"
+    return heavy_atoms
+
+
+def _get_ccd_heavy_atoms(ccd_code):
+    if ccd_code in CCD_HEAVY_ATOMS:
+        return CCD_HEAVY_ATOMS[ccd_code]
+    if ccd_code not in _unknown_ccd_codes:
+        _unknown_ccd_codes.add(ccd_code)
+        print(f"Warning: unknown heavy atom count of CCD component {ccd_code}, counting it as one token (add it to CCD_HEAVY_ATOMS in af3_input_helper.py)", flush=True)
+    return 1
+
+
+def get_token_count(af3_input):
+    """
+    Number of tokens of an AF3 input: one per residue of every protein, RNA and DNA chain, except modified residues, and one per heavy atom of every ligand
+    (from CCD_HEAVY_ATOMS, or counted in its SMILES string) and modified residue, multiplied by the number of copies of each entity (`id` can be a list of chain ids).
+    """
+
+    token_count = 0
+    for entity in af3_input["sequences"]:
+        for entity_type, chain in entity.items():
+            copies = len(chain["id"]) if isinstance(chain["id"], list) else 1
+            if entity_type == "ligand":
+                if "smiles" in chain:
+                    token_count += copies * _get_smiles_heavy_atoms(chain["smiles"])
+                else:
+                    token_count += copies * sum(_get_ccd_heavy_atoms(ccd_code) for ccd_code in chain["ccdCodes"])
+            else:
+                modified_residues = [modification.get("ptmType", modification.get("modificationType")) for modification in chain.get("modifications", [])]
+                residue_tokens = len("".join(chain["sequence"].split())) - len(modified_residues)
+                token_count += copies * (residue_tokens + sum(_get_ccd_heavy_atoms(ccd_code) for ccd_code in modified_residues))
+
+    return token_count
+
+
+def get_manifest_file(folder):
+    return os.path.normpath(folder) + MANIFEST_SUFFIX
+
+
+def load_manifest(folder):
+    """
+    The jobs of a folder's manifest ({input file name: {"name", "chains", "tokens", "seeds", "hash", "size", "mtime_ns", "extra_files"}}), empty if there is none.
+    """
+
+    manifest_file = get_manifest_file(folder)
+    if not os.path.exists(manifest_file):
+        manifest_file = os.path.join(folder, LEGACY_MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+
+    return manifest["jobs"] if manifest.get("version") == MANIFEST_VERSION else {}
+
+
+def _write_job(args):
+    # serialize and hash a job, and write its input (and extra files) unless the file on disk is the one recorded with the same hash
+    folder, file_name, af3_input, extra_files, previous = args
+    content = json.dumps(af3_input, separators=(",", ":"))
+    content_hash = hashlib.sha256(content.encode()).hexdigest()
+    input_file = os.path.join(folder, file_name)
+
+    written = False
+    stat = os.stat(input_file) if os.path.exists(input_file) else None
+    if previous is None or previous["hash"] != content_hash or stat is None or [stat.st_size, stat.st_mtime_ns] != [previous["size"], previous["mtime_ns"]]:
+        for extra_file, extra_content in extra_files.items():
+            with open(os.path.join(folder, extra_file), "w") as f:
+                f.write(extra_content)
+        with open(input_file + ".tmp", "w") as f:
+            f.write(content)
+        os.replace(input_file + ".tmp", input_file)
+        stat = os.stat(input_file)
+        written = True
+
+    chains = [[chain["id"], len(chain.get("sequence", ""))] for entity in af3_input["sequences"] for chain in entity.values()]
+    entry = {
+        "name": af3_input["name"],
+        "chains": chains,
+        "tokens": get_token_count(af3_input),
+        "seeds": len(af3_input["modelSeeds"]),
+        "hash": content_hash,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "extra_files": sorted(extra_files),
+    }
+    return file_name, entry, written
+
+
+def write_af3_inputs(folder, jobs, process_count=PROCESS_COUNT):
+    """
+    Write the AF3 inputs of a folder in parallel and update its manifest. `jobs` is an iterable (e.g. a generator) of (input file name, AF3 input, {extra file name: content})
+    tuples, the extra files (e.g. a FASTA file of the job) are written along with the input. Inputs of jobs from the previous manifest that are not in `jobs` are removed.
+    Returns the new manifest jobs.
+    """
+
+    os.makedirs(folder, exist_ok=True)
+    previous_jobs = load_manifest(folder)
+    manifest_jobs = {}
+    written_count = 0
+    with Pool(processes=process_count) as pool:
+        job_args = ((folder, file_name, af3_input, extra_files, previous_jobs.get(file_name)) for file_name, af3_input, extra_files in jobs)
+        for file_name, entry, written in pool.imap(_write_job, job_args, chunksize=16):
+            manifest_jobs[file_name] = entry
+            written_count += written
+
+    removed_count = 0
+    for file_name in previous_jobs.keys() - manifest_jobs.keys():
+        for job_file in [file_name] + previous_jobs[file_name]["extra_files"]:
+            if os.path.exists(os.path.join(folder, job_file)):
+                os.remove(os.path.join(folder, job_file))
+        removed_count += 1
+
+    manifest_file = get_manifest_file(folder)
+    with open(manifest_file + ".tmp", "w") as f:
+        json.dump({"version": MANIFEST_VERSION, "jobs": manifest_jobs}, f)
+    os.replace(manifest_file + ".tmp", manifest_file)
+    if os.path.exists(os.path.join(folder, LEGACY_MANIFEST_FILE)):
+        os.remove(os.path.join(folder, LEGACY_MANIFEST_FILE))
+    print(f"{folder}: {len(manifest_jobs)} AF3 inputs, {written_count} written, {len(manifest_jobs) - written_count} unchanged, {removed_count} removed", flush=True)
+
+    return manifest_jobs
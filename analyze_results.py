@@ -4,21 +4,22 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 from process_results import print_uniprot_details
+from uniprot_cache import get_uniprot_details_batch
 from constants import CURRENT_PIPELINE
 assert CURRENT_PIPELINE == "pulldown", "This script is only for the pulldown pipeline"
-from constants import SUPERFOLDER_TO_FOLDER, PLDDT_SLIDING_WINDOW, MAX_CLASHES_THRESHOLD, CLASHES_MODEL, PREDICTION_THRESHOLD_METRIC, PREDICTION_THRESHOLD_METRIC_VALUE, DOMAINS_TO_RESIDUES, MIN_CONTACTS_THRESHOLDS, BINDING_DOMAINS_FILTER
-from get_binding_domain_combinations import generate_binding_domain_combinations
+from constants import SUPERFOLDER_TO_FOLDER, PLDDT_SLIDING_WINDOW, MAX_CLASHES_THRESHOLD, CLASHES_MODEL, PREDICTION_THRESHOLD_METRIC, PREDICTION_THRESHOLD_METRIC_VALUE, DOMAINS_TO_RESIDUES, MIN_CONTACTS_THRESHOLDS, BINDING_DOMAINS_FILTER, USE_RESULTS_STORE
+from get_binding_domain_combinations import count_binding_domain_combinations
+from results_store import read_stage
+from perf_helper import measure, write_perf_report
 
 INPUT_FOLDER = "output_merged_results/"
 OUTPUT_FOLDER = "output_analyze_results/"
 
 
 def plot_binding_domain_combinations(folder, merged_df, filtered_df, threshold):
-    # plot bar chart of all binding domain combinations frequency
-    binding_domain_combinations = generate_binding_domain_combinations(DOMAINS_TO_RESIDUES.keys())
-    binding_domain_combinations = ["_".join(combination) + f"_MIN_{threshold}" for combination in binding_domain_combinations]
-    freq_merged = merged_df[binding_domain_combinations].sum()
-    freq_filtered = filtered_df[binding_domain_combinations].sum()
+    # plot bar chart of all binding domain combinations frequency (counted from the combination bitmasks, no combination columns needed)
+    freq_merged = count_binding_domain_combinations(merged_df, threshold)
+    freq_filtered = count_binding_domain_combinations(filtered_df, threshold)
 
     plt.figure(figsize=(10, 8))
     sns.barplot(x=freq_merged.index, y=freq_merged.values, alpha=0.5, label="All Data")
@@ -36,70 +37,105 @@ def plot_binding_domain_combinations(folder, merged_df, filtered_df, threshold):
     plt.close("all")
 
 
-def main():
-    if not os.path.exists(OUTPUT_FOLDER):
-        os.makedirs(OUTPUT_FOLDER)
+def get_analysis_columns():
+    """
+    The merged results columns used by the analysis (the full rows are only read for the filtered predictions).
+    The binding domain combinations are derived from the contacts, so the combination columns are not read.
+    """
+    columns = ["prediction_key", "fasta", "uniprot link", PREDICTION_THRESHOLD_METRIC] + [f"{domain}_contacts" for domain in DOMAINS_TO_RESIDUES.keys()]
+    if MAX_CLASHES_THRESHOLD is not None and CLASHES_MODEL is not None:
+        columns.append("between clashes")
+    return columns
 
-    for superfolder, folders in SUPERFOLDER_TO_FOLDER.items():
-        print(f"Processing {superfolder}", flush=True)
-        merged_df = pd.DataFrame()
+
+def analyze_superfolder(superfolder, folders):
+    """
+    Filter the merged results of the folders of a superfolder, and write the analysis CSV, the filtered proteins TSV and the plots.
+    """
+
+    print(f"Processing {superfolder}", flush=True)
+    if USE_RESULTS_STORE:
+        merged_df = read_stage("merged", superfolder=superfolder, folders=folders, window=PLDDT_SLIDING_WINDOW, columns=get_analysis_columns())
+    else:
+        merged_dfs = []
         for folder in folders:
             print(f"Processing {folder}", flush=True)
 
             merged_file = INPUT_FOLDER + folder + f"_merged_plddt_window_{PLDDT_SLIDING_WINDOW}.csv"
-            partial_merged_df = pd.read_csv(merged_file)
-            merged_df = pd.concat([merged_df, partial_merged_df], ignore_index=True)
-
-        output_csv_file = OUTPUT_FOLDER + superfolder + f"_analysis_plddt_window_{PLDDT_SLIDING_WINDOW}.csv"
-        output_tsv_file = OUTPUT_FOLDER + superfolder + f"_filtered_plddt_window_{PLDDT_SLIDING_WINDOW}.tsv"
-
-        merged_df["highest binding domain"] = merged_df[[f"{domain}_contacts" for domain in DOMAINS_TO_RESIDUES.keys()]].idxmax(axis=1)
-        merged_df["highest binding domain"] = merged_df["highest binding domain"].map({f"{domain}_contacts": domain for domain in DOMAINS_TO_RESIDUES.keys()})
-
-        best_by_metric_idx = merged_df.groupby("fasta")[PREDICTION_THRESHOLD_METRIC].idxmax()
-        top_by_metric_df = merged_df.loc[best_by_metric_idx].reset_index(drop=True)
-
-        if BINDING_DOMAINS_FILTER is not None:
-            filtered_df = merged_df[merged_df["highest binding domain"].isin(BINDING_DOMAINS_FILTER)]
-
-        if MAX_CLASHES_THRESHOLD is None or CLASHES_MODEL is None:
-            print("No clashes data available, not filtering by clashes.")
-            filtered_df = filtered_df[(filtered_df[PREDICTION_THRESHOLD_METRIC] >= PREDICTION_THRESHOLD_METRIC_VALUE)]
-        else:
-            filtered_df = filtered_df[(filtered_df[PREDICTION_THRESHOLD_METRIC] >= PREDICTION_THRESHOLD_METRIC_VALUE) & (filtered_df["between clashes"] <= MAX_CLASHES_THRESHOLD)]
-            # plot distribution of prediction metric and clashes vs. RCKW
-            g = sns.JointGrid(x=PREDICTION_THRESHOLD_METRIC, y="between clashes", data=top_by_metric_df, height=8)
-            g.plot_marginals(sns.kdeplot)
-            g.plot_joint(sns.scatterplot, alpha=0.5, edgecolor=None, s=16)
-            # g.plot_joint(sns.scatterplot, alpha=0.5, edgecolor=None, s=10, hue=merged_df["binding domain"], palette="Set2")
-            g.figure.suptitle(f"Scatter plot of {PREDICTION_THRESHOLD_METRIC} vs between clashes for {superfolder}", y=1.03)
-            g.set_axis_labels(PREDICTION_THRESHOLD_METRIC, "between clashes")
-            plt.savefig(f"{OUTPUT_FOLDER}{superfolder}_jointplot_{PREDICTION_THRESHOLD_METRIC}_vs_clashes_plddt_window_{PLDDT_SLIDING_WINDOW}.svg", bbox_inches="tight")
-
-
-        # print & write out filtered results
-        filtered_df = filtered_df.sort_values(by=PREDICTION_THRESHOLD_METRIC, ascending=False).reset_index(drop=True)
-        filtered_df.to_csv(output_csv_file, index=False)
-        print(f"Filtered predictions saved to {output_csv_file}")
-
-        for threshold in MIN_CONTACTS_THRESHOLDS:
-            plot_binding_domain_combinations(superfolder, merged_df, filtered_df, threshold)
-
-        unique_uniprot_link = filtered_df["uniprot link"].unique()
-        print(f"\n\n\n\n=================== {superfolder} ===================")
-        print(f"Filtered predictions for {superfolder}: {len(unique_uniprot_link)} unique proteins, {filtered_df.shape[0]} total predictions")
-        with open(output_tsv_file, "w") as f:
-            f.write("uniprot\tprotein\torganism\thits\n")
-            for uniprot_link in unique_uniprot_link:
-                print()
-                uniprot_details = print_uniprot_details(uniprot_link.split("/")[-2])
-                hits = filtered_df[filtered_df["uniprot link"] == uniprot_link].shape[0]
-                f.write(f"{uniprot_link}\t{uniprot_details['full_name']}\t{uniprot_details['organism']}\t{hits}\n")
-
-        tsv_df = pd.read_csv(output_tsv_file, sep="\t")
-        tsv_df = tsv_df.sort_values(by="hits", ascending=False).reset_index(drop=True)
-        tsv_df.to_csv(output_tsv_file, sep="\t", index=False)
+            merged_dfs.append(pd.read_csv(merged_file))
+        merged_df = pd.concat(merged_dfs, ignore_index=True)
+
+    output_csv_file = OUTPUT_FOLDER + superfolder + f"_analysis_plddt_window_{PLDDT_SLIDING_WINDOW}.csv"
+    output_tsv_file = OUTPUT_FOLDER + superfolder + f"_filtered_plddt_window_{PLDDT_SLIDING_WINDOW}.tsv"
+
+    merged_df["highest binding domain"] = merged_df[[f"{domain}_contacts" for domain in DOMAINS_TO_RESIDUES.keys()]].idxmax(axis=1)
+    merged_df["highest binding domain"] = merged_df["highest binding domain"].map({f"{domain}_contacts": domain for domain in DOMAINS_TO_RESIDUES.keys()})
+
+    best_by_metric_idx = merged_df.groupby("fasta")[PREDICTION_THRESHOLD_METRIC].idxmax()
+    top_by_metric_df = merged_df.loc[best_by_metric_idx].reset_index(drop=True)
+
+    if BINDING_DOMAINS_FILTER is not None:
+        filtered_df = merged_df[merged_df["highest binding domain"].isin(BINDING_DOMAINS_FILTER)]
+
+    if MAX_CLASHES_THRESHOLD is None or CLASHES_MODEL is None:
+        print("No clashes data available, not filtering by clashes.")
+        filtered_df = filtered_df[(filtered_df[PREDICTION_THRESHOLD_METRIC] >= PREDICTION_THRESHOLD_METRIC_VALUE)]
+    else:
+        filtered_df = filtered_df[(filtered_df[PREDICTION_THRESHOLD_METRIC] >= PREDICTION_THRESHOLD_METRIC_VALUE) & (filtered_df["between clashes"] <= MAX_CLASHES_THRESHOLD)]
+        # plot distribution of prediction metric and clashes vs. RCKW
+        g = sns.JointGrid(x=PREDICTION_THRESHOLD_METRIC, y="between clashes", data=top_by_metric_df, height=8)
+        g.plot_marginals(sns.kdeplot)
+        g.plot_joint(sns.scatterplot, alpha=0.5, edgecolor=None, s=16)
+        # g.plot_joint(sns.scatterplot, alpha=0.5, edgecolor=None, s=10, hue=merged_df["binding domain"], palette="Set2")
+        g.figure.suptitle(f"Scatter plot of {PREDICTION_THRESHOLD_METRIC} vs between clashes for {superfolder}", y=1.03)
+        g.set_axis_labels(PREDICTION_THRESHOLD_METRIC, "between clashes")
+        plt.savefig(f"{OUTPUT_FOLDER}{superfolder}_jointplot_{PREDICTION_THRESHOLD_METRIC}_vs_clashes_plddt_window_{PLDDT_SLIDING_WINDOW}.svg", bbox_inches="tight")
+
+
+    if USE_RESULTS_STORE:
+        # read the full rows of the filtered predictions only
+        full_filtered_df = read_stage("merged", superfolder=superfolder, folders=folders, window=PLDDT_SLIDING_WINDOW, prediction_keys=filtered_df["prediction_key"])
+        filtered_df = pd.merge(full_filtered_df, filtered_df[["prediction_key", "highest binding domain"]], on="prediction_key").drop(columns="prediction_key")
+
+    # print & write out filtered results
+    filtered_df = filtered_df.sort_values(by=PREDICTION_THRESHOLD_METRIC, ascending=False).reset_index(drop=True)
+    filtered_df.to_csv(output_csv_file, index=False)
+    print(f"Filtered predictions saved to {output_csv_file}")
+
+    for threshold in MIN_CONTACTS_THRESHOLDS:
+        plot_binding_domain_combinations(superfolder, merged_df, filtered_df, threshold)
+
+    unique_uniprot_link = filtered_df["uniprot link"].unique()
+    print(f"\n\n\n\n=================== {superfolder} ===================")
+    print(f"Filtered predictions for {superfolder}: {len(unique_uniprot_link)} unique proteins, {filtered_df.shape[0]} total predictions")
+    # fetch the details of all proteins missing from the UniProt cache in batches, before printing them one by one
+    get_uniprot_details_batch([uniprot_link.split("/")[-2] for uniprot_link in unique_uniprot_link])
+    hits_per_link = filtered_df["uniprot link"].value_counts()
+    with open(output_tsv_file, "w") as f:
+        f.write("uniprot\tprotein\torganism\thits\n")
+        for uniprot_link in unique_uniprot_link:
+            print()
+            uniprot_details = print_uniprot_details(uniprot_link.split("/")[-2])
+            if uniprot_details is None:
+                print(f"Could not get the UniProt details of {uniprot_link}", flush=True)
+                uniprot_details = {"full_name": "", "organism": ""}
+            hits = hits_per_link[uniprot_link]
+            f.write(f"{uniprot_link}\t{uniprot_details['full_name']}\t{uniprot_details['organism']}\t{hits}\n")
+
+    tsv_df = pd.read_csv(output_tsv_file, sep="\t")
+    tsv_df = tsv_df.sort_values(by="hits", ascending=False).reset_index(drop=True)
+    tsv_df.to_csv(output_tsv_file, sep="\t", index=False)
+
+
+def main():
+    if not os.path.exists(OUTPUT_FOLDER):
+        os.makedirs(OUTPUT_FOLDER)
+
+    for superfolder, folders in SUPERFOLDER_TO_FOLDER.items():
+        with measure("analyze", superfolder, level="stage"):
+            analyze_superfolder(superfolder, folders)
 
 
 if __name__ == "__main__":
     main()
+    write_perf_report()
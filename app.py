@@ -1,11 +1,22 @@
-from flask import Flask, render_template, jsonify, request, send_from_directory
+from flask import Flask, Response, render_template, jsonify, request, send_from_directory
 import pandas as pd
+import numpy as np
+import threading
+import hashlib
+import gzip
+import json
 import os
 
-from constants import ALL_PLDDT_WINDOWS, MIN_CONTACTS_THRESHOLDS, SUPERFOLDER_TO_FASTA_AND_FOLDER
+from constants import ALL_PLDDT_WINDOWS, MIN_CONTACTS_THRESHOLDS, SUPERFOLDER_TO_FASTA_AND_FOLDER, DOMAINS_TO_RESIDUES, BINDING_DOMAINS_FILTER, PREDICTION_THRESHOLD_METRIC, PREDICTION_THRESHOLD_METRIC_VALUE, MAX_CLASHES_THRESHOLD
+from get_binding_domain_combinations import generate_binding_domain_combinations, get_combination_bitmask, get_binding_domain_bitmasks
 
 app = Flask(__name__, template_folder='web_visualization/')
 
+MERGED_RESULTS_FOLDER = 'output_merged_results'
+# merged results file -> {"version": (mtime_ns, size), "bitmasks": {threshold: bitmasks}, "filtered": mask, "responses": {threshold: (etag, json, gzipped json)}}
+_merged_results_cache = {}
+_merged_results_lock = threading.Lock()
+
 @app.route('/static/merged_results/<path:filename>')
 def serve_merged_results(filename):
     return send_from_directory(os.path.join('output_merged_results'), filename)
@@ -14,6 +25,111 @@ def serve_merged_results(filename):
 def index():
     return render_template('index.html')
 
+def get_chart_domains():
+    # the domains whose combinations are charted (as in analyze_results.py, the binding domains filter if set)
+    return list(BINDING_DOMAINS_FILTER) if BINDING_DOMAINS_FILTER is not None else list(DOMAINS_TO_RESIDUES.keys())
+
+def load_merged_results(merged_file):
+    """
+    Read the columns of a merged results file needed for the combination frequencies: the binding domain bitmask of every row and threshold,
+    and whether the row passes the prediction metric and clashes thresholds.
+    """
+    header = pd.read_csv(merged_file, nrows=0).columns
+    columns = [PREDICTION_THRESHOLD_METRIC] + [column for column in header if column.endswith('_contacts') or column.startswith('binding_domains_MIN_') or column == 'between clashes']
+    merged_df = pd.read_csv(merged_file, usecols=columns)
+
+    filtered = merged_df[PREDICTION_THRESHOLD_METRIC] >= PREDICTION_THRESHOLD_METRIC_VALUE
+    # without clashes data, only the prediction metric threshold is applied (as in analyze_results.py)
+    if MAX_CLASHES_THRESHOLD is not None and 'between clashes' in merged_df.columns:
+        filtered &= merged_df['between clashes'] <= MAX_CLASHES_THRESHOLD
+
+    thresholds = set(MIN_CONTACTS_THRESHOLDS) | {int(column.rsplit('_', 1)[1]) for column in merged_df.columns if column.startswith('binding_domains_MIN_')}
+    return {'bitmasks': {threshold: get_binding_domain_bitmasks(merged_df, threshold) for threshold in thresholds}, 'filtered': filtered.to_numpy()}
+
+def get_combination_frequencies(entry, threshold):
+    """
+    Number of rows with each (exact) combination of the chart domains, for all rows and for the filtered rows, in the order of the chart.
+    """
+    all_domains = list(DOMAINS_TO_RESIDUES.keys())
+    bitmasks = entry['bitmasks'][threshold]
+    all_counts = np.bincount(bitmasks, minlength=1 << len(all_domains))
+    filtered_counts = np.bincount(bitmasks[entry['filtered']], minlength=1 << len(all_domains))
+    frequencies = []
+    # single domains first, as in the chart
+    for combination in reversed(generate_binding_domain_combinations(get_chart_domains())):
+        bitmask = get_combination_bitmask(combination, all_domains)
+        frequencies.append({'combination': ' + '.join(combination), 'all': int(all_counts[bitmask]), 'filtered': int(filtered_counts[bitmask])})
+    return frequencies
+
+def get_cached_response(merged_file, threshold, build_payload):
+    """
+    The (ETag, JSON, gzipped JSON) response for a threshold of a merged results file, computed once per version (modification time and size) of the file.
+    """
+    stat = os.stat(merged_file)
+    version = (stat.st_mtime_ns, stat.st_size)
+    with _merged_results_lock:
+        entry = _merged_results_cache.get(merged_file)
+        if entry is None or entry['version'] != version:
+            entry = {'version': version, 'responses': {}, **load_merged_results(merged_file)}
+            _merged_results_cache[merged_file] = entry
+        if threshold not in entry['responses']:
+            if threshold not in entry['bitmasks']:
+                return None
+            body = json.dumps(build_payload(entry, threshold)).encode()
+            entry['responses'][threshold] = (hashlib.sha1(body).hexdigest(), body, gzip.compress(body))
+        return entry['responses'][threshold]
+
+def json_response(etag, body, gzipped_body):
+    # gzipped if the client accepts it; the ETag lets the browser revalidate its cached copy with a 304 response,
+    # the gzipped body has its own (strong) ETag since its bytes differ from the identity body
+    use_gzip = 'gzip' in request.accept_encodings
+    response = Response(gzipped_body if use_gzip else body, mimetype='application/json')
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+        etag += '-gz'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+@app.route('/api/config')
+def api_config():
+    return jsonify({
+        'superfolders': list(SUPERFOLDER_TO_FASTA_AND_FOLDER.keys()),
+        'plddt_windows': ALL_PLDDT_WINDOWS,
+        'min_contacts_thresholds': MIN_CONTACTS_THRESHOLDS,
+        'domains': get_chart_domains(),
+        'prediction_threshold_metric': PREDICTION_THRESHOLD_METRIC,
+        'prediction_threshold_metric_value': PREDICTION_THRESHOLD_METRIC_VALUE,
+        'max_clashes_threshold': MAX_CLASHES_THRESHOLD,
+    })
+
+@app.route('/api/combination_frequencies/<superfolder>/<int(signed=True):window>/<int:min_contacts>')
+def api_combination_frequencies(superfolder, window, min_contacts):
+    """
+    Binding domain combination frequencies of a superfolder's merged results, for all predictions and for the predictions passing the prediction metric and clashes thresholds.
+    """
+    if superfolder not in SUPERFOLDER_TO_FASTA_AND_FOLDER:
+        return jsonify({'error': f'Unknown superfolder {superfolder}'}), 404
+    merged_file = os.path.join(MERGED_RESULTS_FOLDER, f'{superfolder}_merged_plddt_window_{window}.csv')
+    if not os.path.exists(merged_file):
+        return jsonify({'error': f'No merged results for {superfolder} with sliding window {window}'}), 404
+
+    def build_payload(entry, threshold):
+        return {
+            'superfolder': superfolder,
+            'plddt_window': window,
+            'min_contacts': threshold,
+            'total': int(len(entry['filtered'])),
+            'total_filtered': int(entry['filtered'].sum()),
+            'frequencies': get_combination_frequencies(entry, threshold),
+        }
+
+    response = get_cached_response(merged_file, min_contacts, build_payload)
+    if response is None:
+        return jsonify({'error': f'Minimum contacts threshold {min_contacts} is not one of min_contacts_thresholds'}), 404
+    return json_response(*response)
+
 # TODO: Not used for now, but might be useful in the future, will just leave here for now
 
 # binding_domain_svg_files = []
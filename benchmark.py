@@ -0,0 +1,283 @@
+"""
+Benchmark of the pulldown analysis stages on synthetic screens (see `synthetic_af3.py`), to measure optimizations on a machine without GPUs or a real screen.
+
+For every scale (number of predictions), a synthetic screen is generated (once, it is reused while the generation parameters are unchanged) into
+`output_benchmark/screens/<parameters hash>/` along with a config file, and the stages are timed in a separate process that runs with that config:
+    screen_index (building the index of the screen folder), process_results (`process_results.process_folder`),
+    sliding_window (`files_helper.get_model_files` writing the pLDDT sliding window files), get_model_files (the same call when the files exist),
+    binding_domain (native contacts and buried areas of the models), binding_domain_combinations (`process_binding_domain_combinations`),
+    merge (merge_results.py) and analyze (`analyze_results.main`).
+Every stage starts from the same state in every repetition (the result caches are disabled and the files a stage creates are removed before it), and the
+fastest of `--repeat` repetitions is kept. The wall and CPU time (including the pool workers) of each stage and the peak RSS of each scale are saved with the
+git commit and machine details to `output_benchmark/results/<time>_<commit>.json`, and compared to a previous results file with `--baseline`.
+
+Usage:
+    `python benchmark.py --scales 10 100 --repeat 3 [--set virtual_plddt_windows=true] [--baseline output_benchmark/results/<file>.json]`
+    `python benchmark.py --compare <baseline results file> <results file>`
+"""
+
+import os
+import sys
+import json
+import time
+import glob
+import runpy
+import shutil
+import hashlib
+import platform
+import resource
+import argparse
+import subprocess
+import yaml
+
+BENCHMARK_FOLDER = "output_benchmark/"
+SCRIPT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+SCREEN_FOLDER = "SYN_SCREEN"
+SUPERFOLDER = "SYN"
+TIMINGS_FILE = "timings.json"
+STAGES = ["screen_index", "process_results", "sliding_window", "get_model_files", "binding_domain", "binding_domain_combinations", "merge", "analyze"]
+# stages faster than this (in the baseline) are not flagged as regressions, their timings are mostly noise
+MIN_COMPARED_SECONDS = 0.05
+
+
+def get_generation_params(args, prediction_count):
+    return {
+        "predictions": prediction_count,
+        "bait_length": args.bait_length,
+        "prey_length": args.prey_length,
+        "seeds": args.seeds,
+        "samples": args.samples,
+        "random_seed": args.random_seed,
+    }
+
+
+def get_config(bait_length, overrides):
+    """
+    Config of a benchmark screen: four BAIT domains of equal length, the sliding windows of the default config, and no result caches or network access.
+    """
+
+    domain_length = bait_length // 4
+    config = {
+        "current_pipeline": "pulldown",
+        "process_count": os.cpu_count(),
+        "bait_filename": "bait.fasta",
+        "superfolder_to_fasta_and_folder": {SUPERFOLDER: [["preys.fasta", SCREEN_FOLDER]]},
+        "plddt_sliding_window": 11,
+        "all_plddt_windows": [-1, 11, 25],
+        "prediction_threshold_metric": "ipTM",
+        "prediction_threshold_metric_value": 0.4,
+        "min_contacts_thresholds": [1, 20, 80],
+        "domains_to_residues": {f"D{i + 1}": [i * domain_length + 1, (i + 1) * domain_length if i < 3 else bait_length] for i in range(4)},
+        "binding_domains_filter": ["D1", "D2"],
+        "use_result_cache": False,
+        "uniprot_offline": True,
+    }
+    config.update(overrides)
+    return config
+
+
+def prepare_screen(args, prediction_count, overrides):
+    """
+    Generate the synthetic screen of a scale (unless it exists with the same parameters) and write its config file. Returns the work folder of the scale.
+    """
+
+    from synthetic_af3 import generate_screen
+
+    params = get_generation_params(args, prediction_count)
+    work_folder = os.path.join(BENCHMARK_FOLDER, "screens", hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16])
+    params_file = os.path.join(work_folder, "generation_params.json")
+    if not os.path.exists(params_file):
+        shutil.rmtree(work_folder, ignore_errors=True)
+        generate_screen(
+            os.path.join(work_folder, SCREEN_FOLDER), prediction_count, args.bait_length, tuple(args.prey_length), args.seeds, args.samples, args.random_seed, process_count=args.processes
+        )
+        # written last, so an interrupted generation is started again
+        with open(params_file, "w") as f:
+            json.dump(params, f)
+
+    with open(os.path.join(work_folder, "benchmark.yaml"), "w") as f:
+        yaml.safe_dump(get_config(args.bait_length, overrides), f)
+    return work_folder
+
+
+def _timed(timings, stage, function, *args):
+    # the CPU time includes the pool workers of the stage, which are joined when their pool is closed
+    times_start, wall_start = os.times(), time.perf_counter()
+    result = function(*args)
+    wall_seconds = time.perf_counter() - wall_start
+    times_end = os.times()
+    cpu_seconds = sum(times_end[:4]) - sum(times_start[:4])
+    if stage not in timings or wall_seconds < timings[stage]["wall_seconds"]:
+        timings[stage] = {"wall_seconds": round(wall_seconds, 4), "cpu_seconds": round(cpu_seconds, 4)}
+    return result
+
+
+def measure_stages(repeat):
+    """
+    Time the stages on the screen of the current folder, with the config of the BULKAF3_CONFIG environment variable (run by `run_scale` in a separate process).
+    """
+
+    import pandas as pd
+    import analyze_results
+    from screen_index import load_screen_index, get_screen_index_file
+    from process_results import process_folder
+    from files_helper import get_model_files, N_MODEL
+    from plddt_store import PLDDT_STORE_FILE
+    from get_binding_domain import process_model_parallel, get_binding_domain_columns
+    from get_binding_domain_combinations import process_binding_domain_combinations
+    from results_store import write_stage, get_superfolder, STORE_FOLDER
+    from constants import PLDDT_SLIDING_WINDOW, ALL_PLDDT_WINDOWS, USE_RESULTS_STORE
+
+    timings = {}
+    results_file = f"output_raw_results/{SCREEN_FOLDER}_results.csv"
+    binding_domain_file = f"output_binding_domain/{SCREEN_FOLDER}_binding_domain_plddt_window_{PLDDT_SLIDING_WINDOW}.csv"
+    for folder in ["output_raw_results", "output_binding_domain"]:
+        os.makedirs(folder, exist_ok=True)
+
+    # as in the __main__ blocks of process_results.py and get_binding_domain.py, the results are also written to the results store with use_results_store
+    def process_results():
+        process_folder(SCREEN_FOLDER, results_file)
+        if USE_RESULTS_STORE:
+            write_stage("raw_results", pd.read_csv(results_file), get_superfolder(SCREEN_FOLDER), SCREEN_FOLDER)
+
+    def binding_domain_combinations():
+        binding_domain_df = process_binding_domain_combinations(SCREEN_FOLDER)
+        if USE_RESULTS_STORE:
+            write_stage("binding_domain", binding_domain_df, get_superfolder(SCREEN_FOLDER), SCREEN_FOLDER, PLDDT_SLIDING_WINDOW)
+
+    for _ in range(repeat):
+        if os.path.exists(get_screen_index_file(SCREEN_FOLDER)):
+            os.remove(get_screen_index_file(SCREEN_FOLDER))
+        # every repetition writes the results store from scratch
+        shutil.rmtree(STORE_FOLDER, ignore_errors=True)
+        _timed(timings, "screen_index", load_screen_index, SCREEN_FOLDER)
+        _timed(timings, "process_results", process_results)
+
+        for window_file in glob.glob(os.path.join(SCREEN_FOLDER, "*", "*", "*_plddt_window_*.cif")) + glob.glob(os.path.join(SCREEN_FOLDER, PLDDT_STORE_FILE)):
+            os.remove(window_file)
+        _timed(timings, "sliding_window", get_model_files, SCREEN_FOLDER, PLDDT_SLIDING_WINDOW, N_MODEL, ALL_PLDDT_WINDOWS)
+        model_files = _timed(timings, "get_model_files", get_model_files, SCREEN_FOLDER, PLDDT_SLIDING_WINDOW, N_MODEL, ALL_PLDDT_WINDOWS)
+
+        binding_domain_rows = _timed(timings, "binding_domain", process_model_parallel, model_files)
+        pd.DataFrame(binding_domain_rows, columns=get_binding_domain_columns()).to_csv(binding_domain_file, index=False)
+        _timed(timings, "binding_domain_combinations", binding_domain_combinations)
+        _timed(timings, "merge", runpy.run_path, os.path.join(SCRIPT_FOLDER, "merge_results.py"))
+        _timed(timings, "analyze", analyze_results.main)
+
+    # ru_maxrss is in kB on Linux
+    peak_rss_mb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+    with open(TIMINGS_FILE, "w") as f:
+        json.dump({"model_files": len(model_files), "peak_rss_mb": round(peak_rss_mb, 1), "stages": timings}, f)
+
+
+def run_scale(work_folder, repeat):
+    """
+    Run `measure_stages` in the work folder of a scale, in a new process so the config of the scale is used. Returns its timings.
+    """
+
+    env = dict(os.environ, BULKAF3_CONFIG="benchmark.yaml", MPLBACKEND="Agg")
+    with open(os.path.join(work_folder, "benchmark.log"), "w") as log:
+        returncode = subprocess.call([sys.executable, os.path.join(SCRIPT_FOLDER, "benchmark.py"), "--measure", str(repeat)], cwd=work_folder, env=env, stdout=log, stderr=subprocess.STDOUT)
+    if returncode != 0:
+        raise RuntimeError(f"The benchmark failed with exit code {returncode}, see {os.path.join(work_folder, 'benchmark.log')}")
+
+    with open(os.path.join(work_folder, TIMINGS_FILE)) as f:
+        return json.load(f)
+
+
+def get_git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPT_FOLDER, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=SCRIPT_FOLDER, capture_output=True, text=True, check=True).stdout.strip() != ""
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def compare_results(baseline, results, threshold):
+    """
+    Print the wall time of every stage and scale of two results next to each other, flagging the stages that are more than `threshold` (a fraction) slower.
+    Returns the number of regressions.
+    """
+
+    regressions = 0
+    print(f"{'scale':>8} {'stage':<28} {'baseline s':>11} {'current s':>11} {'change':>8}", flush=True)
+    for scale, scale_results in results["scales"].items():
+        baseline_stages = baseline["scales"].get(scale, {}).get("stages", {})
+        for stage, timing in scale_results["stages"].items():
+            if stage not in baseline_stages:
+                continue
+            baseline_seconds, seconds = baseline_stages[stage]["wall_seconds"], timing["wall_seconds"]
+            change = seconds / baseline_seconds - 1 if baseline_seconds > 0 else 0.0
+            is_regression = change > threshold and baseline_seconds >= MIN_COMPARED_SECONDS
+            regressions += is_regression
+            print(f"{scale:>8} {stage:<28} {baseline_seconds:>11.3f} {seconds:>11.3f} {change:>+8.1%}{'  SLOWER' if is_regression else ''}", flush=True)
+
+    print(f"{regressions} stages more than {threshold:.0%} slower than the baseline (commit {baseline.get('commit')})", flush=True)
+    return regressions
+
+
+def run_benchmark(args, overrides):
+    results = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "machine": {"platform": platform.platform(), "processor": platform.processor(), "cpu_count": os.cpu_count(), "python": platform.python_version()},
+        "generation_params": get_generation_params(args, None),
+        "config_overrides": overrides,
+        "repeat": args.repeat,
+        "scales": {},
+    }
+    results["commit"], results["dirty"] = get_git_commit()
+
+    for prediction_count in args.scales:
+        work_folder = prepare_screen(args, prediction_count, overrides)
+        print(f"Benchmarking {prediction_count} predictions in {work_folder}", flush=True)
+        scale_results = run_scale(work_folder, args.repeat)
+        results["scales"][str(prediction_count)] = scale_results
+        for stage in STAGES:
+            timing = scale_results["stages"][stage]
+            print(f"{prediction_count:>8} {stage:<28} {timing['wall_seconds']:>9.3f} s wall {timing['cpu_seconds']:>9.3f} s CPU", flush=True)
+        print(f"{prediction_count:>8} {scale_results['model_files']} models, peak RSS {scale_results['peak_rss_mb']} MB", flush=True)
+
+    results_folder = os.path.join(BENCHMARK_FOLDER, "results")
+    os.makedirs(results_folder, exist_ok=True)
+    results_file = os.path.join(results_folder, f"{time.strftime('%Y%m%d-%H%M%S')}_{results['commit'] or 'nogit'}.json")
+    with open(results_file, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved the benchmark results to {results_file}", flush=True)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pulldown analysis stages on synthetic AF3 screens")
+    parser.add_argument("--scales", type=int, nargs="+", default=[10, 100], help="numbers of predictions of the benchmarked screens")
+    parser.add_argument("--bait-length", type=int, default=400, help="number of residues of the BAIT chain")
+    parser.add_argument("--prey-length", type=int, nargs=2, default=[100, 800], metavar=("MIN", "MAX"), help="range of the number of residues of the PREY chains")
+    parser.add_argument("--seeds", type=int, default=1, help="number of model seeds per prediction")
+    parser.add_argument("--samples", type=int, default=5, help="number of samples per seed")
+    parser.add_argument("--random-seed", type=int, default=0, help="seed of the screen generator")
+    parser.add_argument("--processes", type=int, default=None, help="number of processes generating the screens (default: all CPUs)")
+    parser.add_argument("--repeat", type=int, default=1, help="number of repetitions of every stage, the fastest is kept")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="override a config key of the benchmark (YAML value), e.g. virtual_plddt_windows=true")
+    parser.add_argument("--baseline", help="results file to compare the new results to")
+    parser.add_argument("--threshold", type=float, default=0.1, help="fraction of slowdown that is flagged as a regression")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "RESULTS"), help="compare two results files and exit")
+    parser.add_argument("--measure", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure is not None:
+        measure_stages(args.measure)
+        sys.exit(0)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            results = json.load(f)
+        sys.exit(1 if compare_results(baseline, results, args.threshold) else 0)
+
+    overrides = {key: yaml.safe_load(value) for key, value in (override.split("=", 1) for override in args.set)}
+    results = run_benchmark(args, overrides)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        sys.exit(1 if compare_results(baseline, results, args.threshold) else 0)
@@ -1,12 +1,15 @@
 import os
 import re
-import requests
+import copy
 import json
 
 from files_helper import get_sequences_from_fasta
+from uniprot_cache import get_uniprot_fastas
+from schedule_af3_jobs import schedule_folder
+from af3_input_helper import get_token_count, write_af3_inputs
 from constants import CURRENT_PIPELINE
 assert CURRENT_PIPELINE == "pulldown", "This script is only for the pulldown pipeline"
-from constants import CONFIG_FILE, BAIT_FILENAME, SUPERFOLDER_TO_FASTA_AND_FOLDER, TEMPLATE_FILE, NUMBER_OF_SEEDS, MODEL_WEIGHTS_FOLDER, DATABASE_FOLDER, MAX_COMBINED_SEQ_LENGTH
+from constants import CONFIG_FILE, BAIT_FILENAME, SUPERFOLDER_TO_FASTA_AND_FOLDER, TEMPLATE_FILE, NUMBER_OF_SEEDS, MODEL_WEIGHTS_FOLDER, DATABASE_FOLDER, MAX_COMBINED_SEQ_LENGTH, GPU_COUNT
 
 def process_folder(input_fasta, output_folder):
     bash_script_file = output_folder + "_RUN.sh"
@@ -21,20 +24,38 @@ def process_folder(input_fasta, output_folder):
     bait_uniprot_ids, bait_sequences = get_sequences_from_fasta(BAIT_FILENAME)
     prey_uniprot_ids, prey_sequences = get_sequences_from_fasta(input_fasta)
 
+    missing_uniprot_ids = []
     for uniprot_id in bait_uniprot_ids + prey_uniprot_ids:
-        file = f"{output_folder}/{uniprot_id}.fasta"
-        if not os.path.exists(file):
-            url = f"https://rest.uniprot.org/uniprotkb/{uniprot_id}.fasta"
-            response = requests.get(url)
-            if response.status_code == 200:
-                print("Downloaded " + url)
-                with open(file, "wb") as f:
-                    f.write(response.content)
-            else:
-                print("Failed to download: " + url)
+        if not os.path.exists(f"{output_folder}/{uniprot_id}.fasta"):
+            missing_uniprot_ids.append(uniprot_id)
         else:
             print("Already downloaded, skipping " + uniprot_id)
 
+    # FASTA files come from the local UniProt cache, missing ones are fetched concurrently in batches
+    fastas = get_uniprot_fastas(missing_uniprot_ids)
+    failed_uniprot_ids = []
+    for uniprot_id in missing_uniprot_ids:
+        if fastas[uniprot_id] is not None:
+            print("Downloaded " + uniprot_id)
+            # write to a temporary file first, so an interrupted run never leaves a partial FASTA file behind
+            fasta_file = f"{output_folder}/{uniprot_id}.fasta"
+            with open(fasta_file + ".tmp", "w") as f:
+                f.write(fastas[uniprot_id])
+            os.replace(fasta_file + ".tmp", fasta_file)
+        else:
+            failed_uniprot_ids.append(uniprot_id)
+
+    # report all missing ids before generating any AF3 inputs; preys without a sequence are skipped
+    if failed_uniprot_ids:
+        missing_ids_file = output_folder + "_missing_uniprot_ids.txt"
+        with open(missing_ids_file, "w") as f:
+            f.write("\n".join(failed_uniprot_ids) + "\n")
+        print(f"Failed to download {len(failed_uniprot_ids)} UniProt FASTA files (listed in {missing_ids_file}): {', '.join(failed_uniprot_ids)}")
+        failed_bait_ids = [uniprot_id for uniprot_id in bait_uniprot_ids if uniprot_id in failed_uniprot_ids]
+        if failed_bait_ids:
+            raise RuntimeError(f"Could not download the bait FASTA files {failed_bait_ids}")
+        prey_uniprot_ids = [uniprot_id for uniprot_id in prey_uniprot_ids if uniprot_id not in failed_uniprot_ids]
+
     # input bait protein file were uniprot ids, so set bait_sequences to the fetched uniprot sequences
     if len(bait_sequences) == 0:
         for bait_uniprot_id in bait_uniprot_ids:
@@ -54,22 +75,28 @@ def process_folder(input_fasta, output_folder):
     assert template_json["sequences"][0]["protein"]["id"] == "PREY", "Template file should have PREY as the first sequence id"
     assert template_json["sequences"][1]["protein"]["id"] == "BAIT", "Template file should have BAIT as the second sequence id"
 
-    # create combined input json files for alphafold3
-    for prey_protein, prey_content in prey_sequences:
-        for bait_protein, bait_content in bait_sequences:
-            total_seq_length = -1
-            af3_input_json = f"{output_folder}/{prey_protein}_{bait_protein}_input.json"
-            with open(af3_input_json, "w") as af3_input_json_file:
-                af3_input_json_content = template_json.copy()
+    # create combined input json files for alphafold3, only for the jobs within the length limit
+    def iter_jobs():
+        for prey_protein, prey_content in prey_sequences:
+            for bait_protein, bait_content in bait_sequences:
+                af3_input_json_content = copy.deepcopy(template_json)
                 af3_input_json_content["name"] = f"{prey_protein}_{bait_protein}"
-                af3_input_json_content["sequences"][0]["protein"]["sequence"] = prey_content.strip()
-                af3_input_json_content["sequences"][1]["protein"]["sequence"] = bait_content.strip()
-                af3_input_json_file.write(json.dumps(af3_input_json_content, indent=4))
-
-            total_seq_length = len(prey_content) + len(bait_content)
-            if total_seq_length > MAX_COMBINED_SEQ_LENGTH:
-                print(f"Skipping {prey_protein}_{bait_protein} due to length {total_seq_length}")
-                continue
+                # sequences read from downloaded FASTA files still contain their line breaks
+                af3_input_json_content["sequences"][0]["protein"]["sequence"] = "".join(prey_content.split())
+                af3_input_json_content["sequences"][1]["protein"]["sequence"] = "".join(bait_content.split())
+
+                total_seq_length = get_token_count(af3_input_json_content)
+                if total_seq_length > MAX_COMBINED_SEQ_LENGTH:
+                    print(f"Skipping {prey_protein}_{bait_protein} due to length {total_seq_length}")
+                    continue
+                yield f"{prey_protein}_{bait_protein}_input.json", af3_input_json_content, {}
+
+    write_af3_inputs(output_folder, iter_jobs())
+
+    # with several GPUs, the jobs are split into one input shard and container per GPU
+    if GPU_COUNT > 1:
+        schedule_folder(output_folder, bash_script_file, GPU_COUNT)
+        return
 
     # create a bash script that runs all the alphafold3 jobs
     with open(bash_script_file, "w") as f:
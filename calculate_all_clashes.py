@@ -1,13 +1,27 @@
-# install chimerax for calculating clashes if needed
+# install chimerax for calculating clashes if needed (only required for the "chimerax" and "chimerax_batch" clashes backends)
 import os
+import pandas as pd
 from multiprocessing import Pool
-from calculate_clashes import calculate_clashes
+from calculate_clashes import calculate_clashes, calculate_clashes_chimerax_batch, MIN_PREY_PLDDT
+from chimerax_helper import split_batches
 from files_helper import get_model_files
+from perf_helper import measure, write_perf_report
+from results_store import write_stage, get_superfolder
+from result_cache import load_result_cache, get_cached_results, update_result_cache, merge_cached_results, get_fingerprint
 from constants import CURRENT_PIPELINE
 assert CURRENT_PIPELINE == "pulldown", "This script is only for the pulldown pipeline"
-from constants import FOLDERS, PLDDT_SLIDING_WINDOW, PROCESS_COUNT, CLASHES_MODEL, CONFIG_FILE
+from constants import FOLDERS, PLDDT_SLIDING_WINDOW, ALL_PLDDT_WINDOWS, PROCESS_COUNT, CLASHES_MODEL, CLASHES_BACKEND, CHIMERAX_BATCH_SIZE, VIRTUAL_PLDDT_WINDOWS, CONFIG_FILE, USE_RESULTS_STORE
 
 OUTPUT_FOLDER = "output_all_clashes/"
+CLASHES_COLUMNS = ["model", "input clashes", "reference clashes", "both clashes", "between clashes"]
+# with virtual sliding windows, the model files are the original models and the smoothed pLDDT is applied in memory
+PLDDT_WINDOW = PLDDT_SLIDING_WINDOW if VIRTUAL_PLDDT_WINDOWS else None
+
+
+def get_cache_params():
+    # the results depend on the clashes model, the sliding window and the backend
+    return {"clashes_model": CLASHES_MODEL, "clashes_model_fingerprint": get_fingerprint(CLASHES_MODEL), "plddt_sliding_window": PLDDT_SLIDING_WINDOW, "virtual_plddt_windows": VIRTUAL_PLDDT_WINDOWS, "backend": CLASHES_BACKEND, "min_prey_plddt": MIN_PREY_PLDDT}
+
 
 def process_folder(folder_name):
     csv_file = OUTPUT_FOLDER + folder_name + f"_clashes_plddt_window_{PLDDT_SLIDING_WINDOW}.csv"
@@ -15,17 +29,36 @@ def process_folder(folder_name):
     print(f"Processing {folder_name}", flush=True)
 
     with open(csv_file, "w") as f:
-        f.write("model,input clashes,reference clashes,both clashes,between clashes\n")
+        f.write(",".join(CLASHES_COLUMNS) + "\n")
+
+    model_files = get_model_files(folder_name, residue_sliding_window=PLDDT_SLIDING_WINDOW, all_sliding_windows=ALL_PLDDT_WINDOWS)
+    plddt_window = PLDDT_WINDOW
 
-    model_files = get_model_files(folder_name, residue_sliding_window=PLDDT_SLIDING_WINDOW)
+    # only process models that are new or changed since the last run
+    cache = load_result_cache("clashes", folder_name, get_cache_params())
+    cached_results, missing_model_files = get_cached_results(cache, model_files)
 
-    with Pool(processes=PROCESS_COUNT) as pool:
-        results = pool.starmap(calculate_clashes, zip(model_files, [CLASHES_MODEL] * len(model_files)))
+    with measure("clashes", folder_name, level="stage"), Pool(processes=PROCESS_COUNT) as pool:
+        if CLASHES_BACKEND == "chimerax_batch":
+            # one ChimeraX session per batch of models instead of one per model
+            batches = split_batches(missing_model_files, CHIMERAX_BATCH_SIZE)
+            new_results = pool.starmap(calculate_clashes_chimerax_batch, zip(batches, [CLASHES_MODEL] * len(batches), [plddt_window] * len(batches)))
+            new_results = [item for sublist in new_results for item in sublist]  # flatten the list of lists
+        else:
+            new_results = pool.starmap(calculate_clashes, zip(missing_model_files, [CLASHES_MODEL] * len(missing_model_files), [CLASHES_BACKEND] * len(missing_model_files), [plddt_window] * len(missing_model_files)))
+
+    # failed calculations (-1 values) are not cached so they are retried on the next run
+    update_result_cache(cache, missing_model_files, new_results, is_valid=lambda result: -1 not in result)
+    results = merge_cached_results(model_files, cached_results, missing_model_files, new_results)
 
     with open(csv_file, "a") as f:
         for model_file, (input_only_clashes, reference_only_clashes, both_clashes, between_clashes) in zip(model_files, results):
             f.write(f"{model_file},{input_only_clashes},{reference_only_clashes},{both_clashes},{between_clashes}\n")
 
+    if USE_RESULTS_STORE:
+        clashes_df = pd.DataFrame([[model_file, *result] for model_file, result in zip(model_files, results)], columns=CLASHES_COLUMNS)
+        write_stage("clashes", clashes_df, get_superfolder(folder_name), folder_name, PLDDT_SLIDING_WINDOW)
+
     print(f"Done processing {folder_name}", flush=True)
 
 
@@ -38,3 +71,5 @@ if __name__ == "__main__":
 
     for folder in FOLDERS:
         process_folder(folder)
+
+    write_perf_report()
@@ -1,21 +1,61 @@
-# install chimerax for calculating clashes if needed
+# install chimerax for calculating clashes if needed (only required for the "chimerax" and "chimerax_batch" backends)
 
 import os
-import subprocess
 import re
 import argparse
+import numpy as np
+from Bio.Align import PairwiseAligner, substitution_matrices
+from Bio.Data.PDBData import protein_letters_3to1_extended
+from structure_helper import load_atoms, select_atoms, count_overlaps_within, count_overlaps_between, file_fingerprint
+from chimerax_helper import run_chimerax_batch
+from perf_helper import instrumented, run_subprocess
+from modify_mmcif_plddt import get_plddt_sliding_window_mmcif
+from plddt_store import get_atom_plddts
+
+CLASHES_BACKENDS = ["native", "chimerax", "chimerax_batch"]
+MIN_PREY_PLDDT = 40
+
+# ChimeraX `matchmaker` default parameters
+MATCH_GAP_OPEN = -12
+MATCH_GAP_EXTEND = -1
+MATCH_CUTOFF_DISTANCE = 2.0
+MATCH_MAX_PRUNE_FRACTION = 0.1
+MATCH_MIN_PAIRS = 3
+
+# parsed reference structures (and their intra-model clash counts), cached per process since the reference is the same for every model
+_reference_cache = {}
+
+
+def calculate_clashes(input_file, reference_file, backend="native", residue_sliding_window=None):
+    """
+    Calculate protein structure clashes between input and reference files.
+    Returns a tuple (input only clashes, reference only clashes, both clashes, between clashes).
+    If `residue_sliding_window` is given, the PREY pLDDT mask uses the smoothed pLDDT of that window from the sidecar store (see `plddt_store.py`)
+    instead of the B-factors of the input file.
+    """
+    if backend == "native":
+        return calculate_clashes_native(input_file, reference_file, residue_sliding_window)
+    elif backend == "chimerax":
+        return calculate_clashes_chimerax(input_file, reference_file, residue_sliding_window)
+    elif backend == "chimerax_batch":
+        return calculate_clashes_chimerax_batch([input_file], reference_file, residue_sliding_window)[0]
+
+    raise ValueError(f"Unknown clashes backend {backend}, expected one of {CLASHES_BACKENDS}")
 
 
-def calculate_clashes(input_file, reference_file):
+@instrumented("clashes")
+def calculate_clashes_chimerax(input_file, reference_file, residue_sliding_window=None):
     """
     Calculate protein structure clashes between input and reference files using ChimeraX.
     Returns the number of unique clashes between the structures.
     """
+    # ChimeraX reads the pLDDT from the B-factors, so the smoothed pLDDT has to be written to a model file
+    chimerax_input_file = input_file if residue_sliding_window is None else get_plddt_sliding_window_mmcif(input_file, residue_sliding_window)
     clash_script_file = os.path.basename(input_file) + "_clash_script.temp.cxc"
 
     clash_script = f"""
-open ./{input_file}
-delete #1/PREY @@bfactor<40
+open ./{chimerax_input_file}
+delete #1/PREY @@bfactor<{MIN_PREY_PLDDT}
 clashes ignoreHiddenModels true
 open ./{reference_file}
 match #1 to #2
@@ -32,7 +72,7 @@ exit
         f.write(clash_script)
 
     command = "chimerax --nogui " + clash_script_file
-    process = subprocess.run(command, shell=True, capture_output=True)
+    process = run_subprocess(command, shell=True, capture_output=True)
 
     # print(process.stdout.decode().strip())
     matches = re.findall(r"STATUS:\n([0-9]+ clashes\n|No clashes)", process.stdout.decode().strip())
@@ -52,15 +92,155 @@ exit
     return (input_only_clashes, reference_only_clashes, both_clashes, between_clashes)
 
 
+@instrumented("clashes")
+def calculate_clashes_chimerax_batch(input_files, reference_file, residue_sliding_window=None):
+    """
+    Calculate protein structure clashes for a batch of input files against the reference file in one ChimeraX session (see `chimerax_helper.py`).
+    Returns a list of clash tuples in the order of `input_files`.
+    """
+    # ChimeraX reads the pLDDT from the B-factors, so the smoothed pLDDT has to be written to a model file
+    chimerax_input_files = input_files if residue_sliding_window is None else [get_plddt_sliding_window_mmcif(input_file, residue_sliding_window) for input_file in input_files]
+
+    results = []
+    for input_file, result in zip(input_files, run_chimerax_batch("clashes", chimerax_input_files, reference=os.path.abspath(reference_file), min_plddt=MIN_PREY_PLDDT)):
+        if "error" in result:
+            print(f"ERROR: Clash calculation failed for {input_file} and {reference_file}: {result['error']}")
+            results.append((-1, -1, -1, -1))
+            continue
+
+        input_only_clashes = result["result"]["input_only_clashes"]
+        reference_only_clashes = result["result"]["reference_only_clashes"]
+        both_clashes = result["result"]["both_clashes"]
+
+        between_clashes = both_clashes - input_only_clashes - reference_only_clashes
+        print(f"Clashes between {input_file} and {reference_file}: {between_clashes}", flush=True)
+        results.append((input_only_clashes, reference_only_clashes, both_clashes, between_clashes))
+
+    return results
+
+
+@instrumented("clashes")
+def calculate_clashes_native(input_file, reference_file, residue_sliding_window=None):
+    """
+    Calculate protein structure clashes between input and reference files in-process, following the same steps as the ChimeraX script:
+    drop PREY atoms with pLDDT (B-factor) < 40, count clashes within the input, superpose the input onto the reference (matchmaker-style),
+    remove BAIT, count clashes of the remaining PREY + reference, and count clashes within the reference.
+    """
+    try:
+        input_atoms = load_atoms(input_file)
+        reference_atoms, reference_only_clashes = _get_reference(reference_file)
+
+        atom_plddts = get_atom_plddts(input_atoms, input_file, residue_sliding_window)
+        input_atoms = select_atoms(input_atoms, ~((input_atoms["chain"] == "PREY") & (atom_plddts < MIN_PREY_PLDDT)))
+        input_only_clashes = count_overlaps_within(input_atoms)
+
+        rotation, translation = match_structures(input_atoms, reference_atoms)
+        prey_atoms = select_atoms(input_atoms, input_atoms["chain"] != "BAIT")
+        prey_atoms["coords"] = prey_atoms["coords"] @ rotation.T + translation
+        # "both" includes clashes within the PREY, within the reference and between the two, as in ChimeraX
+        both_clashes = count_overlaps_within(prey_atoms) + reference_only_clashes + count_overlaps_between(prey_atoms, reference_atoms)
+    except Exception as e:
+        print(f"ERROR: Clash calculation failed for {input_file} and {reference_file}: {e}")
+        return (-1, -1, -1, -1)
+
+    between_clashes = both_clashes - input_only_clashes - reference_only_clashes
+    print(f"Clashes between {input_file} and {reference_file}: {between_clashes}", flush=True)
+
+    return (input_only_clashes, reference_only_clashes, both_clashes, between_clashes)
+
+
+def _get_reference(reference_file):
+    key = file_fingerprint(reference_file)
+    if key not in _reference_cache:
+        reference_atoms = load_atoms(reference_file)
+        _reference_cache[key] = (reference_atoms, count_overlaps_within(reference_atoms))
+    return _reference_cache[key]
+
+
+def _get_chain_ca(atoms, chain):
+    """
+    Get the one-letter sequence and CA coordinates of a chain.
+    """
+    ca_mask = (atoms["chain"] == chain) & (atoms["atom_name"] == "CA")
+    sequence = "".join(protein_letters_3to1_extended.get(res_name, "X") for res_name in atoms["res_name"][ca_mask])
+    return sequence, atoms["coords"][ca_mask]
+
+
+def superpose(mobile_coords, reference_coords):
+    """
+    Least-squares (Kabsch) superposition of paired coordinates. Returns (rotation, translation) mapping mobile onto reference.
+    """
+    mobile_center = mobile_coords.mean(axis=0)
+    reference_center = reference_coords.mean(axis=0)
+    u, _, vt = np.linalg.svd((mobile_coords - mobile_center).T @ (reference_coords - reference_center))
+    d = np.sign(np.linalg.det(vt.T @ u.T))
+    rotation = vt.T @ np.diag([1.0, 1.0, d]) @ u.T
+    return rotation, reference_center - mobile_center @ rotation.T
+
+
+def match_structures(mobile_atoms, reference_atoms):
+    """
+    Superpose one structure onto another like ChimeraX `matchmaker`: align the sequences of the best-scoring chain pair (Needleman-Wunsch, BLOSUM-62),
+    then iteratively superpose the paired CA atoms, pruning pairs farther apart than 2.0 A (at most 10% per iteration).
+    Returns (rotation, translation) mapping mobile coordinates onto the reference.
+    """
+    aligner = PairwiseAligner()
+    aligner.mode = "global"
+    aligner.substitution_matrix = substitution_matrices.load("BLOSUM62")
+    aligner.open_gap_score = MATCH_GAP_OPEN
+    aligner.extend_gap_score = MATCH_GAP_EXTEND
+
+    best = None
+    for mobile_chain in np.unique(mobile_atoms["chain"]):
+        mobile_sequence, mobile_ca = _get_chain_ca(mobile_atoms, mobile_chain)
+        for reference_chain in np.unique(reference_atoms["chain"]):
+            reference_sequence, reference_ca = _get_chain_ca(reference_atoms, reference_chain)
+            if not mobile_sequence or not reference_sequence:
+                continue
+            alignment = aligner.align(mobile_sequence, reference_sequence)[0]
+            if best is None or alignment.score > best[0]:
+                best = (alignment.score, alignment, mobile_ca, reference_ca)
+
+    if best is None:
+        raise ValueError("No chains with CA atoms to match")
+
+    _, alignment, mobile_ca, reference_ca = best
+    mobile_indices, reference_indices = [], []
+    for (mobile_start, mobile_end), (reference_start, reference_end) in zip(*alignment.aligned):
+        mobile_indices.extend(range(mobile_start, mobile_end))
+        reference_indices.extend(range(reference_start, reference_end))
+    mobile_ca, reference_ca = mobile_ca[mobile_indices], reference_ca[reference_indices]
+
+    while True:
+        rotation, translation = superpose(mobile_ca, reference_ca)
+        distances = np.linalg.norm(mobile_ca @ rotation.T + translation - reference_ca, axis=1)
+        far = distances > MATCH_CUTOFF_DISTANCE
+        if not far.any():
+            break
+        n_prune = min(int(far.sum()), max(1, int(len(distances) * MATCH_MAX_PRUNE_FRACTION)))
+        keep = np.argsort(distances)[: len(distances) - n_prune]
+        if len(keep) < MATCH_MIN_PAIRS:
+            break
+        mobile_ca, reference_ca = mobile_ca[keep], reference_ca[keep]
+
+    return rotation, translation
+
+
 def main():
-    parser = argparse.ArgumentParser(description="Calculate protein structure clashes using ChimeraX")
+    parser = argparse.ArgumentParser(description="Calculate protein structure clashes natively or using ChimeraX")
     parser.add_argument("input", help="Input model file")
     parser.add_argument("reference", help="Reference model file")
+    parser.add_argument("--backend", choices=CLASHES_BACKENDS + ["compare"], default="native", help="Clash engine to use; 'compare' runs every backend and prints the results side by side")
 
     args = parser.parse_args()
 
     print("Calculating clashes...")
-    _, _, _, clash_count = calculate_clashes(args.input, args.reference)
+    if args.backend == "compare":
+        for backend in CLASHES_BACKENDS:
+            input_only_clashes, reference_only_clashes, both_clashes, clash_count = calculate_clashes(args.input, args.reference, backend=backend)
+            print(f"[{backend}] input: {input_only_clashes}, reference: {reference_only_clashes}, both: {both_clashes}, between: {clash_count}")
+    else:
+        _, _, _, clash_count = calculate_clashes(args.input, args.reference, backend=args.backend)
     print(f"Clashes between {args.input} and {args.reference}: {clash_count}")
 
     return args.input, args.reference, clash_count
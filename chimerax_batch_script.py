@@ -0,0 +1,90 @@
+"""
+Script executed *inside* ChimeraX (not with the regular Python interpreter) by `chimerax_helper.py`:
+    chimerax --nogui --exit --script "chimerax_batch_script.py <job json file>"
+
+Runs the clashes or binding domain ChimeraX commands for a whole batch of models in one ChimeraX session, closing the models between each one.
+Results are written as one JSON line per model to the job's output file (flushed after every model), so a failing or crashing model
+does not lose the results of the rest of the batch.
+"""
+
+import re
+import sys
+import json
+from chimerax.core.commands import run
+from chimerax.core.logger import StringPlainTextLog
+
+
+def count_pairs(result):
+    # the clashes/contacts commands return a dictionary mapping each atom to the atoms it clashes with (each pair appears twice)
+    if not result:
+        return 0
+    return sum(len(others) for others in result.values()) // 2
+
+
+def get_model_atoms(session):
+    return session.models.list()[0].atoms
+
+
+def run_clashes(session, model_file, job):
+    run(session, f'open "{model_file}"', log=False)
+    run(session, f"delete #1/PREY @@bfactor<{job['min_plddt']}", log=False)
+    input_only_clashes = count_pairs(run(session, "clashes ignoreHiddenModels true", log=False))
+    run(session, f'open "{job["reference"]}"', log=False)
+    run(session, "match #1 to #2", log=False)
+    run(session, "select #1/BAIT", log=False)
+    run(session, "delete atoms sel", log=False)
+    run(session, "delete bonds sel", log=False)
+    both_clashes = count_pairs(run(session, "clashes ignoreHiddenModels true", log=False))
+    run(session, "hide #1 models", log=False)
+    reference_only_clashes = count_pairs(run(session, "clashes ignoreHiddenModels true", log=False))
+
+    return {"input_only_clashes": input_only_clashes, "reference_only_clashes": reference_only_clashes, "both_clashes": both_clashes}
+
+
+def run_binding_domain(session, model_file, job):
+    run(session, f'open "{model_file}"', log=False)
+    run(session, f"delete #1/PREY @@bfactor<{job['min_plddt']}", log=False)
+    atoms = get_model_atoms(session)
+    prey_atom_count = int((atoms.chain_ids == "PREY").sum())
+    if prey_atom_count == 0:
+        return {"prey_atom_count": 0, "contacts": [], "buriedareas": []}
+
+    run(session, "sel #1/PREY", log=False)
+    contacts = [count_pairs(run(session, "contacts sel restrict both", log=False))]
+    run(session, "~sel", log=False)
+
+    buriedareas = []
+    for start, end in job["domains"]:
+        # parse the area from this command's own log message so the value is formatted exactly as in the ChimeraX log
+        with StringPlainTextLog(session.logger) as log:
+            run(session, f"measure buriedarea /PREY withAtoms2 /BAIT:{start}-{end}")
+        buriedareas.append(float(re.findall(r"= ([\d\.\-e]+)", log.getvalue())[-1]))
+        run(session, f"sel #1/BAIT:{start}-{end}", log=False)
+        contacts.append(count_pairs(run(session, "contacts sel restrict both", log=False)))
+        run(session, "sel add #1/PREY", log=False)
+        contacts.append(count_pairs(run(session, "contacts sel restrict both", log=False)))
+        run(session, "~sel", log=False)
+
+    return {"prey_atom_count": prey_atom_count, "contacts": contacts, "buriedareas": buriedareas}
+
+
+TASKS = {"clashes": run_clashes, "binding_domain": run_binding_domain}
+
+
+def main(session, job_file):
+    with open(job_file) as f:
+        job = json.load(f)
+
+    task = TASKS[job["task"]]
+    with open(job["output"], "a") as output:
+        for key, model_file in job["models"]:
+            try:
+                run(session, "close session", log=False)
+                line = {"model": key, "result": task(session, model_file, job)}
+            except Exception as e:
+                line = {"model": key, "error": f"{type(e).__name__}: {e}"}
+            output.write(json.dumps(line) + "\n")
+            output.flush()
+
+
+main(session, sys.argv[1])  # noqa: F821 (`session` is provided by ChimeraX)
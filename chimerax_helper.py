@@ -0,0 +1,77 @@
+"""
+Helpers for running ChimeraX over batches of models in a single ChimeraX process (the "chimerax_batch" backends),
+instead of paying the ChimeraX startup cost for every model.
+"""
+
+import os
+import json
+import shutil
+import tempfile
+from perf_helper import run_subprocess
+
+CHIMERAX_BATCH_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "chimerax_batch_script.py")
+
+
+def split_batches(items, batch_size):
+    return [items[i : i + batch_size] for i in range(0, len(items), batch_size)]
+
+
+def run_chimerax_batch(task, model_files, **job_params):
+    """
+    Run `chimerax_batch_script.py` for the given task ("clashes" or "binding_domain") over a batch of models in one ChimeraX session.
+    Returns a list (in the order of `model_files`) of {"model": ..., "result": {...}} or {"model": ..., "error": "..."} dictionaries.
+
+    If ChimeraX itself crashes, the results written so far are kept, the model it crashed on is marked as failed and ChimeraX is restarted
+    on the rest of the batch, so one bad model does not poison its batch.
+    """
+    temp_folder = tempfile.mkdtemp(prefix="chimerax_batch_")
+    results = {}
+    remaining = list(model_files)
+    batches_without_progress = 0
+
+    try:
+        while remaining:
+            job_file = os.path.join(temp_folder, "job.json")
+            output_file = os.path.join(temp_folder, "results.jsonl")
+            if os.path.exists(output_file):
+                os.remove(output_file)
+            with open(job_file, "w") as f:
+                json.dump({"task": task, "models": [[model_file, os.path.abspath(model_file)] for model_file in remaining], "output": output_file, **job_params}, f)
+
+            try:
+                process = run_subprocess(["chimerax", "--nogui", "--exit", "--script", f"{CHIMERAX_BATCH_SCRIPT} {job_file}"], capture_output=True)
+            except OSError as e:
+                for model_file in remaining:
+                    results[model_file] = {"model": model_file, "error": f"Could not run ChimeraX: {e}"}
+                break
+
+            finished = 0
+            if os.path.exists(output_file):
+                with open(output_file) as f:
+                    for line in f:
+                        try:
+                            result = json.loads(line)
+                        except json.JSONDecodeError:
+                            break  # partially written line from a crash
+                        results[result["model"]] = result
+                        finished += 1
+
+            remaining = [model_file for model_file in remaining if model_file not in results]
+            if not remaining:
+                break
+
+            # ChimeraX stopped before finishing the batch: the first remaining model is the one it crashed on
+            error = f"ChimeraX exited with code {process.returncode}: {process.stderr.decode().strip()[-1000:]}"
+            results[remaining[0]] = {"model": remaining[0], "error": error}
+            remaining = remaining[1:]
+
+            # ChimeraX is most likely not working at all (e.g. not installed), so do not restart it for every model
+            batches_without_progress = batches_without_progress + 1 if finished == 0 else 0
+            if batches_without_progress >= 2:
+                for model_file in remaining:
+                    results[model_file] = {"model": model_file, "error": error}
+                remaining = []
+    finally:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+
+    return [results[model_file] for model_file in model_files]
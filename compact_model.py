@@ -0,0 +1,264 @@
+"""
+Compact binary encoding of AF3 samples, used by `model_retention.py` for the samples outside the top K of a prediction.
+
+A `*_model.cif` file is re-encoded as a `*_model.npz` file holding every column of its `_atom_site` loop: the coordinates as int32 thousandths of an
+Angstrom and the B-factors (pLDDT) as uint16 hundredths (the precision AF3 writes them with, so the encoding is lossless), integer columns as int32
+and the other columns as a vocabulary and one uint8/uint16 code per atom, plus the text before and after the loop. `mmcif_helper.read_atom_site` and
+`write_atom_site_bfactors` read and rewrite these files like mmCIF files, and `decode_model` writes them back as mmCIF (e.g. to open them in ChimeraX).
+
+A `*_confidences.json` file is re-encoded as a `*_confidences.npz` file: `pae` as uint8 eighths of an Angstrom (capped at 31.875, AF3 caps the PAE at 31.75),
+`contact_probs` as uint8 hundredths, `atom_plddts` as uint16 hundredths, and the other arrays (chain ids, residue ids) as in the model files.
+`confidences_helper.read_atom_plddts` reads these files like the JSON files.
+
+Both are compressed NumPy archives (`np.savez_compressed`). Integer vectors (coordinates, atom and residue numbers) are stored as differences between
+consecutive values, which compress to a few bits per atom, so the files are about ten times smaller than the text files and are read without parsing.
+"""
+
+import os
+import json
+import argparse
+import numpy as np
+from mmcif_helper import _find_atom_site_loop, _tokenize, COMPACT_MODEL_EXTENSION
+from screen_archive import open_screen_file
+
+COMPACT_MODEL_SUFFIX = "_model" + COMPACT_MODEL_EXTENSION
+COMPACT_CONFIDENCES_SUFFIX = "_confidences.npz"
+COMPACT_VERSION = 1
+
+# _atom_site columns stored as fixed point integers: column -> (scale, dtype)
+QUANTIZED_ATOM_SITE_COLUMNS = {"Cartn_x": (1000, np.int32), "Cartn_y": (1000, np.int32), "Cartn_z": (1000, np.int32), "B_iso_or_equiv": (100, np.uint16)}
+# confidences arrays stored as fixed point integers: key -> (scale, dtype, maximum value)
+QUANTIZED_CONFIDENCES = {"pae": (8, np.uint8, 31.875), "contact_probs": (100, np.uint8, 1.0), "atom_plddts": (100, np.uint16, 100.0)}
+
+
+def get_compact_file(input_file):
+    """
+    Path of the compact version of a model or confidences file: `*_model.cif` -> `*_model.npz`, `*_confidences.json` -> `*_confidences.npz`.
+    """
+
+    if input_file.endswith("_model.cif") or (input_file.endswith("_confidences.json") and not input_file.endswith("summary_confidences.json")):
+        return os.path.splitext(input_file)[0] + ".npz"
+    raise ValueError(f"{input_file} is not a model or confidences file")
+
+
+def is_compact_file(path):
+    return path.endswith(COMPACT_MODEL_SUFFIX) or path.endswith(COMPACT_CONFIDENCES_SUFFIX)
+
+
+def _is_integer_column(values):
+    # integers without leading zeros or signs, so the text is restored exactly
+    if len(values) == 0 or not np.all(np.char.isdigit(values)):
+        return False
+    return bool(np.all((np.char.str_len(values) == 1) | (np.char.find(values, "0") != 0))) and max(np.char.str_len(values)) < 10
+
+
+def _encode_integers(arrays, name, values):
+    values = np.asarray(values, dtype=np.int32)
+    if values.ndim == 1:
+        arrays[f"{name}.deltas"] = np.diff(values, prepend=np.int32(0)).astype(np.int32)
+    else:
+        arrays[name] = values
+
+
+def _encode_array(arrays, name, values):
+    values = np.asarray(values)
+    if values.dtype.kind in "iub" or (values.dtype.kind == "U" and _is_integer_column(values)):
+        _encode_integers(arrays, name, values.astype(np.int64))
+    elif values.dtype.kind == "f":
+        arrays[name] = values.astype(np.float32)
+    else:
+        vocabulary, codes = np.unique(values.astype(str), return_inverse=True)
+        arrays[f"{name}.vocabulary"] = vocabulary
+        arrays[name] = codes.astype(np.uint8 if len(vocabulary) <= 256 else np.uint16 if len(vocabulary) <= 65536 else np.uint32)
+
+
+def _decode_array(arrays, name):
+    if f"{name}.vocabulary" in arrays:
+        return arrays[f"{name}.vocabulary"][arrays[name]]
+    if f"{name}.deltas" in arrays:
+        return np.cumsum(arrays[f"{name}.deltas"], dtype=np.int32)
+    return arrays[name]
+
+
+def _quantize(values, scale, dtype, maximum=None):
+    values = np.asarray(values, dtype=np.float64)
+    if maximum is not None:
+        values = np.clip(values, 0, maximum)
+    return np.round(values * scale).astype(dtype)
+
+
+def _load_arrays(compact_file):
+    with open_screen_file(compact_file, "rb") as f:
+        with np.load(f, allow_pickle=False) as npz:
+            arrays = dict(npz)
+    if int(arrays.pop("version", -1)) != COMPACT_VERSION:
+        raise ValueError(f"Unsupported compact file version in {compact_file}")
+    return arrays
+
+
+def _save_arrays(output_file, arrays):
+    # written to a temporary file first, so an interrupted encoding never leaves a truncated file behind
+    temp_file = f"{output_file}.{os.getpid()}.tmp"
+    with open(temp_file, "wb") as f:
+        np.savez_compressed(f, version=np.array(COMPACT_VERSION), **arrays)
+    os.replace(temp_file, output_file)
+
+
+def encode_model(model_file, output_file=None):
+    """
+    Re-encode a mmCIF model file as a compact `*_model.npz` file. Returns the path of the compact file.
+    """
+
+    output_file = output_file or get_compact_file(model_file)
+    with open_screen_file(model_file) as f:
+        lines = f.read().splitlines()
+
+    columns, start, end = _find_atom_site_loop(lines)
+    rows = [_tokenize(line) for line in lines[start:end]]
+    if any(len(row) != len(columns) for row in rows):
+        raise ValueError(f"Expected one {len(columns)} column _atom_site row per line in {model_file}")
+    table = np.array(rows, dtype=str).reshape(-1, len(columns))
+
+    arrays = {"columns": np.array(columns), "prefix": np.array("\n".join(lines[:start])), "suffix": np.array("\n".join(lines[end:]))}
+    for i, column in enumerate(columns):
+        if column in QUANTIZED_ATOM_SITE_COLUMNS:
+            scale, dtype = QUANTIZED_ATOM_SITE_COLUMNS[column]
+            values = _quantize(table[:, i].astype(np.float64), scale, dtype)
+            if column == "B_iso_or_equiv":
+                arrays[f"atom_site.{column}"] = values
+            else:
+                _encode_integers(arrays, f"atom_site.{column}", values)
+        else:
+            _encode_array(arrays, f"atom_site.{column}", table[:, i])
+
+    _save_arrays(output_file, arrays)
+    return output_file
+
+
+def read_compact_atom_site_columns(compact_file):
+    """
+    The `_atom_site` columns of a compact model file, as a dictionary of column name -> NumPy array (numeric for the coordinates, B-factors and integer columns).
+    """
+
+    arrays = _load_arrays(compact_file)
+    columns = {}
+    for column in arrays["columns"]:
+        if column in QUANTIZED_ATOM_SITE_COLUMNS:
+            columns[column] = _decode_array(arrays, f"atom_site.{column}") / QUANTIZED_ATOM_SITE_COLUMNS[column][0]
+        else:
+            columns[column] = _decode_array(arrays, f"atom_site.{column}")
+    return columns
+
+
+def write_compact_bfactors(input_file, output_file, bfactors, rows=None):
+    """
+    Copy a compact model file, replacing the B-factors of the `_atom_site` rows `rows` (default: all rows) with `bfactors`.
+    """
+
+    arrays = _load_arrays(input_file)
+    column = "atom_site.B_iso_or_equiv"
+    arrays[column] = arrays[column].copy()
+    scale, dtype = QUANTIZED_ATOM_SITE_COLUMNS["B_iso_or_equiv"]
+    arrays[column][slice(None) if rows is None else rows] = _quantize(bfactors, scale, dtype)
+    _save_arrays(output_file, arrays)
+
+
+def _format_value(value):
+    # quoting of mmCIF values, as written by AF3
+    if value == "" or " " in value or value[0] in "_#$'\"[];":
+        return f'"{value}"' if "'" in value else f"'{value}'"
+    return value
+
+
+def decode_model(compact_file, output_file):
+    """
+    Write a compact model file back as a mmCIF file (same values as the original file, with left-aligned columns).
+    """
+
+    arrays = _load_arrays(compact_file)
+    columns = [str(column) for column in arrays["columns"]]
+    formatted = []
+    for column in columns:
+        if column in QUANTIZED_ATOM_SITE_COLUMNS:
+            scale = QUANTIZED_ATOM_SITE_COLUMNS[column][0]
+            digits = len(str(scale)) - 1
+            formatted.append(np.char.mod(f"%.{digits}f", _decode_array(arrays, f"atom_site.{column}") / scale))
+        else:
+            formatted.append(np.array([_format_value(str(value)) for value in _decode_array(arrays, f"atom_site.{column}")]))
+
+    widths = [int(max(np.char.str_len(values))) if len(values) else 0 for values in formatted]
+    lines = [" ".join(values[i].ljust(width) for values, width in zip(formatted, widths)).rstrip() for i in range(len(formatted[0]) if formatted else 0)]
+    with open(output_file, "w") as f:
+        f.write("\n".join([str(arrays["prefix"])] + lines + [str(arrays["suffix"])]) + "\n")
+
+
+def encode_confidences(confidences_file, output_file=None):
+    """
+    Re-encode an AF3 `*_confidences.json` file as a compact `*_confidences.npz` file. Returns the path of the compact file.
+    """
+
+    output_file = output_file or get_compact_file(confidences_file)
+    with open_screen_file(confidences_file) as f:
+        confidences = json.load(f)
+
+    arrays = {"keys": np.array(list(confidences.keys()))}
+    for key, values in confidences.items():
+        if key in QUANTIZED_CONFIDENCES:
+            scale, dtype, maximum = QUANTIZED_CONFIDENCES[key]
+            arrays[f"confidences.{key}"] = _quantize(values, scale, dtype, maximum)
+        else:
+            _encode_array(arrays, f"confidences.{key}", values)
+
+    _save_arrays(output_file, arrays)
+    return output_file
+
+
+def read_compact_confidences(compact_file, keys=None):
+    """
+    The arrays of a compact confidences file (all of them, or only `keys`), as a dictionary of key -> NumPy array (floats for the quantized arrays).
+    """
+
+    arrays = _load_arrays(compact_file)
+    confidences = {}
+    for key in arrays["keys"] if keys is None else keys:
+        if key in QUANTIZED_CONFIDENCES:
+            confidences[key] = arrays[f"confidences.{key}"] / QUANTIZED_CONFIDENCES[key][0]
+        else:
+            confidences[key] = _decode_array(arrays, f"confidences.{key}")
+    return confidences
+
+
+def decode_confidences(compact_file, output_file):
+    """
+    Write a compact confidences file back as an AF3 style JSON file (quantized values rounded to their stored precision).
+    """
+
+    confidences = {}
+    for key, values in read_compact_confidences(compact_file).items():
+        if key in QUANTIZED_CONFIDENCES:
+            values = np.round(values, 3)
+        confidences[key] = values.tolist()
+    with open(output_file, "w") as f:
+        f.write(json.dumps(confidences))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Encode AF3 model (.cif) and confidences (.json) files as compact .npz files, or decode compact files back")
+    parser.add_argument("files", nargs="+", help="Files to encode (*_model.cif, *_confidences.json) or decode (*.npz models, *_confidences.npz)")
+    parser.add_argument("--output-folder", help="Folder of the output files (default: next to the input files)")
+    args = parser.parse_args()
+
+    for input_file in args.files:
+        output_folder = args.output_folder or os.path.dirname(input_file)
+        if input_file.endswith(COMPACT_CONFIDENCES_SUFFIX):
+            output_file = os.path.join(output_folder, os.path.basename(input_file)[: -len(".npz")] + ".json")
+            decode_confidences(input_file, output_file)
+        elif input_file.endswith(COMPACT_MODEL_EXTENSION):
+            # compact models and their sliding window copies
+            output_file = os.path.join(output_folder, os.path.basename(input_file)[: -len(".npz")] + ".cif")
+            decode_model(input_file, output_file)
+        elif input_file.endswith("_model.cif"):
+            output_file = encode_model(input_file, os.path.join(output_folder, os.path.basename(get_compact_file(input_file))))
+        else:
+            output_file = encode_confidences(input_file, os.path.join(output_folder, os.path.basename(get_compact_file(input_file))))
+        print(f"{input_file} ({os.path.getsize(input_file) / 2**20:.2f} MB) -> {output_file} ({os.path.getsize(output_file) / 2**20:.2f} MB)", flush=True)
@@ -0,0 +1,183 @@
+"""
+Streaming reader for AF3 `*_confidences.json` files. Besides the per-atom `atom_plddts` and `atom_chain_ids`, these files hold the N x N `pae`
+and `contact_probs` matrices, so `json.load` decodes tens of millions of floats into Python objects just to read the pLDDTs.
+`read_json_keys` reads the file in chunks and only decodes the values of the requested top-level keys, skipping over the others without decoding them,
+and stops reading as soon as all requested keys have been found.
+Compact confidences files (`*_confidences.npz`, see `compact_model.py`) are read directly as arrays.
+"""
+
+import re
+import json
+import numpy as np
+from screen_archive import open_screen_file
+from compact_model import read_compact_confidences, COMPACT_CONFIDENCES_SUFFIX
+
+CHUNK_SIZE = 1 << 20
+# characters that matter when skipping over a JSON value: brackets change the nesting depth, strings may contain brackets
+STRUCTURE_PATTERN = re.compile(r'[\[\]{}"]')
+SCALAR_END_PATTERN = re.compile(r"[,\]}\s]")
+WHITESPACE_PATTERN = re.compile(r"\S")
+
+
+class _ChunkReader:
+    """
+    A text buffer over a file that is filled one chunk at a time. Skipped values are dropped from the buffer, so memory stays bounded by the largest decoded value.
+    """
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+
+    def _read_chunk(self, keep_from):
+        # append the next chunk, dropping the buffer before `keep_from`; returns the number of dropped characters
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            raise ValueError("Unexpected end of JSON file")
+        self.buffer = self.buffer[keep_from:] + chunk
+        return keep_from
+
+    def next_char(self):
+        """
+        Skip whitespace and return the next character (without consuming it).
+        """
+        while True:
+            match = WHITESPACE_PATTERN.search(self.buffer, self.pos)
+            if match:
+                self.pos = match.start()
+                return self.buffer[self.pos]
+            self.pos -= self._read_chunk(self.pos)
+
+    def expect(self, characters):
+        char = self.next_char()
+        if char not in characters:
+            raise ValueError(f"Expected one of {characters!r} in JSON file, found {char!r}")
+        self.pos += 1
+        return char
+
+    def _string_end(self, start):
+        # index after the closing quote of the string starting at `start` (escaped quotes are part of the string)
+        i = start + 1
+        while True:
+            i = self.buffer.find('"', i)
+            if i == -1:
+                i = len(self.buffer)
+                self._read_chunk(0)
+                continue
+            backslashes = 0
+            while self.buffer[i - 1 - backslashes] == "\\":
+                backslashes += 1
+            if backslashes % 2 == 0:
+                return i + 1
+            i += 1
+
+    def read_value(self, keep):
+        """
+        Consume the value at the current position. Returns its raw text if `keep`, otherwise the value is skipped and dropped from the buffer.
+        """
+        char = self.next_char()
+        start = self.pos
+        if not keep:
+            # nothing before the value is needed anymore
+            self.buffer = self.buffer[start:]
+            start = self.pos = 0
+
+        if char == '"':
+            end = self._string_end(start)
+        elif char in "[{":
+            depth = 0
+            i = start
+            while True:
+                match = STRUCTURE_PATTERN.search(self.buffer, i)
+                if match is None:
+                    if keep:
+                        i = len(self.buffer)
+                        self._read_chunk(0)
+                    else:
+                        # skipped values can be dropped as they are read, only the nesting depth is needed
+                        self.buffer = ""
+                        start = i = 0
+                        self._read_chunk(0)
+                    continue
+                i = match.end()
+                if match.group() == '"':
+                    i = self._string_end(match.start())
+                elif match.group() in "[{":
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 0:
+                        break
+            end = i
+        else:
+            while True:
+                match = SCALAR_END_PATTERN.search(self.buffer, start)
+                if match:
+                    end = match.start()
+                    break
+                self._read_chunk(0)
+
+        self.pos = end
+        return self.buffer[start:end] if keep else None
+
+
+def read_json_keys(json_file, keys, array_keys=(), chunk_size=CHUNK_SIZE):
+    """
+    Read only the values of the given top-level `keys` of a JSON object file, without decoding the values of any other key.
+    Values of `array_keys` (flat arrays of numbers) are decoded directly into float64 NumPy arrays, the others with `json.loads`.
+    Raises a KeyError if a key is missing.
+    """
+
+    keys = set(keys) | set(array_keys)
+    values = {}
+    with open_screen_file(json_file) as f:
+        reader = _ChunkReader(f, chunk_size)
+        reader.expect("{")
+        while len(values) < len(keys):
+            if reader.next_char() == "}":
+                break
+            key = json.loads(reader.read_value(keep=True))
+            reader.expect(":")
+            if key not in keys:
+                reader.read_value(keep=False)
+            elif key in array_keys:
+                values[key] = np.fromstring(reader.read_value(keep=True).strip()[1:-1], sep=",")
+            else:
+                values[key] = json.loads(reader.read_value(keep=True))
+            if reader.expect(",}") == "}":
+                break
+
+    missing_keys = keys - values.keys()
+    if missing_keys:
+        raise KeyError(f"Missing keys {sorted(missing_keys)} in {json_file}")
+
+    return values
+
+
+def get_chain_means(chain_ids, values):
+    """
+    Mean of the per-atom `values` of each chain, for any number of chains. Returns a dictionary of chain id -> mean.
+    """
+
+    chains, chain_index = np.unique(np.asarray(chain_ids), return_inverse=True)
+    sums = np.bincount(chain_index, weights=values, minlength=len(chains))
+    counts = np.bincount(chain_index, minlength=len(chains))
+    return {str(chain): float(total / count) for chain, total, count in zip(chains, sums, counts)}
+
+
+def read_atom_plddts(confidences_file):
+    """
+    Read the per-atom pLDDTs and chain ids of an AF3 `*_confidences.json` (or compact `*_confidences.npz`) file. Returns (atom_plddts, atom_chain_ids) as NumPy arrays.
+    """
+
+    if confidences_file.endswith(COMPACT_CONFIDENCES_SUFFIX):
+        confidences = read_compact_confidences(confidences_file, ["atom_plddts", "atom_chain_ids"])
+    else:
+        confidences = read_json_keys(confidences_file, ["atom_chain_ids"], array_keys=["atom_plddts"])
+    atom_plddts = confidences["atom_plddts"]
+    atom_chain_ids = np.asarray(confidences["atom_chain_ids"])
+    if len(atom_chain_ids) != len(atom_plddts):
+        raise ValueError(f"Length of atom_chain_ids ({len(atom_chain_ids)}) does not match length of atom_plddts ({len(atom_plddts)}) in {confidences_file}")
+
+    return atom_plddts, atom_chain_ids
@@ -1,12 +1,14 @@
 # TODO: Migrate all constants from other files to this file.
 # TODO: Migrate hardcoded values to the config file.
+import os
 import yaml
 import multiprocessing
 
 # ======================= HELPER FUNCTIONS =======================
 
 # NOTE: This config file is used for both the pulldown pipeline and the individual complex feature prediction, depending on which script is run.
-CONFIG_FILE = "configs/pulldown/lrrk2_rckw.yaml"
+# It can be overridden with the BULKAF3_CONFIG environment variable (run_pipeline.py sets it for every stage).
+CONFIG_FILE = os.environ.get("BULKAF3_CONFIG", "configs/pulldown/lrrk2_rckw.yaml")
 
 def load_yaml_config(file_path):
     with open(file_path, "r") as file:
@@ -20,6 +22,7 @@ CURRENT_PIPELINE = CONFIG["current_pipeline"]
 
 # Compute-specific constants:
 PROCESS_COUNT = CONFIG.get("process_count", multiprocessing.cpu_count() // 2)
+CHIMERAX_BATCH_SIZE = CONFIG.get("chimerax_batch_size", 50)
 MAX_ID_LENGTH = 40
 
 # Input & AF3 constants:
@@ -27,6 +30,24 @@ DATABASE_FOLDER = "$HOME/public_databases"
 MODEL_WEIGHTS_FOLDER = "$HOME/"
 NUMBER_OF_SEEDS = CONFIG.get("number_of_seeds", 2)
 MAX_COMBINED_SEQ_LENGTH = CONFIG.get("max_combined_seq_length", 10000)
+# Number of GPUs the AF3 jobs are bin-packed onto, with one container and input shard per GPU (see schedule_af3_jobs.py)
+GPU_COUNT = CONFIG.get("gpu_count", 1)
+# Cache of the AF3 data pipeline results (MSAs and templates) by protein sequence, shared by all jobs and screens (see msa_cache.py)
+MSA_CACHE_FOLDER = CONFIG.get("msa_cache_folder", "output_msa_cache/")
+# UniProt REST API used for protein details and FASTA files (see uniprot_cache.py); in offline mode only the local cache is used
+UNIPROT_BASE_URL = CONFIG.get("uniprot_base_url", "https://rest.uniprot.org")
+UNIPROT_OFFLINE = CONFIG.get("uniprot_offline", False)
+UNIPROT_MAX_WORKERS = CONFIG.get("uniprot_max_workers", 8)
+UNIPROT_REQUESTS_PER_SECOND = CONFIG.get("uniprot_requests_per_second", 10)
+# Reuse the results of unchanged predictions/models between runs of the analysis stages (see result_cache.py)
+USE_RESULT_CACHE = CONFIG.get("use_result_cache", True)
+# Also keep the results of the analysis stages in a typed Parquet store, and join them on prediction keys (see results_store.py, requires pyarrow)
+USE_RESULTS_STORE = CONFIG.get("use_results_store", False)
+# Record the wall/CPU time, peak RSS, bytes read and subprocess time of every stage and model, and write a report to output_perf/ (see perf_helper.py)
+PERF_REPORT = CONFIG.get("perf_report", False)
+PERF_PROMETHEUS = CONFIG.get("perf_prometheus", False)
+# Keep smoothed pLDDT sliding windows in a per-screen sidecar store instead of writing `_plddt_window_N.cif` copies of every model
+VIRTUAL_PLDDT_WINDOWS = CONFIG.get("virtual_plddt_windows", False)
 TEMPLATE_FILE = "input_fasta/alphafold3_input_template_complex.json" if CURRENT_PIPELINE == "complex" else "input_fasta/alphafold3_input_template_pulldown.json"
 
 # ================== Pulldown pipeline specific, not used in individual complex feature ==================
@@ -45,6 +66,9 @@ if CURRENT_PIPELINE == "pulldown":
 
     MIN_CONTACTS_THRESHOLDS = CONFIG["min_contacts_thresholds"]
     DOMAINS_TO_RESIDUES = CONFIG["domains_to_residues"]
+    # Also write the one-hot binding domain combination columns (2^D - 1 per contacts threshold) next to the combination bitmasks
+    BINDING_DOMAIN_COMBINATION_COLUMNS = CONFIG.get("binding_domain_combination_columns", False)
+    BINDING_DOMAIN_BACKEND = CONFIG.get("binding_domain_backend", "native")
     # FULL LRRK2
     # DOMAINS_TO_RESIDUES = {
     #     "ARM": [1, 704],
@@ -62,11 +86,18 @@ if CURRENT_PIPELINE == "pulldown":
     # For example, with LRRK2, predictions were run using just the ROC-COR region, but the clashes_model is a pdb file containing the entire RCKW region.
     CLASHES_MODEL = CONFIG.get("clashes_model") 
     MAX_CLASHES_THRESHOLD = CONFIG.get("max_clashes_threshold")
+    CLASHES_BACKEND = CONFIG.get("clashes_backend", "native")
     BINDING_DOMAINS_FILTER = CONFIG.get("binding_domains_filter")
+    # Seconds between two scans of the screen folders for completed predictions in watch mode (see watch_screen.py and screen_archive.py)
+    WATCH_POLL_SECONDS = CONFIG.get("watch_poll_seconds", 60)
+    # Number of samples per prediction (by ranking score) kept as mmCIF/JSON files by model_retention.py, the others are re-encoded as compact .npz files (see compact_model.py)
+    RETAIN_TOP_SAMPLES = CONFIG.get("retain_top_samples", 1)
 
 # ================== Indivdiual complex prediction specific, not used in pulldown pipeline ==================
 if CURRENT_PIPELINE == "complex":
     INPUT_FASTA = CONFIG["input_fasta"]
     OUTPUT_FOLDER = CONFIG["output_folder"]
     FIXED_PROTEINS = CONFIG.get("fixed_proteins")
-    CUSTOM_PREDICTIONS = CONFIG.get("custom_predictions")
\ No newline at end of file
+    CUSTOM_PREDICTIONS = CONFIG.get("custom_predictions")
+    # Maximum number of chains (fixed proteins included) of a generated combination, no limit if not set
+    MAX_CHAINS = CONFIG.get("max_chains")
\ No newline at end of file
@@ -1,9 +1,12 @@
 import re
 import os
-import pandas as pd
-from modify_mmcif_plddt import get_plddt_sliding_window_mmcif
+from modify_mmcif_plddt import get_plddt_sliding_windows_mmcif
+from plddt_store import get_missing_plddt_windows, compute_smoothed_plddts, update_plddt_store, PLDDT_STORE_FILE
+from screen_index import load_screen_index, get_ranked_model_files
+from screen_archive import is_archived_screen
+from perf_helper import instrumented, measure, write_perf_report
 import multiprocessing as mp
-from constants import PROCESS_COUNT, MAX_ID_LENGTH
+from constants import PROCESS_COUNT, MAX_ID_LENGTH, VIRTUAL_PLDDT_WINDOWS
 
 
 N_MODEL = -1  # -1 for all models
@@ -43,44 +46,60 @@ def get_sequences_from_fasta(fasta_file):
     return proteins, sequences
 
 
-def get_model_files(folder, residue_sliding_window, n_model=N_MODEL):
+def get_model_files(folder, residue_sliding_window, n_model=N_MODEL, all_sliding_windows=()):
     """
     Get model files from the given folder. Returned files vary depending on the provided sliding window length for calculating per-residue PLDDT scores.
+    The sliding window files for `all_sliding_windows` are created in the same pass (each model is parsed once), so other windows do not need another pass later.
+    With VIRTUAL_PLDDT_WINDOWS, the original model files are returned and the smoothed pLDDT of every window is added to the screen's sidecar store instead (see `plddt_store.py`).
+    The prediction folders, ranking scores and model files are looked up in the screen index (see `screen_index.py`) instead of listing the folders.
     """
 
-    with mp.Pool(processes=PROCESS_COUNT) as pool:
-        model_folders = [f for f in os.listdir(folder) if os.path.isdir(os.path.join(folder, f))]
-        all_model_files = pool.starmap(process_model_folder, [(model_folder, folder, residue_sliding_window, n_model) for model_folder in model_folders])
+    if is_archived_screen(folder) and not VIRTUAL_PLDDT_WINDOWS:
+        raise ValueError(f"{folder} is archived, the sliding window files cannot be written next to its models: enable virtual_plddt_windows")
 
-    all_model_files = [item for sublist in all_model_files for item in sublist]  # flatten the list of lists
+    index = load_screen_index(folder)
+    with measure("sliding_window", folder, level="stage"), mp.Pool(processes=PROCESS_COUNT) as pool:
+        results = pool.starmap(
+            process_model_folder, [(model_folder, folder, residue_sliding_window, n_model, all_sliding_windows, prediction) for model_folder, prediction in index["predictions"].items()]
+        )
+
+    all_model_files = [item for model_files, _ in results for item in model_files]  # flatten the list of lists
+    if VIRTUAL_PLDDT_WINDOWS:
+        update_plddt_store(os.path.join(folder, PLDDT_STORE_FILE), {key: array for _, entries in results for key, array in entries.items()})
 
     print(f"Found {len(all_model_files)} model files in {folder}")
     return all_model_files
 
 
-def process_model_folder(model_folder, folder, residue_sliding_window, n_model=N_MODEL):
+@instrumented("sliding_window")
+def process_model_folder(model_folder, folder, residue_sliding_window, n_model=N_MODEL, all_sliding_windows=(), prediction=None):
     model_files = []
-    model_root = os.path.join(folder, model_folder)
-    ranking_file = [f for f in os.listdir(model_root) if f.endswith("_ranking_scores.csv")][0]
-    ranking_csv = pd.read_csv(os.path.join(model_root, ranking_file))
-    ranking_csv.sort_values(by=["ranking_score"], ascending=False, inplace=True)
-    ranking_data = ranking_csv.head(n_model) if n_model > 0 else ranking_csv
-    for _, row in ranking_data.iterrows():
-        seed_folder = f"seed-{int(row['seed'])}_sample-{int(row['sample'])}"
-        model_file = [f for f in os.listdir(os.path.join(model_root, seed_folder)) if f.endswith("model.cif")][0]
-        model_file_path = os.path.join(model_root, seed_folder, model_file)
-        sliding_window_model_file = get_plddt_sliding_window_mmcif(model_file_path, residue_sliding_window=residue_sliding_window)
-        model_files.append(sliding_window_model_file)
-
-    return model_files
+    plddt_store_entries = {}
+    sliding_windows = sorted(set(all_sliding_windows) | {residue_sliding_window})
+    if prediction is None:
+        prediction = load_screen_index(folder)["predictions"][model_folder]
+    for model_file_path in get_ranked_model_files(folder, model_folder, prediction, n_model):
+        if VIRTUAL_PLDDT_WINDOWS:
+            missing_windows = get_missing_plddt_windows(model_file_path, sliding_windows)
+            if missing_windows:
+                plddt_store_entries.update(compute_smoothed_plddts(model_file_path, missing_windows))
+            model_files.append(model_file_path)
+        else:
+            sliding_window_model_files = get_plddt_sliding_windows_mmcif(model_file_path, sliding_windows)
+            model_files.append(sliding_window_model_files[residue_sliding_window])
+
+    return model_files, plddt_store_entries
 
 #TODO: In the future, support this for the complex pipeline as well.
 if __name__ == "__main__":
     from constants import CURRENT_PIPELINE
 
     assert CURRENT_PIPELINE == "pulldown", "This script is only for the pulldown pipeline"
-    from constants import FOLDERS
+    from constants import FOLDERS, PLDDT_SLIDING_WINDOW, ALL_PLDDT_WINDOWS
 
+    # create the sliding window model files of every configured window, parsing each model once
     for folder in FOLDERS:
         print(f"Processing {folder}", flush=True)
-        model_files = get_model_files(folder, residue_sliding_window=11, n_model=N_MODEL)
+        model_files = get_model_files(folder, residue_sliding_window=PLDDT_SLIDING_WINDOW, n_model=N_MODEL, all_sliding_windows=ALL_PLDDT_WINDOWS)
+
+    write_perf_report()
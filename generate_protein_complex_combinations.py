@@ -1,11 +1,14 @@
 # TODO: Prevent writing to existing folder
 # TODO: Support for fasta sequences with long IDs (that are possibily repetitive when truncated)
+import copy
 import json
 import itertools
 import os
 import re
 
 from files_helper import get_sequences_from_fasta
+from schedule_af3_jobs import schedule_folder
+from af3_input_helper import write_af3_inputs
 from constants import CURRENT_PIPELINE
 
 assert CURRENT_PIPELINE == "complex", "This script is only for the complex pipeline"
@@ -22,6 +25,8 @@ from constants import (
     OUTPUT_FOLDER,
     MAX_COMBINED_SEQ_LENGTH,
     CUSTOM_PREDICTIONS,
+    MAX_CHAINS,
+    GPU_COUNT,
 )
 
 DIGIT_TO_WORD = {"0": "zero", "1": "one", "2": "two", "3": "three", "4": "four", "5": "five", "6": "six", "7": "seven", "8": "eight", "9": "nine"}
@@ -34,41 +39,78 @@ def clean_id(id):
     return id[:MAX_ID_LENGTH].upper()
 
 
+def iter_unfixed_subsets(unfixed_proteins, lengths, max_length, min_size=0, max_size=None):
+    """
+    Yield the subsets of the unfixed proteins (as tuples, in the order of `unfixed_proteins`) with `min_size` to `max_size` proteins and a combined sequence length
+    of at most `max_length`. The subsets are enumerated depth-first over the proteins sorted by length, so a branch is cut as soon as the next protein does not fit
+    (every later protein is at least as long), and subsets over the length limit are never generated.
+    """
+
+    max_size = len(unfixed_proteins) if max_size is None else max_size
+    if max_size < 0:
+        return
+    order = sorted(range(len(unfixed_proteins)), key=lambda i: lengths[unfixed_proteins[i]])
+
+    def extend(start, chosen, total_length):
+        if len(chosen) >= min_size:
+            yield tuple(unfixed_proteins[i] for i in sorted(chosen))
+        if len(chosen) == max_size:
+            return
+        for k in range(start, len(order)):
+            length = lengths[unfixed_proteins[order[k]]]
+            if total_length + length > max_length:
+                break
+            chosen.append(order[k])
+            yield from extend(k + 1, chosen, total_length + length)
+            chosen.pop()
+
+    yield from extend(0, [], 0)
+
+
 def generate_protein_complex_combinations():
     _, sequences = get_sequences_from_fasta(INPUT_FASTA)
-    sequence_ids, sequence_fastas = zip(*sequences)
-    combinations = []
+    sequences_by_id = dict(sequences)
+    lengths = {id: len(sequence) for id, sequence in sequences}
+    max_chains = MAX_CHAINS if MAX_CHAINS is not None else len(sequences_by_id)
+    combination_iterators = []
 
+    fixed_proteins = ()
+    unfixed_index = {}
     if FIXED_PROTEINS:
-        fixed_proteins = [protein.strip()[0:MAX_ID_LENGTH] for protein in FIXED_PROTEINS if protein.strip()]
-        generated_combinations = []
+        fixed_proteins = tuple(protein.strip()[0:MAX_ID_LENGTH] for protein in FIXED_PROTEINS if protein.strip())
 
-        if set(fixed_proteins) - set(sequence_ids):
+        if set(fixed_proteins) - sequences_by_id.keys():
             raise ValueError("Some fixed proteins are not present in the input FASTA file.")
         if len(set(fixed_proteins)) != len(fixed_proteins):
             raise ValueError(f"Fixed proteins file contains duplicate entries after truncation to {MAX_ID_LENGTH} characters. Please ensure all fixed proteins after truncation are unique.")
 
-        unfixed_proteins = [p for p in sequence_ids if p not in fixed_proteins]
-        for r in range(0 if len(unfixed_proteins) > 0 else 1, len(unfixed_proteins) + 1):
-            generated_combinations.extend(itertools.combinations(unfixed_proteins, r))
-
-        generated_combinations = [tuple((tuple(fixed_proteins) + combo)) for combo in generated_combinations]
-        combinations.extend(generated_combinations)
-        print(f"Generated {len(generated_combinations)} combinations of protein complexes; from {len(unfixed_proteins)} unfixed proteins and {len(fixed_proteins)} fixed proteins.")
+        fixed_set = set(fixed_proteins)
+        unfixed_proteins = [p for p in sequences_by_id if p not in fixed_set]
+        unfixed_index = {protein: i for i, protein in enumerate(unfixed_proteins)}
+        fixed_length = sum(lengths[id] for id in fixed_proteins)
+        # combinations over the length or chain limit are pruned while enumerating, the others are streamed to disk
+        subsets = iter_unfixed_subsets(unfixed_proteins, lengths, MAX_COMBINED_SEQ_LENGTH - fixed_length, 0 if len(unfixed_proteins) > 0 else 1, max_chains - len(fixed_proteins))
+        combination_iterators.append(fixed_proteins + subset for subset in subsets)
+        print(f"Generating combinations of protein complexes from {len(unfixed_proteins)} unfixed proteins and {len(fixed_proteins)} fixed proteins (at most {max_chains} chains).")
+
+    def is_generated(combo):
+        # whether a combination is one of the generated ones (the fixed proteins, then unfixed proteins in FASTA order), without enumerating them
+        if not fixed_proteins or combo[: len(fixed_proteins)] != fixed_proteins or len(combo) > max_chains:
+            return False
+        indices = [unfixed_index.get(protein, -1) for protein in combo[len(fixed_proteins) :]]
+        return all(i >= 0 for i in indices) and all(a < b for a, b in zip(indices, indices[1:])) and (len(indices) > 0 or len(unfixed_index) > 0)
 
     if CUSTOM_PREDICTIONS:
-        custom_predictions = [tuple(custom_prediction) for custom_prediction in CUSTOM_PREDICTIONS]
-        overlap = set(custom_predictions) & set(combinations)
-        print(f"Adding {len(custom_predictions)} custom predictions to the combinations (found {len(overlap)} overlaps with generated combinations).")
-        non_overlap_combinations = [combo for combo in custom_predictions if combo not in combinations]
+        custom_predictions = list(dict.fromkeys(tuple(custom_prediction) for custom_prediction in CUSTOM_PREDICTIONS))
+        non_overlap_combinations = [combo for combo in custom_predictions if not is_generated(combo)]
+        print(f"Adding {len(custom_predictions)} custom predictions to the combinations (found {len(custom_predictions) - len(non_overlap_combinations)} overlaps with generated combinations).")
 
         for combo in non_overlap_combinations:
             for protein in combo:
-                if protein not in sequence_ids:
+                if protein not in sequences_by_id:
                     raise ValueError(f"Custom prediction contains protein {protein} that is not present in the input FASTA file.")
 
-        combinations.extend(non_overlap_combinations)
-        print(f"{len(combinations)} total combinations after adding custom predictions.")
+        combination_iterators.append(non_overlap_combinations)
 
     if not os.path.exists(OUTPUT_FOLDER):
         os.makedirs(OUTPUT_FOLDER)
@@ -76,31 +118,35 @@ def generate_protein_complex_combinations():
     template_json = json.load(open(TEMPLATE_FILE, "r"))
     template_json["modelSeeds"] = list(range(NUMBER_OF_SEEDS))
 
-    # Create FASTA files and AF3 input JSON files for each combination
-    for i, combo in enumerate(combinations):
-        complex_name = "_".join(combo)
+    # Create FASTA files and AF3 input JSON files for each combination, as they are generated
+    def iter_jobs():
+        for combo in itertools.chain.from_iterable(combination_iterators):
+            complex_name = "_".join(combo)
 
-        total_seq_length = sum(len(sequence_fastas[sequence_ids.index(id)]) for id in combo)
-        if total_seq_length > MAX_COMBINED_SEQ_LENGTH:
-            print(f"Skipping combination {complex_name}: Total sequence length {total_seq_length} exceeds maximum allowed length {MAX_COMBINED_SEQ_LENGTH}.")
-            continue
-        else:
-            print(f"Processing combination {complex_name}: with total sequence length {total_seq_length}")
+            total_seq_length = sum(lengths[id] for id in combo)
+            if total_seq_length > MAX_COMBINED_SEQ_LENGTH:
+                print(f"Skipping combination {complex_name}: Total sequence length {total_seq_length} exceeds maximum allowed length {MAX_COMBINED_SEQ_LENGTH}.")
+                continue
+            else:
+                print(f"Processing combination {complex_name}: with total sequence length {total_seq_length}")
 
-        fasta_content = "\n".join([f">{id}\n{sequence_fastas[sequence_ids.index(id)]}" for id in combo])
-        with open(f"{OUTPUT_FOLDER}/{total_seq_length}_{complex_name}.fasta", "w") as f:
-            f.write(fasta_content)
+            fasta_content = "\n".join([f">{id}\n{sequences_by_id[id]}" for id in combo])
+            af3_json = copy.deepcopy(template_json)
+            af3_json["name"] = f"{complex_name}"
+            af3_json["sequences"] = [{"protein": {"id": clean_id(id), "sequence": sequences_by_id[id]}} for id in combo]
+            yield f"{total_seq_length}_{complex_name}_input.json", af3_json, {f"{total_seq_length}_{complex_name}.fasta": fasta_content}
 
-        af3_json_file = f"{OUTPUT_FOLDER}/{total_seq_length}_{complex_name}_input.json"
-        af3_json = template_json.copy()
-        af3_json["name"] = f"{complex_name}"
-        af3_json["sequences"] = [{"protein": {"id": clean_id(id), "sequence": sequence_fastas[sequence_ids.index(id)]}} for id in combo]
-        with open(af3_json_file, "w") as f:
-            f.write(json.dumps(af3_json, indent=4))
+    manifest_jobs = write_af3_inputs(OUTPUT_FOLDER, iter_jobs())
+    print(f"Wrote {len(manifest_jobs)} combinations of protein complexes.")
 
     # Generate a Docker command to run AlphaFold3 for each complex
     output_bash_script = f"{OUTPUT_FOLDER}/run_alphafold3.sh"
 
+    # with several GPUs, the jobs are split into one input shard and container per GPU
+    if GPU_COUNT > 1:
+        schedule_folder(OUTPUT_FOLDER, output_bash_script, GPU_COUNT)
+        return
+
     with open(output_bash_script, "w") as bash_file:
         # create a bash script that runs all the alphafold3 jobs
         results_folder_abs = os.path.abspath(OUTPUT_FOLDER)
@@ -1,26 +1,151 @@
 """
-A script to get the predicted binding domain of a protein to LRRK2. Uses the chimerax `buriedarea` command to calculate the interacting region between the prey protein and LRRK2.
+A script to get the predicted binding domain of a protein to LRRK2. Calculates the contacts and buried area between the prey protein and each domain of LRRK2,
+either natively (in-process, see `structure_helper.py`) or with the chimerax `contacts` and `measure buriedarea` commands.
 """
 
 import os
 import re
-import subprocess
 import matplotlib.pyplot as plt
 import pandas as pd
 import multiprocessing as mp
 from files_helper import get_model_files
-from constants import FOLDERS, DOMAINS_TO_RESIDUES, PLDDT_SLIDING_WINDOW, PROCESS_COUNT
+from chimerax_helper import run_chimerax_batch, split_batches
+from perf_helper import instrumented, measure, run_subprocess, write_perf_report
+from modify_mmcif_plddt import get_plddt_sliding_window_mmcif
+from plddt_store import get_atom_plddts
+from result_cache import load_result_cache, get_cached_results, update_result_cache, merge_cached_results
+from structure_helper import (
+    load_atoms,
+    select_atoms,
+    count_overlaps_between,
+    atoms_near,
+    surface_points,
+    points_buried_by,
+    VDW_RADII,
+    PROBE_RADIUS,
+    CONTACT_OVERLAP_CUTOFF,
+    CONTACT_HBOND_ALLOWANCE,
+)
+from results_store import write_stage, get_superfolder
+from constants import FOLDERS, DOMAINS_TO_RESIDUES, PLDDT_SLIDING_WINDOW, ALL_PLDDT_WINDOWS, PROCESS_COUNT, BINDING_DOMAIN_BACKEND, CHIMERAX_BATCH_SIZE, VIRTUAL_PLDDT_WINDOWS, USE_RESULTS_STORE
 from get_binding_domain_combinations import process_binding_domain_combinations
 
 OUTPUT_FOLDER = "output_binding_domain/"
+BINDING_DOMAIN_BACKENDS = ["native", "chimerax", "chimerax_batch"]
+MIN_PREY_PLDDT = 40
+# with virtual sliding windows, the model files are the original models and the smoothed pLDDT is applied in memory
+PLDDT_WINDOW = PLDDT_SLIDING_WINDOW if VIRTUAL_PLDDT_WINDOWS else None
 
-def get_binding_domain_stats(model_file):
+
+def get_binding_domain_stats(model_file, backend=BINDING_DOMAIN_BACKEND, residue_sliding_window=PLDDT_WINDOW):
+    """
+    Get the buried area and the number of contacts between the prey protein and each bait domain in DOMAINS_TO_RESIDUES.
+    Returns a row of [model_file, *domain buried areas, *domain contacts] (None values if the calculation failed).
+    If `residue_sliding_window` is given, the PREY pLDDT mask uses the smoothed pLDDT of that window from the sidecar store (see `plddt_store.py`).
+    """
+    if backend == "native":
+        return get_binding_domain_stats_native(model_file, residue_sliding_window)
+    elif backend == "chimerax":
+        return get_binding_domain_stats_chimerax(model_file, residue_sliding_window)
+    elif backend == "chimerax_batch":
+        return get_binding_domain_stats_chimerax_batch([model_file], residue_sliding_window)[0]
+
+    raise ValueError(f"Unknown binding domain backend {backend}, expected one of {BINDING_DOMAIN_BACKENDS}")
+
+
+@instrumented("binding_domain")
+def get_binding_domain_stats_native(model_file, residue_sliding_window=PLDDT_WINDOW):
+    """
+    Native equivalent of the ChimeraX script: drops PREY atoms with pLDDT (B-factor) < 40, then for each domain counts the PREY-domain contacts
+    and the buried area between the PREY and the domain. The structure and the PREY surface (Shrake-Rupley points buried by the PREY itself)
+    are computed once and shared across all domains.
+    """
+    try:
+        atoms = load_atoms(model_file)
+        atom_plddts = get_atom_plddts(atoms, model_file, residue_sliding_window)
+        prey_atoms = select_atoms(atoms, (atoms["chain"] == "PREY") & (atom_plddts >= MIN_PREY_PLDDT))
+        bait_atoms = select_atoms(atoms, atoms["chain"] == "BAIT")
+
+        # edge case: when the entire structure has a sliding window plDDT < 40, just return 0 for the buried area and contacts
+        if len(prey_atoms["coords"]) == 0:
+            result = [(domain, 0, 0) for domain in DOMAINS_TO_RESIDUES.keys()]
+            print(f"Processing {model_file}\n{result}\n", flush=True)
+            return [model_file] + [0 for _ in DOMAINS_TO_RESIDUES.keys()] + [0 for _ in DOMAINS_TO_RESIDUES.keys()]
+
+        # buried area (SASA(prey) + SASA(domain) - SASA(prey + domain)) / 2 as in ChimeraX `measure buriedarea`: only atoms near the other set can lose surface
+        reach = 2 * (max(VDW_RADII.values()) + PROBE_RADIUS)
+        prey_points, prey_owner, prey_point_areas = surface_points(prey_atoms, atoms_near(prey_atoms, bait_atoms, reach))
+        prey_points_exposed = ~points_buried_by(prey_points, prey_atoms, owner=prey_owner)
+
+        buriedareas = []
+        interdomain_contacts = []
+        for residues in DOMAINS_TO_RESIDUES.values():
+            domain_atoms = select_atoms(bait_atoms, (bait_atoms["res_seq"] >= residues[0]) & (bait_atoms["res_seq"] <= residues[1]))
+            interdomain_contacts.append(count_overlaps_between(prey_atoms, domain_atoms, CONTACT_OVERLAP_CUTOFF, CONTACT_HBOND_ALLOWANCE))
+
+            domain_points, domain_owner, domain_point_areas = surface_points(domain_atoms, atoms_near(domain_atoms, prey_atoms, reach))
+            domain_buried = ~points_buried_by(domain_points, domain_atoms, owner=domain_owner) & points_buried_by(domain_points, prey_atoms)
+            prey_buried = prey_points_exposed & points_buried_by(prey_points, domain_atoms)
+            buriedareas.append(round(float(prey_point_areas[prey_buried].sum() + domain_point_areas[domain_buried].sum()) / 2, 2))
+    except Exception as e:
+        print(f"Processing {model_file}\n=================================================\nFailed to calculate buried area or contacts for {model_file}\n{e}\n=================================================\n", flush=True)
+        return [model_file] + [None for _ in DOMAINS_TO_RESIDUES.keys()] + [None for _ in DOMAINS_TO_RESIDUES.keys()]
+
+    result = list(zip(DOMAINS_TO_RESIDUES.keys(), buriedareas, interdomain_contacts))
+    print(f"Processing {model_file}\n{result}\n", flush=True)
+    return [model_file] + buriedareas + interdomain_contacts
+
+
+@instrumented("binding_domain")
+def get_binding_domain_stats_chimerax_batch(model_files, residue_sliding_window=PLDDT_WINDOW):
+    """
+    Same as `get_binding_domain_stats_chimerax`, but runs a whole batch of models in one ChimeraX session (see `chimerax_helper.py`)
+    and reads the contacts and buried areas from the structured results of the batch script instead of the ChimeraX log.
+    """
+    # ChimeraX reads the pLDDT from the B-factors, so the smoothed pLDDT has to be written to a model file
+    chimerax_model_files = model_files if residue_sliding_window is None else [get_plddt_sliding_window_mmcif(model_file, residue_sliding_window) for model_file in model_files]
+    domains = [[residues[0], residues[1]] for residues in DOMAINS_TO_RESIDUES.values()]
+    rows = []
+    for model_file, result in zip(model_files, run_chimerax_batch("binding_domain", chimerax_model_files, domains=domains, min_plddt=MIN_PREY_PLDDT)):
+        output_text = f"Processing {model_file}\n"
+
+        if "error" in result:
+            output_text += "=================================================\n"
+            output_text += f"Failed to calculate buried area or contacts for {model_file}\n"
+            output_text += result["error"] + "\n"
+            output_text += "=================================================\n"
+            print(output_text, flush=True)
+            rows.append([model_file] + [None for _ in DOMAINS_TO_RESIDUES.keys()] + [None for _ in DOMAINS_TO_RESIDUES.keys()])
+            continue
+
+        # edge case: when the entire structure has a sliding window plDDT < 40, just return 0 for the buried area and contacts
+        if result["result"]["prey_atom_count"] == 0:
+            buriedareas = [0 for _ in DOMAINS_TO_RESIDUES.keys()]
+            interdomain_contacts = [0 for _ in DOMAINS_TO_RESIDUES.keys()]
+        else:
+            contacts = result["result"]["contacts"]
+            prey_protein_contacts = contacts[0]
+            interdomain_contacts = [contacts[i + 1] - contacts[i] - prey_protein_contacts for i in range(1, len(contacts), 2)]
+            buriedareas = result["result"]["buriedareas"]
+
+        result = list(zip(DOMAINS_TO_RESIDUES.keys(), buriedareas, interdomain_contacts))
+        output_text += f"{result}\n"
+        print(output_text, flush=True)
+        rows.append([model_file] + [area for _, area, _ in result] + [contacts for _, _, contacts in result])
+
+    return rows
+
+
+@instrumented("binding_domain")
+def get_binding_domain_stats_chimerax(model_file, residue_sliding_window=PLDDT_WINDOW):
+    # ChimeraX reads the pLDDT from the B-factors, so the smoothed pLDDT has to be written to a model file
+    chimerax_model_file = model_file if residue_sliding_window is None else get_plddt_sliding_window_mmcif(model_file, residue_sliding_window)
     rand_suffix = os.urandom(4).hex()
 
     contacts_script_file = f"{os.path.basename(model_file)}_{rand_suffix}_contacts_script.temp.cxc"
     contacts_script = f""" 
-open {model_file} 
-delete #1/PREY @@bfactor<40 
+open {chimerax_model_file} 
+delete #1/PREY @@bfactor<{MIN_PREY_PLDDT} 
 sel #1/PREY
 contacts sel restrict both
 ~sel
@@ -40,7 +165,7 @@ contacts sel restrict both
         f.write(contacts_script)
 
     command = "chimerax --nogui " + contacts_script_file
-    process = subprocess.run(command, shell=True, capture_output=True)
+    process = run_subprocess(command, shell=True, capture_output=True)
 
     stdout = process.stdout.decode().strip()
     buriedarea_matches = re.findall(r"INFO:\nBuried area between /PREY and /BAIT:(\d+)-(\d+) = ([\d\.\-e]+)", stdout)
@@ -94,11 +219,33 @@ contacts sel restrict both
         return [model_file] + [area for _, area, _ in result] + [contacts for _, _, contacts in result]
 
 
-def process_model_parallel(model_files):
+def get_cache_params():
+    # the results depend on the domains, the sliding window and the backend
+    return {"domains_to_residues": DOMAINS_TO_RESIDUES, "plddt_sliding_window": PLDDT_SLIDING_WINDOW, "virtual_plddt_windows": VIRTUAL_PLDDT_WINDOWS, "backend": BINDING_DOMAIN_BACKEND, "min_prey_plddt": MIN_PREY_PLDDT}
+
+
+def get_binding_domain_columns():
+    return ["model"] + [key + "_area" for key in DOMAINS_TO_RESIDUES.keys()] + [key + "_contacts" for key in DOMAINS_TO_RESIDUES.keys()]
+
+
+def process_model_parallel(model_files, folder=None):
+    # only process models that are new or changed since the last run
+    cache = load_result_cache("binding_domain", folder, get_cache_params()) if folder else None
+    cached_results, missing_model_files = get_cached_results(cache, model_files) if cache else ({}, model_files)
+
     with mp.Pool(processes=PROCESS_COUNT) as pool:
-        results = pool.map(get_binding_domain_stats, model_files)
+        if BINDING_DOMAIN_BACKEND == "chimerax_batch":
+            # one ChimeraX session per batch of models instead of one per model
+            new_results = pool.map(get_binding_domain_stats_chimerax_batch, split_batches(missing_model_files, CHIMERAX_BATCH_SIZE))
+            new_results = [item for sublist in new_results for item in sublist]  # flatten the list of lists
+        else:
+            new_results = pool.map(get_binding_domain_stats, missing_model_files)
+
+    if cache:
+        # failed calculations (None values) are not cached so they are retried on the next run
+        update_result_cache(cache, missing_model_files, new_results, is_valid=lambda row: None not in row)
 
-    return results
+    return merge_cached_results(model_files, cached_results, missing_model_files, new_results)
 
 
 if __name__ == "__main__":
@@ -106,14 +253,16 @@ if __name__ == "__main__":
         os.makedirs(OUTPUT_FOLDER)
 
     for folder in FOLDERS:
-        model_files = get_model_files(folder, residue_sliding_window=PLDDT_SLIDING_WINDOW)
-        results = process_model_parallel(model_files)    
-        binding_domain_area = [key + "_area" for key in DOMAINS_TO_RESIDUES.keys()]
-        binding_domain_contacts = [key + "_contacts" for key in DOMAINS_TO_RESIDUES.keys()]
+        model_files = get_model_files(folder, residue_sliding_window=PLDDT_SLIDING_WINDOW, all_sliding_windows=ALL_PLDDT_WINDOWS)
+        with measure("binding_domain", folder, level="stage"):
+            results = process_model_parallel(model_files, folder)
         output_file = f"binding_domain_plddt_window_{PLDDT_SLIDING_WINDOW}.csv"
-        result_df = pd.DataFrame(results, columns=["model"] + binding_domain_area + binding_domain_contacts)
+        result_df = pd.DataFrame(results, columns=get_binding_domain_columns())
         result_df.to_csv(f"{OUTPUT_FOLDER}{folder}_{output_file}", index=False)
-        process_binding_domain_combinations(folder)
+        binding_domain_df = process_binding_domain_combinations(folder)
+        if USE_RESULTS_STORE:
+            write_stage("binding_domain", binding_domain_df, get_superfolder(folder), folder, PLDDT_SLIDING_WINDOW)
         
         print(f"Saved {folder}_{output_file}")
+    write_perf_report()
     print("Done!\n")
@@ -1,16 +1,21 @@
 """
 This script generates all possible combinations of binding domains for a given set of binding domains.
-For each prey protein, it will create a new column for each combination of binding domains,
-and assign a value of 1 if the combination is present in the binding domains of that prey protein (the number of contacts surpass a threshold).
+For each prey protein, it will assign the (mutually exclusive) combination of binding domains whose number of contacts surpass a threshold.
 For example, if the binding domains are "A", "B", and "C", the script will generate the following combinations:
 - A, B, C, AB, AC, BC, ABC
+
+The combination of each prediction is encoded as an integer bitmask of the domains meeting the threshold (bit i set for the i-th domain of DOMAINS_TO_RESIDUES),
+stored in a `binding_domains_MIN_<threshold>` column, so the exact combination of a prediction is the one whose bitmask equals the row's bitmask.
+The one-hot `<combination>_MIN_<threshold>` columns (2^D - 1 per threshold) are only written with `binding_domain_combination_columns`,
+and can otherwise be derived when needed with `add_binding_domain_combination_columns` or counted with `count_binding_domain_combinations`.
 """
 
 import itertools
+import numpy as np
 import pandas as pd
 from constants import CURRENT_PIPELINE
 assert CURRENT_PIPELINE == "pulldown", "This script is only for the pulldown pipeline"
-from constants import DOMAINS_TO_RESIDUES, FOLDERS, PLDDT_SLIDING_WINDOW, MIN_CONTACTS_THRESHOLDS
+from constants import DOMAINS_TO_RESIDUES, FOLDERS, PLDDT_SLIDING_WINDOW, MIN_CONTACTS_THRESHOLDS, BINDING_DOMAIN_COMBINATION_COLUMNS
 
 
 def generate_binding_domain_combinations(binding_domains):
@@ -25,32 +30,86 @@ def generate_binding_domain_combinations(binding_domains):
     return list(reversed(combinations))
 
 
-def process_binding_domain_combinations(folder):
+def get_combination_bitmask(combination, binding_domains):
     """
-    Process a folder to generate binding domain combinations.
+    Bitmask of a combination of binding domains (bit i set for the i-th domain of `binding_domains`).
     """
-    binding_domain_combinations = generate_binding_domain_combinations(DOMAINS_TO_RESIDUES.keys())
-    # append "_contacts" to get df column names
-    binding_domain_combinations_columns = [tuple(f"{domain}_contacts" for domain in combination) for combination in binding_domain_combinations]
+    binding_domains = list(binding_domains)
+    return sum(1 << binding_domains.index(domain) for domain in combination)
 
-    binding_domain_file = f"output_binding_domain/{folder}_binding_domain_plddt_window_{PLDDT_SLIDING_WINDOW}.csv"
 
-    binding_domain_df = pd.read_csv(binding_domain_file)
-
-    # create new columns for each combination of binding domains
-    for i, combination in enumerate(binding_domain_combinations_columns):
-        for threshold in MIN_CONTACTS_THRESHOLDS:
-            column_name = "_".join(binding_domain_combinations[i]) + f"_MIN_{threshold}"
-            # check if all domains in the combination meet the threshold for each row
-            mask = (binding_domain_df[list(combination)] >= threshold).all(axis=1)
-            # and check that any of the (superset) domains with this domain as a subset do not meet the threshold (keep columns mutually exclusive)
-            for j in range(i):
-                superset_combination = binding_domain_combinations_columns[j]
-                if set(combination).issubset(set(superset_combination)):
-                    mask &= (binding_domain_df[list(superset_combination)] < threshold).any(axis=1)
-            binding_domain_df[column_name] = mask.astype(int)
+def get_binding_domain_bitmask_column(threshold):
+    return f"binding_domains_MIN_{threshold}"
+
+
+def get_binding_domain_bitmasks(binding_domain_df, threshold, binding_domains=DOMAINS_TO_RESIDUES.keys()):
+    """
+    Bitmask of the binding domains with at least `threshold` contacts, for each row (from the `binding_domains_MIN_<threshold>` column if present, otherwise from the contacts).
+    """
+    bitmask_column = get_binding_domain_bitmask_column(threshold)
+    # the stored bitmasks use the domain order of DOMAINS_TO_RESIDUES
+    if bitmask_column in binding_domain_df.columns and list(binding_domains) == list(DOMAINS_TO_RESIDUES.keys()):
+        return binding_domain_df[bitmask_column].to_numpy(dtype=np.int64)
+
+    contacts = binding_domain_df[[f"{domain}_contacts" for domain in binding_domains]].to_numpy()
+    return ((contacts >= threshold).astype(np.int64) << np.arange(contacts.shape[1], dtype=np.int64)).sum(axis=1)
+
+
+def count_binding_domain_combinations(binding_domain_df, threshold, binding_domains=DOMAINS_TO_RESIDUES.keys()):
+    """
+    Number of rows with each (exact) combination of binding domains, indexed by the `<combination>_MIN_<threshold>` column names, in the order of `generate_binding_domain_combinations`.
+    """
+    binding_domains = list(binding_domains)
+    bitmask_counts = np.bincount(get_binding_domain_bitmasks(binding_domain_df, threshold, binding_domains), minlength=1 << len(binding_domains))
+    combinations = generate_binding_domain_combinations(binding_domains)
+    return pd.Series(
+        [bitmask_counts[get_combination_bitmask(combination, binding_domains)] for combination in combinations],
+        index=["_".join(combination) + f"_MIN_{threshold}" for combination in combinations],
+    )
+
+
+def add_binding_domain_combination_columns(binding_domain_df, thresholds=MIN_CONTACTS_THRESHOLDS, binding_domains=DOMAINS_TO_RESIDUES.keys()):
+    """
+    Derive the one-hot `<combination>_MIN_<threshold>` columns (1 if the combination is exactly the set of domains meeting the threshold) from the bitmasks.
+    """
+    binding_domains = list(binding_domains)
+    combinations = generate_binding_domain_combinations(binding_domains)
+    columns = {}
+    for threshold in thresholds:
+        bitmasks = get_binding_domain_bitmasks(binding_domain_df, threshold, binding_domains)
+        for combination in combinations:
+            columns["_".join(combination) + f"_MIN_{threshold}"] = (bitmasks == get_combination_bitmask(combination, binding_domains)).astype(int)
+
+    # add all columns at once instead of one by one
+    return pd.concat([binding_domain_df, pd.DataFrame(columns, index=binding_domain_df.index)], axis=1)
+
+
+def add_binding_domain_bitmask_columns(binding_domain_df):
+    """
+    Add the binding domain combination bitmask of each threshold (and the combination columns, if enabled) to binding domain results (model, areas and contacts).
+    """
+    # drop the columns of a previous run, they are recomputed from the contacts
+    binding_domain_df = binding_domain_df[["model"] + [f"{domain}_{value}" for value in ["area", "contacts"] for domain in DOMAINS_TO_RESIDUES.keys()]].copy()
+
+    for threshold in MIN_CONTACTS_THRESHOLDS:
+        binding_domain_df[get_binding_domain_bitmask_column(threshold)] = get_binding_domain_bitmasks(binding_domain_df, threshold)
+
+    if BINDING_DOMAIN_COMBINATION_COLUMNS:
+        binding_domain_df = add_binding_domain_combination_columns(binding_domain_df)
+
+    return binding_domain_df
+
+
+def process_binding_domain_combinations(folder):
+    """
+    Process a folder to add the binding domain combination bitmask of each threshold (and the combination columns, if enabled).
+    Returns the binding domain results with the added columns.
+    """
+    binding_domain_file = f"output_binding_domain/{folder}_binding_domain_plddt_window_{PLDDT_SLIDING_WINDOW}.csv"
 
+    binding_domain_df = add_binding_domain_bitmask_columns(pd.read_csv(binding_domain_file))
     binding_domain_df.to_csv(binding_domain_file, index=False)
+    return binding_domain_df
 
 
 if __name__ == "__main__":
@@ -2,42 +2,80 @@ import os
 import pandas as pd
 from constants import CURRENT_PIPELINE
 assert CURRENT_PIPELINE == "pulldown", "This script is only for the pulldown pipeline"
-from constants import SUPERFOLDER_TO_FOLDER, PLDDT_SLIDING_WINDOW, CLASHES_MODEL, MAX_CLASHES_THRESHOLD
+from constants import SUPERFOLDER_TO_FOLDER, PLDDT_SLIDING_WINDOW, CLASHES_MODEL, MAX_CLASHES_THRESHOLD, VIRTUAL_PLDDT_WINDOWS, USE_RESULTS_STORE
+from results_store import read_stage, write_stage
+from perf_helper import measure, write_perf_report
 
 OUTPUT_FOLDER = "output_merged_results/"
 if not os.path.exists(OUTPUT_FOLDER):
     os.makedirs(OUTPUT_FOLDER)
 
+def merge_folder_csv(folder):
+    """
+    Merge the per-stage CSV files of a screen folder on the model path.
+    """
+    predictions_file = "output_raw_results/" + folder + "_results.csv"
+    predictions_df = pd.read_csv(predictions_file)
+    # with virtual sliding windows, all stages refer to the original model files
+    if PLDDT_SLIDING_WINDOW > 0 and not VIRTUAL_PLDDT_WINDOWS:
+        predictions_df["model"] = predictions_df["model"].str.replace(r"\.(cif|npz)$", rf"_plddt_window_{PLDDT_SLIDING_WINDOW}.\1", regex=True)
+
+    binding_file = "output_binding_domain/" + folder + f"_binding_domain_plddt_window_{PLDDT_SLIDING_WINDOW}.csv"
+    binding_df = pd.read_csv(binding_file)
+    assert len(predictions_df) == len(binding_df), "DataFrames have different lengths"
+    merged_df = pd.merge(predictions_df, binding_df, on="model")
+
+    # conditional merging of clashes data, if it exists
+    if CLASHES_MODEL and MAX_CLASHES_THRESHOLD is not None:
+        clashes_file = "output_all_clashes/" + folder + f"_clashes_plddt_window_{PLDDT_SLIDING_WINDOW}.csv"
+        clashes_df = pd.read_csv(clashes_file)
+        assert len(predictions_df) == len(clashes_df), "DataFrames have different lengths"
+        merged_df = pd.merge(merged_df, clashes_df, on="model")
+    else:
+        print("No clashes data available, merging only predictions and binding domain data")
+
+    assert len(merged_df) == len(predictions_df), f"Merged DataFrame has different length than original DataFrames {len(merged_df)} vs {len(predictions_df)}"
+    return merged_df
+
+
+def merge_folder_store(superfolder, folder):
+    """
+    Merge the per-stage results of a screen folder from the results store on the prediction key, and write them to the store's merged dataset.
+    """
+    predictions_df = read_stage("raw_results", superfolder=superfolder, folders=[folder])
+    # the binding domain and clashes stages refer to the (sliding window) model files that were analyzed
+    binding_df = read_stage("binding_domain", superfolder=superfolder, folders=[folder], window=PLDDT_SLIDING_WINDOW)
+    assert len(predictions_df) == len(binding_df), "DataFrames have different lengths"
+    merged_df = pd.merge(predictions_df.drop(columns="model"), binding_df, on="prediction_key")
+
+    if CLASHES_MODEL and MAX_CLASHES_THRESHOLD is not None:
+        clashes_df = read_stage("clashes", superfolder=superfolder, folders=[folder], window=PLDDT_SLIDING_WINDOW)
+        assert len(predictions_df) == len(clashes_df), "DataFrames have different lengths"
+        merged_df = pd.merge(merged_df, clashes_df.drop(columns="model"), on="prediction_key")
+    else:
+        print("No clashes data available, merging only predictions and binding domain data")
+
+    assert len(merged_df) == len(predictions_df), f"Merged DataFrame has different length than original DataFrames {len(merged_df)} vs {len(predictions_df)}"
+
+    # same column order as the CSV merge, with the prediction key first
+    merged_df = merged_df[["prediction_key", "model"] + [column for column in merged_df.columns if column not in ["prediction_key", "model"]]]
+    write_stage("merged", merged_df, superfolder, folder, PLDDT_SLIDING_WINDOW)
+    return merged_df.drop(columns="prediction_key")
+
+
 for superfolder, folders in SUPERFOLDER_TO_FOLDER.items():
     print(f"Processing {superfolder}", flush=True)
-    superfolder_df = pd.DataFrame()
+    folder_dfs = []
 
     for folder in folders:
         print(f"Processing {folder}", flush=True)
         output_file = OUTPUT_FOLDER + folder + f"_merged_plddt_window_{PLDDT_SLIDING_WINDOW}.csv"
-        predictions_file = "output_raw_results/" + folder + "_results.csv"
-        predictions_df = pd.read_csv(predictions_file)
-        if PLDDT_SLIDING_WINDOW > 0:
-            predictions_df["model"] = predictions_df["model"].str.replace(".cif", f"_plddt_window_{PLDDT_SLIDING_WINDOW}.cif")
-
-        binding_file = "output_binding_domain/" + folder + f"_binding_domain_plddt_window_{PLDDT_SLIDING_WINDOW}.csv"
-        binding_df = pd.read_csv(binding_file)
-
-        # conditional merging of clashes data, if it exists
-        if CLASHES_MODEL and MAX_CLASHES_THRESHOLD is not None:
-            clashes_file = "output_all_clashes/" + folder + f"_clashes_plddt_window_{PLDDT_SLIDING_WINDOW}.csv"
-            clashes_df = pd.read_csv(clashes_file)
-            assert len(predictions_df) == len(clashes_df) == len(binding_df), "DataFrames have different lengths"
-            merged_df = pd.merge(predictions_df, clashes_df, on="model")
-        else:
-            print("No clashes data available, merging only predictions and binding domain data")
-            assert len(predictions_df) == len(binding_df), "DataFrames have different lengths"
-            merged_df = pd.merge(predictions_df, binding_df, on="model")
-
-        assert len(merged_df) == len(predictions_df), f"Merged DataFrame has different length than original DataFrames {len(merged_df)} vs {len(predictions_df)}"
-
-        merged_df.to_csv(output_file, index=False)
-
-        superfolder_df = pd.concat([superfolder_df, merged_df], ignore_index=True)
-    
-    superfolder_df.to_csv(OUTPUT_FOLDER + superfolder + "_merged_plddt_window_" + str(PLDDT_SLIDING_WINDOW) + ".csv", index=False)
\ No newline at end of file
+        with measure("merge", folder, level="stage"):
+            merged_df = merge_folder_store(superfolder, folder) if USE_RESULTS_STORE else merge_folder_csv(folder)
+            merged_df.to_csv(output_file, index=False)
+        folder_dfs.append(merged_df)
+
+    superfolder_df = pd.concat(folder_dfs, ignore_index=True)
+    superfolder_df.to_csv(OUTPUT_FOLDER + superfolder + "_merged_plddt_window_" + str(PLDDT_SLIDING_WINDOW) + ".csv", index=False)
+
+write_perf_report()
@@ -0,0 +1,141 @@
+"""
+Lightweight mmCIF helpers that only look at the `_atom_site` loop (AF3 model.cif files), instead of building a full Biopython structure.
+Atoms are read into NumPy arrays, and B-factors (pLDDT) can be rewritten in place, leaving every other byte of the file unchanged.
+Compact binary models (`*_model.npz` and their `*_plddt_window_N.npz` copies, see `compact_model.py`) are read and rewritten the same way.
+"""
+
+import re
+import numpy as np
+from screen_archive import open_screen_file
+
+# mmCIF tokens: quoted strings (which may contain spaces or the other quote character) or runs of non-whitespace characters
+TOKEN_PATTERN = re.compile(r"'[^']*'(?=\s|$)|\"[^\"]*\"(?=\s|$)|\S+")
+ATOM_SITE_PREFIX = "_atom_site."
+COMPACT_MODEL_EXTENSION = ".npz"
+
+
+def _find_atom_site_loop(lines):
+    """
+    Find the `_atom_site` loop in the lines of a mmCIF file. Returns (column names, index of the first data line, index after the last data line).
+    """
+
+    for i, line in enumerate(lines):
+        if not line.startswith(ATOM_SITE_PREFIX) or not lines[i - 1].strip() == "loop_":
+            continue
+
+        columns = []
+        j = i
+        while j < len(lines) and lines[j].startswith(ATOM_SITE_PREFIX):
+            columns.append(lines[j].strip()[len(ATOM_SITE_PREFIX) :])
+            j += 1
+
+        start = j
+        while j < len(lines) and lines[j].strip() and lines[j][0] not in "#_" and not lines[j].startswith(("loop_", "data_")):
+            j += 1
+
+        return columns, start, j
+
+    raise ValueError("No _atom_site loop found")
+
+
+def _tokenize(line):
+    if "'" in line or '"' in line:
+        return [token[1:-1] if token[0] in "'\"" else token for token in TOKEN_PATTERN.findall(line)]
+    return line.split()
+
+
+def get_residue_index(chain, res_seq, ins_code):
+    """
+    Index of the residue of each atom within its chain (0 for the first residue of every chain), given per-atom chain ids, residue numbers and insertion codes.
+    """
+
+    # a new residue starts whenever the chain, residue number or insertion code changes; count them within each chain
+    new_residue = np.ones(len(chain), dtype=bool)
+    new_residue[1:] = (chain[1:] != chain[:-1]) | (res_seq[1:] != res_seq[:-1]) | (ins_code[1:] != ins_code[:-1])
+    new_chain = np.ones(len(chain), dtype=bool)
+    new_chain[1:] = chain[1:] != chain[:-1]
+    residue_count = np.cumsum(new_residue)
+    return (residue_count - np.maximum.accumulate(np.where(new_chain, residue_count, 0))).astype(np.int64)
+
+
+def read_atom_site(mmcif_file):
+    """
+    Read the `_atom_site` loop of a mmCIF file (first model only) into a dictionary of NumPy arrays, one entry per atom:
+    `coords`, `element`, `atom_name`, `res_name`, `chain`, `res_seq`, `residue_index` (index of the residue within its chain), `bfactor`,
+    and `row` (the index of the atom's row in the `_atom_site` loop, used to write B-factors back with `write_atom_site_bfactors`).
+    """
+
+    if mmcif_file.endswith(COMPACT_MODEL_EXTENSION):
+        from compact_model import read_compact_atom_site_columns
+
+        columns = read_compact_atom_site_columns(mmcif_file)
+    else:
+        with open_screen_file(mmcif_file) as f:
+            lines = f.read().splitlines()
+
+        column_names, start, end = _find_atom_site_loop(lines)
+        rows = [_tokenize(line) for line in lines[start:end]]
+        if any(len(row) != len(column_names) for row in rows):
+            raise ValueError(f"Expected one {len(column_names)} column _atom_site row per line in {mmcif_file}")
+
+        table = np.array(rows, dtype=str).reshape(-1, len(column_names))
+        columns = {name: table[:, i] for i, name in enumerate(column_names)}
+
+    def column(*names):
+        for name in names:
+            if name in columns:
+                return columns[name]
+        raise ValueError(f"Missing _atom_site column {names[0]} in {mmcif_file}")
+
+    keep = np.ones(len(column("Cartn_x")), dtype=bool)
+    if "pdbx_PDB_model_num" in columns and len(keep) > 0:
+        keep &= column("pdbx_PDB_model_num") == column("pdbx_PDB_model_num")[0]
+    if "label_alt_id" in columns:
+        keep &= np.isin(column("label_alt_id"), [".", "?", "A"])
+
+    chain = column("auth_asym_id", "label_asym_id")[keep]
+    res_seq = column("auth_seq_id", "label_seq_id")[keep]
+    ins_code = column("pdbx_PDB_ins_code")[keep] if "pdbx_PDB_ins_code" in columns else np.full(len(chain), "?")
+
+    residue_index = get_residue_index(chain, res_seq, ins_code)
+
+    return {
+        "coords": np.column_stack([column("Cartn_x"), column("Cartn_y"), column("Cartn_z")]).astype(np.float64)[keep].reshape(-1, 3),
+        "element": np.char.upper(column("type_symbol")[keep]),
+        "atom_name": column("label_atom_id", "auth_atom_id")[keep],
+        "res_name": column("label_comp_id", "auth_comp_id")[keep],
+        "chain": chain,
+        "res_seq": res_seq.astype(np.int64),
+        "residue_index": residue_index,
+        "bfactor": column("B_iso_or_equiv")[keep].astype(np.float64),
+        "row": np.flatnonzero(keep),
+    }
+
+
+def write_atom_site_bfactors(input_file, output_file, bfactors, rows=None):
+    """
+    Copy a mmCIF file, replacing only the `B_iso_or_equiv` values of the `_atom_site` rows `rows` (default: all rows) with `bfactors`.
+    Every other byte of the file is copied unchanged.
+    """
+
+    if input_file.endswith(COMPACT_MODEL_EXTENSION):
+        from compact_model import write_compact_bfactors
+
+        return write_compact_bfactors(input_file, output_file, bfactors, rows)
+
+    with open(input_file, newline="") as f:
+        lines = f.read().splitlines(keepends=True)
+
+    columns, start, end = _find_atom_site_loop(lines)
+    bfactor_column = columns.index("B_iso_or_equiv")
+    rows = np.arange(end - start) if rows is None else np.asarray(rows)
+    if len(rows) != len(bfactors):
+        raise ValueError(f"Got {len(bfactors)} B-factors for {len(rows)} _atom_site rows")
+
+    for row, bfactor in zip(rows, bfactors):
+        line = lines[start + row]
+        token = list(TOKEN_PATTERN.finditer(line))[bfactor_column]
+        lines[start + row] = f"{line[: token.start()]}{bfactor:.2f}{line[token.end() :]}"
+
+    with open(output_file, "w", newline="") as f:
+        f.write("".join(lines))
@@ -0,0 +1,119 @@
+"""
+Top-K retention of AF3 samples: only the top `retain_top_samples` samples of every prediction (by ranking score) are kept as mmCIF model and JSON confidences
+files, the model and confidences files of the other samples are re-encoded as compact `.npz` files (see `compact_model.py`, about ten times smaller),
+and their `_plddt_window_N.cif` copies are removed. The analysis stages read the compact files like the original ones (native backends only, ChimeraX
+cannot open them: `python compact_model.py <file>` writes a compact file back as mmCIF/JSON).
+
+Every compact file is read back and checked against its original before the original is removed, and the prediction folder is touched afterwards so the
+screen index (see `screen_index.py`) rescans it. Only completed predictions (with a ranking scores file) are processed, so this can run while AF3 is still
+writing the screen; archive a screen (see `screen_archive.py`) after the retention, archived screens are skipped.
+"""
+
+import os
+import glob
+import argparse
+import numpy as np
+from multiprocessing import Pool
+from mmcif_helper import read_atom_site
+from confidences_helper import read_atom_plddts
+from compact_model import encode_model, encode_confidences, get_compact_file, is_compact_file
+from screen_index import load_screen_index, get_completed_predictions, get_sample_files
+from screen_archive import is_archived_screen
+
+
+def _check_compact_model(model_file, compact_file):
+    original, compact = read_atom_site(model_file), read_atom_site(compact_file)
+    if not (
+        all(np.array_equal(original[key], compact[key]) for key in ("element", "atom_name", "res_name", "chain", "res_seq", "residue_index", "row"))
+        and np.allclose(original["coords"], compact["coords"], rtol=0, atol=5e-4)
+        and np.allclose(original["bfactor"], compact["bfactor"], rtol=0, atol=5e-3)
+    ):
+        raise ValueError(f"{compact_file} does not match {model_file}")
+
+
+def _check_compact_confidences(confidences_file, compact_file):
+    (original_plddts, original_chain_ids), (compact_plddts, compact_chain_ids) = read_atom_plddts(confidences_file), read_atom_plddts(compact_file)
+    if not (np.array_equal(original_chain_ids, compact_chain_ids) and np.allclose(original_plddts, compact_plddts, rtol=0, atol=5e-3)):
+        raise ValueError(f"{compact_file} does not match {confidences_file}")
+
+
+def retain_prediction(folder, prediction_name, prediction, top_k):
+    """
+    Re-encode the model and confidences files of the samples of a prediction outside its top `top_k` samples as compact files.
+    Returns (number of re-encoded files, bytes saved).
+    """
+
+    encoded, saved = 0, 0
+    ranking = sorted(prediction["ranking"], key=lambda row: row[2], reverse=True)
+    for seed, sample, _ in ranking[top_k:]:
+        sample_name = f"seed-{seed}_sample-{sample}"
+        if sample_name not in prediction["samples"]:
+            continue
+        sample_files = get_sample_files(folder, prediction_name, sample_name, prediction["samples"][sample_name])
+        for key, encode, check in [("model", encode_model, _check_compact_model), ("confidences", encode_confidences, _check_compact_confidences)]:
+            input_file = sample_files[key]
+            if input_file is None or is_compact_file(input_file) or not os.path.exists(input_file):
+                continue
+            compact_file = encode(input_file, get_compact_file(input_file))
+            try:
+                check(input_file, compact_file)
+            except ValueError as e:
+                os.remove(compact_file)
+                print(f"Keeping {input_file}: {e}", flush=True)
+                continue
+            saved += os.path.getsize(input_file) - os.path.getsize(compact_file)
+            os.remove(input_file)
+            encoded += 1
+            if key == "model":
+                for window_file in glob.glob(glob.escape(os.path.splitext(input_file)[0]) + "_plddt_window_*.cif"):
+                    saved += os.path.getsize(window_file)
+                    os.remove(window_file)
+
+    if encoded > 0:
+        # the files were replaced inside the seed/sample folders, which does not change the modification time of the prediction folder
+        os.utime(os.path.join(folder, prediction_name))
+    return encoded, saved
+
+
+def _retain_prediction(args):
+    folder, prediction_name, prediction, top_k = args
+    try:
+        return retain_prediction(folder, prediction_name, prediction, top_k)
+    except Exception as e:
+        # a failing prediction (e.g. a truncated model file) does not stop the retention of the others
+        print(f"Failed to re-encode the samples of {os.path.join(folder, prediction_name)}: {e!r}", flush=True)
+        return 0, 0
+
+
+def retain_screen(folder, top_k, process_count):
+    """
+    Re-encode the samples outside the top `top_k` of every completed prediction of a screen folder. Returns the number of bytes saved.
+    """
+
+    if is_archived_screen(folder):
+        print(f"Skipping {folder}: archived screens are read-only, run the retention before archiving", flush=True)
+        return 0
+
+    predictions = get_completed_predictions(load_screen_index(folder))
+    with Pool(processes=process_count) as pool:
+        results = pool.map(_retain_prediction, [(folder, prediction_name, prediction, top_k) for prediction_name, prediction in predictions.items()])
+
+    encoded, saved = sum(result[0] for result in results), sum(result[1] for result in results)
+    load_screen_index(folder)
+    print(f"{folder}: re-encoded {encoded} files of {len(predictions)} predictions, saved {saved / 2**20:.1f} MB", flush=True)
+    return saved
+
+
+if __name__ == "__main__":
+    from constants import FOLDERS, PROCESS_COUNT, RETAIN_TOP_SAMPLES
+
+    parser = argparse.ArgumentParser(description="Keep full mmCIF/JSON files only for the top samples of every prediction, re-encode the others as compact files")
+    parser.add_argument("--folders", nargs="+", default=FOLDERS, help="screen folders to process (default: the screen folders of the config)")
+    parser.add_argument("--top-k", type=int, default=RETAIN_TOP_SAMPLES, help="number of samples per prediction kept as mmCIF/JSON files (default: retain_top_samples of the config)")
+    args = parser.parse_args()
+
+    if args.top_k < 1:
+        parser.error("--top-k must be at least 1")
+
+    saved = sum(retain_screen(folder, args.top_k, PROCESS_COUNT) for folder in args.folders if os.path.isdir(folder))
+    print(f"Saved {saved / 2**20:.1f} MB", flush=True)
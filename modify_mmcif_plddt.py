@@ -2,7 +2,38 @@
 
 import os
 import numpy as np
-from Bio.PDB import MMCIFParser, MMCIFIO
+from mmcif_helper import read_atom_site, write_atom_site_bfactors
+
+
+def get_residue_plddts(atoms, target_chain_id="PREY"):
+    """
+    Average the atom B-factors (pLDDT) of each residue of the target chain. Returns (per-residue pLDDT, mask of the target chain atoms).
+    """
+
+    chain_mask = atoms["chain"] == target_chain_id
+    residue_index = atoms["residue_index"][chain_mask]
+    residue_count = residue_index.max() + 1 if len(residue_index) > 0 else 0
+    residue_bfactors = np.bincount(residue_index, weights=atoms["bfactor"][chain_mask], minlength=residue_count) / np.maximum(np.bincount(residue_index, minlength=residue_count), 1)
+    return residue_bfactors, chain_mask
+
+
+def sliding_window_mean(values, residue_sliding_window):
+    """
+    Mean of each value and its neighbors in a window of `residue_sliding_window` values (truncated at both ends), computed with a cumulative sum.
+    """
+
+    half_window = max(residue_sliding_window, 1) // 2
+    cumulative_sum = np.concatenate(([0.0], np.cumsum(values, dtype=np.float64)))
+    indices = np.arange(len(values))
+    start = np.maximum(0, indices - half_window)
+    end = np.minimum(len(values), indices + half_window + 1)
+    return (cumulative_sum[end] - cumulative_sum[start]) / (end - start)
+
+
+def get_plddt_sliding_window_file(input_file, residue_sliding_window):
+    # compact models (`*_model.npz`) get compact sliding window files
+    root, extension = os.path.splitext(input_file)
+    return f"{root}_plddt_window_{residue_sliding_window}{extension}" if residue_sliding_window > 1 else input_file
 
 
 def get_plddt_sliding_window_mmcif(input_file, residue_sliding_window=1, target_chain_id="PREY"):
@@ -14,38 +45,27 @@ def get_plddt_sliding_window_mmcif(input_file, residue_sliding_window=1, target_
         Writes to a new mmCIF file with the same name as the input file but with the sliding window as a suffix.
     """
 
-    output_file = input_file.replace(".cif", f"_plddt_window_{residue_sliding_window}.cif") if residue_sliding_window > 1 else input_file
+    return get_plddt_sliding_windows_mmcif(input_file, [residue_sliding_window], target_chain_id)[residue_sliding_window]
 
-    if os.path.exists(output_file):
-        # print(f"Output file {output_file} already exists. Skipping modification.")
-        return output_file
 
-    parser = MMCIFParser(QUIET=True)
-
-    structure = parser.get_structure("structure", input_file)
-    for model in structure:
-        # print(f" Processing Model: {model.id}")
-        for chain in model:
-            if chain.id != target_chain_id:
-                continue
-
-            # print(f"  Found target chain: {chain.id}")
-            residue_bfactors = [np.mean([atom.get_bfactor() for atom in residue]) for residue in chain]
-            new_residue_bfactors = []
-            for i in range(len(residue_bfactors)):
-                start = max(0, i - residue_sliding_window // 2)
-                end = min(len(residue_bfactors), i + residue_sliding_window // 2 + 1)
-                new_bfactor_value = np.mean(residue_bfactors[start:end])
-                new_residue_bfactors.append(new_bfactor_value)
+def get_plddt_sliding_windows_mmcif(input_file, residue_sliding_windows, target_chain_id="PREY"):
+    """
+    Same as `get_plddt_sliding_window_mmcif`, but for several sliding windows at once: the model is parsed once and every missing
+    `_plddt_window_N.cif` file is written from the same per-residue pLDDT values. Returns a dictionary of sliding window -> mmCIF file.
+    """
 
-            # write the new B-factors back to the structure
-            for i, residue in enumerate(chain):
-                for atom in residue:
-                    atom.set_bfactor(new_residue_bfactors[i])
+    output_files = {window: get_plddt_sliding_window_file(input_file, window) for window in residue_sliding_windows}
+    missing_windows = [window for window, output_file in output_files.items() if not os.path.exists(output_file)]
+    if len(missing_windows) == 0:
+        # print(f"Output files {output_files} already exist. Skipping modification.")
+        return output_files
 
-    print(f"Writing structure with new pLDDT scores to {output_file}", flush=True)
-    io = MMCIFIO()
-    io.set_structure(structure)
-    io.save(output_file)
+    # only the _atom_site loop is parsed, and only the B_iso_or_equiv column of the target chain is rewritten
+    atoms = read_atom_site(input_file)
+    residue_bfactors, chain_mask = get_residue_plddts(atoms, target_chain_id)
+    for window in missing_windows:
+        new_residue_bfactors = sliding_window_mean(residue_bfactors, window)
+        print(f"Writing structure with new pLDDT scores to {output_files[window]}", flush=True)
+        write_atom_site_bfactors(input_file, output_files[window], new_residue_bfactors[atoms["residue_index"][chain_mask]], rows=atoms["row"][chain_mask])
 
-    return output_file
+    return output_files
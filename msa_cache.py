@@ -0,0 +1,211 @@
+"""
+Sequence-keyed cache of the AF3 data pipeline results (MSAs and templates), so the data pipeline runs once per unique protein chain instead of once per chain per job
+(in a pulldown screen the bait chain is the same in every job, and in the complex pipeline every chain is part of many combinations).
+
+Two-phase mode, over all AF3 input folders of the current config file:
+1. `python msa_cache.py prepare` writes a single-chain data pipeline input for every protein sequence that is not cached yet to `<msa cache>/data_pipeline_input/`,
+   and a run script `<msa cache>/RUN_DATA_PIPELINE.sh` that runs only the AF3 data pipeline on them (`--norun_inference`, no GPU needed).
+2. `python msa_cache.py import` stores the `*_data.json` results of that run in the cache: `<msa cache>/<sha256 of the sequence>/` holds `unpaired.a3m`, `paired.a3m`,
+   the template structures (`template_<i>.cif`) and `templates.json` (their query and template residue indices).
+3. `python msa_cache.py inject` rewrites the job inputs to refer to the cached MSAs and templates (`unpairedMsaPath`, `pairedMsaPath` and `mmcifPath`, as mounted in the container),
+   and writes run scripts that mount the cache and skip the data pipeline (`--norun_data_pipeline`).
+
+The per-chain MSAs and templates do not depend on the other chains of a job (AF3 pairs the MSAs of the chains during featurisation), so they can be shared across jobs and screens.
+Only protein chains are cached; the cache does not track the genetic database versions, delete it after updating the databases.
+"""
+
+import os
+import json
+import glob
+import shutil
+import hashlib
+import argparse
+from constants import MSA_CACHE_FOLDER, GPU_COUNT
+from schedule_af3_jobs import MSA_CACHE_MOUNT, get_docker_command, get_run_script_files, schedule_folder
+
+DATA_PIPELINE_INPUT_FOLDER = "data_pipeline_input"
+DATA_PIPELINE_OUTPUT_FOLDER = "data_pipeline_output"
+DATA_PIPELINE_SCRIPT = "RUN_DATA_PIPELINE.sh"
+
+
+def clean_sequence(sequence):
+    return "".join(sequence.split()).upper()
+
+
+def get_sequence_hash(sequence):
+    return hashlib.sha256(clean_sequence(sequence).encode()).hexdigest()
+
+
+def get_entry_folder(sequence_hash, cache_folder=MSA_CACHE_FOLDER):
+    return os.path.join(cache_folder, sequence_hash)
+
+
+def is_cached(sequence_hash, cache_folder=MSA_CACHE_FOLDER):
+    # entries are complete once their folder exists, they are written to a temporary folder first
+    return os.path.isdir(get_entry_folder(sequence_hash, cache_folder))
+
+
+def get_protein_sequences(input_folders):
+    """
+    {sequence hash: sequence} of the unique protein chains of all `*_input.json` files in the input folders.
+    """
+
+    sequences = {}
+    for input_folder in input_folders:
+        for input_file in glob.glob(os.path.join(input_folder, "*_input.json")):
+            with open(input_file) as f:
+                af3_input = json.load(f)
+            for entity in af3_input["sequences"]:
+                if "protein" in entity:
+                    sequence = clean_sequence(entity["protein"]["sequence"])
+                    sequences.setdefault(get_sequence_hash(sequence), sequence)
+
+    return sequences
+
+
+def prepare_data_pipeline(input_folders, cache_folder=MSA_CACHE_FOLDER):
+    """
+    Phase 1: write a single-chain data pipeline input for every protein sequence of the input folders that is not cached, and the script that runs the data pipeline on them.
+    Returns the number of inputs written.
+    """
+
+    sequences = get_protein_sequences(input_folders)
+    missing = {sequence_hash: sequence for sequence_hash, sequence in sequences.items() if not is_cached(sequence_hash, cache_folder)}
+    print(f"{len(sequences)} unique protein chains, {len(sequences) - len(missing)} cached, {len(missing)} to run through the data pipeline", flush=True)
+
+    input_folder = os.path.join(cache_folder, DATA_PIPELINE_INPUT_FOLDER)
+    if os.path.exists(input_folder):
+        shutil.rmtree(input_folder)
+    os.makedirs(input_folder)
+    os.makedirs(os.path.join(cache_folder, DATA_PIPELINE_OUTPUT_FOLDER), exist_ok=True)
+    for sequence_hash, sequence in missing.items():
+        af3_input = {"name": f"msa_{sequence_hash}", "modelSeeds": [1], "sequences": [{"protein": {"id": "A", "sequence": sequence}}], "dialect": "alphafold3", "version": 3}
+        with open(os.path.join(input_folder, f"msa_{sequence_hash}_input.json"), "w") as f:
+            json.dump(af3_input, f)
+
+    bash_script_file = os.path.join(cache_folder, DATA_PIPELINE_SCRIPT)
+    with open(bash_script_file, "w") as f:
+        f.write(get_docker_command(input_folder, os.path.join(cache_folder, DATA_PIPELINE_OUTPUT_FOLDER), "af3_data_pipeline", run_inference=False))
+    if missing:
+        print(f"Run {bash_script_file}, then `python msa_cache.py import`", flush=True)
+
+    return len(missing)
+
+
+def _write_entry(protein, cache_folder):
+    # write the MSAs and templates of a data pipeline result to a temporary folder, then move it into place
+    sequence_hash = get_sequence_hash(protein["sequence"])
+    entry_folder = get_entry_folder(sequence_hash, cache_folder)
+    temp_folder = f"{entry_folder}.{os.getpid()}.tmp"
+    if os.path.exists(temp_folder):
+        shutil.rmtree(temp_folder)
+    os.makedirs(temp_folder)
+
+    with open(os.path.join(temp_folder, "unpaired.a3m"), "w") as f:
+        f.write(protein.get("unpairedMsa") or "")
+    with open(os.path.join(temp_folder, "paired.a3m"), "w") as f:
+        f.write(protein.get("pairedMsa") or "")
+    templates = []
+    for i, template in enumerate(protein.get("templates") or []):
+        mmcif_file = f"template_{i}.cif"
+        with open(os.path.join(temp_folder, mmcif_file), "w") as f:
+            f.write(template["mmcif"])
+        templates.append({"mmcifFile": mmcif_file, "queryIndices": template["queryIndices"], "templateIndices": template["templateIndices"]})
+    with open(os.path.join(temp_folder, "templates.json"), "w") as f:
+        json.dump(templates, f)
+
+    if os.path.exists(entry_folder):
+        shutil.rmtree(entry_folder)
+    os.replace(temp_folder, entry_folder)
+
+
+def import_data_pipeline(cache_folder=MSA_CACHE_FOLDER):
+    """
+    Phase 2: store the protein chains of the data pipeline results (`<output folder>/<job>/<job>_data.json`) in the cache.
+    Imported job folders are removed, their content is in the cache. Returns the number of imported chains.
+    """
+
+    imported = 0
+    output_folder = os.path.join(cache_folder, DATA_PIPELINE_OUTPUT_FOLDER)
+    for data_file in sorted(glob.glob(os.path.join(output_folder, "*", "*_data.json"))):
+        with open(data_file) as f:
+            af3_data = json.load(f)
+        for entity in af3_data["sequences"]:
+            if "protein" in entity:
+                _write_entry(entity["protein"], cache_folder)
+                imported += 1
+        shutil.rmtree(os.path.dirname(data_file))
+
+    print(f"Imported {imported} protein chains into {cache_folder}", flush=True)
+    return imported
+
+
+def inject_cached_msas(af3_input, cache_folder=MSA_CACHE_FOLDER):
+    """
+    Make the protein chains of an AF3 input refer to their cached MSAs and templates (paths as mounted in the container). Returns the sequences of the chains that are not cached.
+    """
+
+    missing_sequences = []
+    for entity in af3_input["sequences"]:
+        if "protein" not in entity:
+            continue
+        protein = entity["protein"]
+        sequence_hash = get_sequence_hash(protein["sequence"])
+        if not is_cached(sequence_hash, cache_folder):
+            missing_sequences.append(protein["sequence"])
+            continue
+
+        with open(os.path.join(get_entry_folder(sequence_hash, cache_folder), "templates.json")) as f:
+            templates = json.load(f)
+        mount_folder = f"{MSA_CACHE_MOUNT}/{sequence_hash}"
+        for key in ["unpairedMsa", "pairedMsa"]:
+            protein.pop(key, None)
+        protein["unpairedMsaPath"] = f"{mount_folder}/unpaired.a3m"
+        protein["pairedMsaPath"] = f"{mount_folder}/paired.a3m"
+        protein["templates"] = [
+            {"mmcifPath": f"{mount_folder}/{template['mmcifFile']}", "queryIndices": template["queryIndices"], "templateIndices": template["templateIndices"]} for template in templates
+        ]
+
+    return missing_sequences
+
+
+def inject_folder(input_folder, bash_script_file, cache_folder=MSA_CACHE_FOLDER, gpu_count=GPU_COUNT):
+    """
+    Phase 3: rewrite the job inputs of a folder to use the cached MSAs and templates, and write its inference-only run script.
+    Raises a RuntimeError (before rewriting anything) if a protein chain is not cached.
+    """
+
+    input_files = sorted(glob.glob(os.path.join(input_folder, "*_input.json")))
+    af3_inputs = []
+    missing_sequences = set()
+    for input_file in input_files:
+        with open(input_file) as f:
+            af3_input = json.load(f)
+        missing_sequences.update(inject_cached_msas(af3_input, cache_folder))
+        af3_inputs.append(af3_input)
+
+    if missing_sequences:
+        raise RuntimeError(f"{len(missing_sequences)} protein chains of {input_folder} are not in the MSA cache, run `python msa_cache.py prepare` and the data pipeline first")
+
+    for input_file, af3_input in zip(input_files, af3_inputs):
+        with open(input_file + ".tmp", "w") as f:
+            f.write(json.dumps(af3_input, separators=(",", ":")))
+        os.replace(input_file + ".tmp", input_file)
+    print(f"Injected cached MSAs into {len(input_files)} inputs of {input_folder}", flush=True)
+
+    schedule_folder(input_folder, bash_script_file, gpu_count, msa_cache_folder=cache_folder)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the AF3 data pipeline once per unique protein chain and reuse the cached MSAs and templates in every job")
+    parser.add_argument("phase", choices=["prepare", "import", "inject"], help="prepare: write the data pipeline inputs of uncached chains, import: store the data pipeline results, inject: write inference-only inputs")
+    args = parser.parse_args()
+
+    run_script_files = get_run_script_files()
+    if args.phase == "prepare":
+        prepare_data_pipeline(run_script_files.keys())
+    elif args.phase == "import":
+        import_data_pipeline()
+    else:
+        for folder, bash_script_file in run_script_files.items():
+            inject_folder(folder, bash_script_file)
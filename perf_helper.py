@@ -0,0 +1,268 @@
+"""
+Optional performance instrumentation of the analysis stages (enabled with `perf_report` in the config file), to size `process_count` and find pathological models.
+
+`measure(stage, item)` (a context manager) and `instrumented(stage)` (a decorator, the item is the first argument) record, for every stage pass over a folder
+and every model or prediction: the wall time, the CPU time (of the process and of the subprocesses it waited for), the peak RSS, the bytes read and the time spent
+in subprocesses (ChimeraX, run through `run_subprocess`). Every process appends its records to `output_perf/records/<run id>/<pid>.jsonl`, so pool workers need no
+coordination, and `write_perf_report()` aggregates the records of the run into `output_perf/<run id>.json` (per stage totals and the slowest items), `.csv`
+(one row per record) and, with `perf_prometheus`, a Prometheus text format snapshot `.prom`. The run id is shared through the BULKAF3_PERF_RUN environment
+variable, so all stages started by run_pipeline.py write one report. Long-running processes (the watcher) start a new run after every report (`start_perf_run`),
+so the cost of a report does not grow with their uptime.
+
+Peak RSS and bytes read come from /proc (Linux); elsewhere the peak RSS is the process lifetime peak and the bytes read are not recorded.
+"""
+
+import os
+import csv
+import json
+import time
+import resource
+import functools
+import subprocess
+from contextlib import contextmanager
+
+try:
+    from constants import PERF_REPORT, PERF_PROMETHEUS
+except FileNotFoundError:
+    # standalone tools (e.g. `python calculate_clashes.py <model> <reference>`) also run without a config file
+    PERF_REPORT, PERF_PROMETHEUS = False, False
+
+PERF_FOLDER = "output_perf/"
+RUN_ENVIRONMENT_VARIABLE = "BULKAF3_PERF_RUN"
+RECORD_COLUMNS = ["stage", "item", "level", "pid", "start", "wall_seconds", "cpu_seconds", "subprocess_seconds", "peak_rss_mb", "read_mb", "error"]
+SLOWEST_ITEMS = 20
+
+_subprocess_seconds = 0.0
+_depth = 0
+_run_count = 0
+
+
+def get_run_id():
+    # set once by the first process of a run, inherited by pool workers and the stages started by run_pipeline.py
+    return os.environ.setdefault(RUN_ENVIRONMENT_VARIABLE, f"{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}")
+
+
+if PERF_REPORT:
+    # before any pool is started, so the workers record into the run of their parent
+    get_run_id()
+
+
+def start_perf_run():
+    """
+    Start a new run: the following records go into a new report. Pool workers keep the run id they were started with, start new pools after this.
+    """
+
+    global _run_count
+    if PERF_REPORT:
+        # numbered, so runs started within the same second get distinct ids
+        _run_count += 1
+        os.environ[RUN_ENVIRONMENT_VARIABLE] = f"{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}_{_run_count}"
+
+
+def _read_proc_status(key):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(key + ":"):
+                    return int(line.split()[1]) / 1024  # kB
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _reset_peak_rss():
+    # resets the VmHWM of the process to its current RSS (Linux), so the peak of the measured call is recorded instead of the process lifetime peak
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _read_bytes():
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _cpu_seconds():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def _write_record(record):
+    records_folder = os.path.join(PERF_FOLDER, "records", get_run_id())
+    os.makedirs(records_folder, exist_ok=True)
+    with open(os.path.join(records_folder, f"{os.getpid()}.jsonl"), "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+@contextmanager
+def measure(stage, item, level="item"):
+    """
+    Record the performance of the enclosed code as `item` (e.g. a model file) of `stage` ("stage" level records are whole passes over a folder).
+    Does nothing unless `perf_report` is enabled. Exceptions are recorded and re-raised.
+    """
+
+    global _depth
+    if not PERF_REPORT:
+        yield
+        return
+
+    if _depth == 0:
+        _reset_peak_rss()
+    _depth += 1
+    start, wall_start, cpu_start, read_start, subprocess_start = time.time(), time.perf_counter(), _cpu_seconds(), _read_bytes(), _subprocess_seconds
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        _depth -= 1
+        read_end = _read_bytes()
+        _write_record(
+            {
+                "stage": stage,
+                "item": str(item),
+                "level": level,
+                "pid": os.getpid(),
+                "start": round(start, 3),
+                "wall_seconds": round(time.perf_counter() - wall_start, 4),
+                "cpu_seconds": round(_cpu_seconds() - cpu_start, 4),
+                "subprocess_seconds": round(_subprocess_seconds - subprocess_start, 4),
+                "peak_rss_mb": round(_read_proc_status("VmHWM"), 1),
+                "read_mb": round((read_end - read_start) / 2**20, 3) if read_start is not None and read_end is not None else None,
+                "error": error,
+            }
+        )
+
+
+def _get_item_name(value):
+    # batches of models are named by their first model
+    if isinstance(value, (list, tuple)):
+        return f"{value[0]} (+{len(value) - 1} more)" if value else "empty batch"
+    return str(value)
+
+
+def instrumented(stage):
+    """
+    Decorator recording every call of a function as an item of `stage`, named by the function's first argument (e.g. the model file).
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with measure(stage, _get_item_name(args[0]) if args else function.__name__):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def run_subprocess(*args, **kwargs):
+    """
+    `subprocess.run`, with the time spent in the subprocess added to the measured calls.
+    """
+
+    global _subprocess_seconds
+    start = time.perf_counter()
+    try:
+        return subprocess.run(*args, **kwargs)
+    finally:
+        _subprocess_seconds += time.perf_counter() - start
+
+
+def load_records(run_id=None):
+    records_folder = os.path.join(PERF_FOLDER, "records", run_id or get_run_id())
+    records = []
+    if os.path.isdir(records_folder):
+        for records_file in sorted(os.listdir(records_folder)):
+            with open(os.path.join(records_folder, records_file)) as f:
+                records.extend(json.loads(line) for line in f if line.strip())
+    return sorted(records, key=lambda record: record["start"])
+
+
+def summarize_records(records):
+    """
+    Per stage and level: number of records, total/mean/max wall time, total CPU and subprocess time, max peak RSS, total bytes read, number of errors.
+    """
+
+    summary = {}
+    for record in records:
+        entry = summary.setdefault(
+            f"{record['stage']}:{record['level']}",
+            {"stage": record["stage"], "level": record["level"], "count": 0, "wall_seconds": 0.0, "max_wall_seconds": 0.0, "cpu_seconds": 0.0, "subprocess_seconds": 0.0, "peak_rss_mb": 0.0, "read_mb": 0.0, "errors": 0},
+        )
+        entry["count"] += 1
+        entry["wall_seconds"] += record["wall_seconds"]
+        entry["max_wall_seconds"] = max(entry["max_wall_seconds"], record["wall_seconds"])
+        entry["cpu_seconds"] += record["cpu_seconds"]
+        entry["subprocess_seconds"] += record["subprocess_seconds"]
+        entry["peak_rss_mb"] = max(entry["peak_rss_mb"], record["peak_rss_mb"])
+        entry["read_mb"] += record["read_mb"] or 0.0
+        entry["errors"] += record["error"] is not None
+
+    for entry in summary.values():
+        entry["mean_wall_seconds"] = entry["wall_seconds"] / entry["count"]
+        # CPU time per wall second: close to 1 for CPU-bound items, lower for I/O or subprocess waits
+        entry["cpu_utilization"] = entry["cpu_seconds"] / entry["wall_seconds"] if entry["wall_seconds"] > 0 else None
+    return list(summary.values())
+
+
+def get_prometheus_snapshot(summary):
+    metrics = [
+        ("wall_seconds", "bulkaf3_wall_seconds_total", "Total wall time of the measured items", "counter"),
+        ("cpu_seconds", "bulkaf3_cpu_seconds_total", "Total CPU time of the measured items, including waited subprocesses", "counter"),
+        ("subprocess_seconds", "bulkaf3_subprocess_seconds_total", "Total time spent in subprocesses (ChimeraX)", "counter"),
+        ("read_mb", "bulkaf3_read_megabytes_total", "Total megabytes read by the measured items", "counter"),
+        ("count", "bulkaf3_items_total", "Number of measured items", "counter"),
+        ("errors", "bulkaf3_errors_total", "Number of measured items that raised an exception", "counter"),
+        ("max_wall_seconds", "bulkaf3_max_wall_seconds", "Wall time of the slowest measured item", "gauge"),
+        ("peak_rss_mb", "bulkaf3_peak_rss_megabytes", "Peak resident set size of the measured items", "gauge"),
+    ]
+    lines = []
+    for key, name, description, metric_type in metrics:
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for entry in summary:
+            lines.append(f'{name}{{stage="{entry["stage"]}",level="{entry["level"]}"}} {entry[key]}')
+    return "\n".join(lines) + "\n"
+
+
+def write_perf_report(run_id=None):
+    """
+    Aggregate the records of a run (the current one by default) into the JSON, CSV and (with `perf_prometheus`) Prometheus report files.
+    Does nothing unless `perf_report` is enabled, or if the run has no records (e.g. a watcher run in which nothing was analyzed).
+    """
+
+    if not PERF_REPORT:
+        return
+
+    run_id = run_id or get_run_id()
+    records = load_records(run_id)
+    if not records:
+        return
+    summary = summarize_records(records)
+    item_records = [record for record in records if record["level"] == "item"]
+    slowest = sorted(item_records, key=lambda record: record["wall_seconds"], reverse=True)[:SLOWEST_ITEMS]
+
+    report_file = os.path.join(PERF_FOLDER, run_id)
+    with open(report_file + ".json", "w") as f:
+        json.dump({"run": run_id, "summary": summary, "slowest_items": slowest, "records": records}, f, indent=2)
+    with open(report_file + ".csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=RECORD_COLUMNS)
+        writer.writeheader()
+        writer.writerows(records)
+    if PERF_PROMETHEUS:
+        with open(report_file + ".prom", "w") as f:
+            f.write(get_prometheus_snapshot(summary))
+
+    print(f"Wrote the performance report of {len(records)} measurements to {report_file}.json", flush=True)
@@ -0,0 +1,157 @@
+"""
+Virtual smoothed pLDDT layer: instead of writing a `_plddt_window_N.cif` copy of every model for every sliding window,
+the smoothed per-residue pLDDT of each model and window is kept in one compact sidecar store per screen folder
+(`<screen folder>/plddt_windows.npz`, one float32 array per model per window), and the analysis backends apply the pLDDT mask in memory.
+
+Store keys include the fingerprint (size and modification time) of the model, so the smoothed pLDDT of a re-predicted or rewritten model is computed again,
+and its superseded entries are dropped from the store when the new ones are added.
+"""
+
+import os
+import fcntl
+import zipfile
+import numpy as np
+from mmcif_helper import read_atom_site
+from screen_archive import get_archive_member
+from modify_mmcif_plddt import get_residue_plddts, sliding_window_mean
+
+PLDDT_STORE_FILE = "plddt_windows.npz"
+
+# opened stores, cached per process and keyed by (store file, size, mtime) so appended entries are picked up
+_store_cache = {}
+
+
+def get_plddt_store_file(model_file):
+    """
+    The sidecar store of the screen folder that a sample model file belongs to (<screen folder>/<prediction>/<seed-X_sample-Y>/<model file>).
+    """
+
+    return os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(model_file)))), PLDDT_STORE_FILE)
+
+
+def _get_model_fingerprint(model_file):
+    # size and modification time, as in `result_cache.get_fingerprint` (models of archived screens keep the ones they had on disk)
+    if not os.path.exists(model_file):
+        member = get_archive_member(model_file)
+        if member is not None:
+            return f"{member['size']}_{member['mtime_ns']}"
+    stat = os.stat(model_file)
+    return f"{stat.st_size}_{stat.st_mtime_ns}"
+
+
+def _get_key_prefix(key):
+    # the key without the model fingerprint: `<model path>/window_N/`
+    return key.rsplit("/", 1)[0] + "/"
+
+
+def get_plddt_store_key(model_file, residue_sliding_window):
+    screen_folder = os.path.dirname(get_plddt_store_file(model_file))
+    return f"{os.path.relpath(os.path.abspath(model_file), screen_folder)}/window_{residue_sliding_window}/{_get_model_fingerprint(model_file)}"
+
+
+def _open_store(store_file):
+    """
+    Returns (opened store, set of its keys), or (None, empty set) if the store does not exist yet.
+    """
+    if not os.path.exists(store_file):
+        return None, set()
+
+    stat = os.stat(store_file)
+    key = (store_file, stat.st_size, stat.st_mtime_ns)
+    if key not in _store_cache:
+        for cached_key in [cached_key for cached_key in _store_cache if cached_key[0] == store_file]:
+            _store_cache.pop(cached_key)[0].close()
+        store = np.load(store_file)
+        _store_cache[key] = (store, set(store.files))
+    return _store_cache[key]
+
+
+def get_missing_plddt_windows(model_file, residue_sliding_windows):
+    _, store_keys = _open_store(get_plddt_store_file(model_file))
+    return [window for window in residue_sliding_windows if window > 1 and get_plddt_store_key(model_file, window) not in store_keys]
+
+
+def compute_smoothed_plddts(model_file, residue_sliding_windows, target_chain_id="PREY"):
+    """
+    Parse a model once and compute the smoothed per-residue pLDDT of the target chain for each sliding window.
+    Values are rounded to 2 decimals, as they would be in a `_plddt_window_N.cif` file. Returns a dictionary of store key -> array.
+    """
+
+    atoms = read_atom_site(model_file)
+    residue_bfactors, _ = get_residue_plddts(atoms, target_chain_id)
+    return {get_plddt_store_key(model_file, window): np.round(sliding_window_mean(residue_bfactors, window), 2).astype(np.float32) for window in residue_sliding_windows}
+
+
+def _rewrite_store(store_file, superseded_keys):
+    # copy the store without the superseded entries (of models that changed since), written to a temporary file first
+    temp_file = f"{store_file}.{os.getpid()}.tmp"
+    with zipfile.ZipFile(store_file) as store, zipfile.ZipFile(temp_file, "w") as new_store:
+        for info in store.infolist():
+            if info.filename not in superseded_keys:
+                new_store.writestr(info, store.read(info.filename))
+    os.replace(temp_file, store_file)
+
+
+def update_plddt_store(store_file, entries):
+    """
+    Add new arrays (store key -> array) to a sidecar store, skipping keys that are already present.
+    The entries of the same models and windows with another model fingerprint are removed from the store.
+    """
+
+    if len(entries) == 0:
+        return
+
+    # the screen folder of an archived screen may not exist
+    os.makedirs(os.path.dirname(store_file), exist_ok=True)
+    # stages can run concurrently, so only one process appends to the store at a time
+    with open(store_file + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(store_file):
+            new_prefixes = {_get_key_prefix(key) for key in entries}
+            with zipfile.ZipFile(store_file) as store:
+                existing_keys = set(store.namelist())
+            superseded_keys = set()
+            for name in existing_keys:
+                key = name[: -len(".npy")]
+                # keys written before the fingerprint was part of the key are `<model path>/window_N`
+                if key not in entries and (_get_key_prefix(key) in new_prefixes or key + "/" in new_prefixes):
+                    superseded_keys.add(name)
+            if superseded_keys:
+                _rewrite_store(store_file, superseded_keys)
+
+        with zipfile.ZipFile(store_file, "a") as store:
+            existing_keys = set(store.namelist())
+            for key, array in entries.items():
+                if key + ".npy" in existing_keys:
+                    continue
+                with store.open(key + ".npy", "w", force_zip64=True) as f:
+                    np.lib.format.write_array(f, np.asarray(array), allow_pickle=False)
+
+
+def load_smoothed_plddt(model_file, residue_sliding_window, target_chain_id="PREY"):
+    """
+    Get the smoothed per-residue pLDDT of a model for a sliding window from the sidecar store, computing it in memory if it is not stored yet.
+    """
+
+    store, store_keys = _open_store(get_plddt_store_file(model_file))
+    key = get_plddt_store_key(model_file, residue_sliding_window)
+    if key in store_keys:
+        return store[key]
+
+    return compute_smoothed_plddts(model_file, [residue_sliding_window], target_chain_id)[key]
+
+
+def get_atom_plddts(atoms, model_file, residue_sliding_window=None, target_chain_id="PREY"):
+    """
+    Per-atom pLDDT used for masking low confidence atoms: the B-factors of the model, with the atoms of the target chain set to the smoothed
+    per-residue pLDDT of the sliding window (as in the `_plddt_window_N.cif` files). No smoothing is applied for windows <= 1 or None.
+    """
+
+    if residue_sliding_window is None or residue_sliding_window <= 1:
+        return atoms["bfactor"]
+
+    smoothed_plddt = load_smoothed_plddt(model_file, residue_sliding_window, target_chain_id)
+    chain_mask = atoms["chain"] == target_chain_id
+    atom_plddts = atoms["bfactor"].copy()
+    atom_plddts[chain_mask] = smoothed_plddt[atoms["residue_index"][chain_mask]]
+    return atom_plddts
@@ -5,15 +5,23 @@ Note, unlike other scripts, this script currently has to be manually changed to
 import os
 import re
 import copy
-import requests
 import shutil
 import json
+import pandas as pd
 from multiprocessing import Pool
+from uniprot_cache import get_uniprot_details_batch
+from confidences_helper import read_atom_plddts, get_chain_means
+from screen_index import load_screen_index, get_sample_files, get_prediction_fingerprint
+from screen_archive import open_screen_file
+from result_cache import load_result_cache, get_cached_results, update_result_cache, merge_cached_results
+from perf_helper import instrumented, measure, write_perf_report
 from constants import CURRENT_PIPELINE
 assert CURRENT_PIPELINE == "pulldown", "This script is only for the pulldown pipeline"
-from constants import PREDICTION_THRESHOLD_METRIC, PREDICTION_THRESHOLD_METRIC_VALUE, FOLDERS, PROCESS_COUNT
+from constants import PREDICTION_THRESHOLD_METRIC, PREDICTION_THRESHOLD_METRIC_VALUE, FOLDERS, PROCESS_COUNT, USE_RESULTS_STORE
+from results_store import write_stage, get_superfolder
 
 RESULTS_ROOT_FOLDER = "output_raw_results/"
+RESULTS_COLUMNS = ["model", "fasta", "seed", "sample", "uniprot link", "ipTM", "pTM", "pLDDT", "prey pLDDT", "bait pLDDT"]
 PRINT_CANDIDATE_RESULTS = True
 # TODO: need to implement for AF3
 # CREATE_REFINED_RUN_SCRIPT = False
@@ -23,8 +31,20 @@ PRINT_CANDIDATE_RESULTS = True
 def process_folder(folder, results_csv):
     results = []
 
-    with Pool(processes=PROCESS_COUNT) as pool:
-        results = pool.map(process_model_directory, [os.path.join(folder, file) for file in os.listdir(folder) if os.path.isdir(os.path.join(folder, file))])
+    index = load_screen_index(folder)
+    predictions = {os.path.join(folder, name): prediction for name, prediction in index["predictions"].items()}
+    model_directories = list(predictions.keys())
+    fingerprints = {model_directory: get_prediction_fingerprint(prediction) for model_directory, prediction in predictions.items()}
+
+    # only process predictions that are new or changed since the last run
+    cache = load_result_cache("process_results", folder, {})
+    cached_results, missing_directories = get_cached_results(cache, model_directories, fingerprints)
+
+    with measure("process_results", folder, level="stage"), Pool(processes=PROCESS_COUNT) as pool:
+        new_results = pool.starmap(process_model_directory, [(model_directory, predictions[model_directory]) for model_directory in missing_directories])
+
+    update_result_cache(cache, missing_directories, new_results, is_valid=lambda result: len(result[1]) > 0, fingerprints=fingerprints)
+    results = merge_cached_results(model_directories, cached_results, missing_directories, new_results)
 
     results_sorted = copy.deepcopy(results)
     results_sorted.sort(key=lambda result: max(prediction[PREDICTION_THRESHOLD_METRIC] for prediction in result[1]), reverse=True)
@@ -42,16 +62,10 @@ def process_folder(folder, results_csv):
         print(f"UNIPROT LINK: https://www.uniprot.org/uniprotkb/{uniprot_id}/entry")
 
     with open(results_csv, "w") as f:
-        f.write("model,fasta,seed,sample,uniprot link,ipTM,pTM,pLDDT,prey pLDDT,bait pLDDT\n")
+        f.write(",".join(RESULTS_COLUMNS) + "\n")
         for result in results_sorted:
-            uniprot_id = result[0].split("/")[1].split("_")[0]
-            # uniprot edge case
-            if len(uniprot_id) == 2:
-                uniprot_id = result[0].split("/")[1].split("_")[1]
-            for prediction in result[1]:
-                f.write(
-                    f'{prediction["model"]},{result[0]}.fasta,{prediction["seed"]},{prediction["sample"]},https://www.uniprot.org/uniprotkb/{uniprot_id}/entry,{prediction["ipTM"]},{prediction["pTM"]},{prediction["pLDDT"]},{prediction["bait pLDDT"]},{prediction["prey pLDDT"]}\n'
-                )
+            for row in get_result_rows(result):
+                f.write(",".join(str(value) for value in row) + "\n")
 
     # if PRINT_CANDIDATE_RESULTS:
     #     print(f"\n\n\n\n=================== CANDIDATE RESULTS ({PREDICTION_THRESHOLD_METRIC} > {PREDICTION_THRESHOLD_METRIC_VALUE}) ===================")
@@ -65,48 +79,49 @@ def process_folder(folder, results_csv):
     #         print(f"Full result details: {result}\n")
 
 
-def process_model_directory(model_path):
+@instrumented("process_results")
+def process_model_directory(model_path, prediction=None):
+    """
+    Get the scores of every seed/sample of a prediction folder. `prediction` is the folder's entry in the screen index (loaded from the index if not given).
+    """
     print(f"Processing {model_path}...", flush=True)
     model_scores = []
-
-    for seed in os.listdir(model_path):
-        if not seed.startswith("seed-"):
+    folder, prediction_name = os.path.split(os.path.normpath(model_path))
+    if prediction is None:
+        prediction = load_screen_index(folder)["predictions"][prediction_name]
+
+    for seed_folder, sample_entry in prediction["samples"].items():
+        seed_path = os.path.join(model_path, seed_folder)
+        full_seed_match = re.search(r"seed-(\d+)_sample-(\d+)", seed_folder)
+        if full_seed_match is None:
             continue
-        seed_path = os.path.join(model_path, seed)
-        if not os.path.isdir(seed_path):
-            continue
-
-        full_seed_match = re.search(r"seed-(\d+)_sample-(\d+)", seed)
         seed = full_seed_match.group(1)
         sample = full_seed_match.group(2)
 
-        confidence_file = [f for f in os.listdir(seed_path) if f.endswith("confidences.json")]
-        if len(confidence_file) == 0:
+        sample_files = get_sample_files(folder, prediction_name, seed_folder, sample_entry)
+        if sample_files["confidences"] is None:
             print(f"Warning: No confidences.json found in {seed_path}. Skipping this seed.")
             continue
 
-        confidence_json_data = json.load(open(os.path.join(seed_path, confidence_file[0])))
-        plddt = sum(confidence_json_data["atom_plddts"]) / len(confidence_json_data["atom_plddts"]) / 100.0
-        assert len(confidence_json_data["atom_chain_ids"]) == len(
-            confidence_json_data["atom_plddts"]
-        ), f"Length of atom_chain_ids ({len(confidence_json_data['atom_chain_ids'])}) does not match length of atom_plddts ({len(confidence_json_data['atom_plddts'])}) in {confidence_file[0]}"
-        chain_id_and_pLDDT = list(zip(confidence_json_data["atom_chain_ids"], confidence_json_data["atom_plddts"]))
-        bait_pLDDT_scores = [score for chain_id, score in chain_id_and_pLDDT if chain_id == "BAIT"]
-        prey_pLDDT_scores = [score for chain_id, score in chain_id_and_pLDDT if chain_id == "PREY"]
-        assert len(bait_pLDDT_scores) + len(prey_pLDDT_scores) == len(
-            confidence_json_data["atom_plddts"]
-        ), f"Length of bait_pLDDT_scores ({len(bait_pLDDT_scores)}) + length of prey_pLDDT_scores ({len(prey_pLDDT_scores)}) does not match length of atom_plddts ({len(confidence_json_data['atom_plddts'])}) in {confidence_file[0]}"
-        bait_pLDDT = sum(bait_pLDDT_scores) / len(bait_pLDDT_scores) / 100.0
-        prey_pLDDT = sum(prey_pLDDT_scores) / len(prey_pLDDT_scores) / 100.0
-
-        summary_confidences_file = [f for f in os.listdir(seed_path) if f.endswith("summary_confidences.json")]
-        if len(summary_confidences_file) == 0:
+        # only the per-atom pLDDTs are decoded, the PAE and contact probability matrices are skipped
+        atom_plddts, atom_chain_ids = read_atom_plddts(sample_files["confidences"])
+        plddt = float(atom_plddts.mean()) / 100.0
+        chain_pLDDTs = get_chain_means(atom_chain_ids, atom_plddts)
+        assert set(chain_pLDDTs.keys()) <= {"BAIT", "PREY"}, f"Unexpected chains {sorted(chain_pLDDTs.keys())} (expected BAIT and PREY) in {sample_files['confidences']}"
+        bait_pLDDT = chain_pLDDTs["BAIT"] / 100.0
+        prey_pLDDT = chain_pLDDTs["PREY"] / 100.0
+
+        if sample_files["summary_confidences"] is None:
             print(f"Warning: No summary_confidences.json found in {seed_path}. Skipping this seed.")
             continue
 
-        summary_confidences_json_data = json.load(open(os.path.join(seed_path, summary_confidences_file[0])))
+        with open_screen_file(sample_files["summary_confidences"]) as f:
+            summary_confidences_json_data = json.load(f)
 
-        seed_model_path = os.path.join(seed_path, [f for f in os.listdir(seed_path) if f.endswith(".cif")][0])
+        if sample_files["model"] is None:
+            print(f"Warning: No model.cif found in {seed_path}. Skipping this seed.")
+            continue
+        seed_model_path = sample_files["model"]
 
         model_scores.append(
             {
@@ -124,6 +139,21 @@ def process_model_directory(model_path):
     return model_path, model_scores
 
 
+def get_result_rows(result):
+    """
+    The rows (in the order of RESULTS_COLUMNS) of the results CSV for one (prediction folder, scores) result of `process_model_directory`.
+    """
+    uniprot_id = result[0].split("/")[1].split("_")[0]
+    # uniprot edge case
+    if len(uniprot_id) == 2:
+        uniprot_id = result[0].split("/")[1].split("_")[1]
+
+    return [
+        [prediction["model"], f"{result[0]}.fasta", prediction["seed"], prediction["sample"], f"https://www.uniprot.org/uniprotkb/{uniprot_id}/entry", prediction["ipTM"], prediction["pTM"], prediction["pLDDT"], prediction["bait pLDDT"], prediction["prey pLDDT"]]
+        for prediction in result[1]
+    ]
+
+
 def print_uniprot_details(uniprot_id):
     uniprot_details = get_uniprot_details(uniprot_id)
     if uniprot_details is not None:
@@ -136,34 +166,13 @@ def print_uniprot_details(uniprot_id):
 
 def get_uniprot_details(uniprot_id):
     """
-    Fetch details about a UniProt ID using the UniProt API.
+    Fetch details about a UniProt ID using the UniProt API (through the local UniProt cache, see `uniprot_cache.py`).
     Args:
         uniprot_id (str): The UniProt ID to fetch.
     Returns:
-        dict: The filtered details of the UniProt entry.
+        dict: The filtered details of the UniProt entry, or None if it could not be found or fetched.
     """
-    base_url = f"https://rest.uniprot.org/uniprotkb/{uniprot_id}"
-
-    try:
-        response = requests.get(base_url, headers={"Accept": "application/json"})
-        response.raise_for_status()  # Raise an error for HTTP errors
-        json = response.json()
-        id = json["uniProtkbId"]
-        try:
-            full_name = json["proteinDescription"]["recommendedName"]["fullName"]["value"]
-        except:
-            full_name = ""
-        if full_name == "":
-            try:
-                full_name = json["proteinDescription"]["submissionNames"][0]["fullName"]["value"]
-            except:
-                full_name = ""
-        organism = json["organism"]["scientificName"]
-
-        return {"id": id, "full_name": full_name, "organism": organism}
-    except requests.exceptions.RequestException as e:
-        # print(f"An error occurred: {e}")
-        return None
+    return get_uniprot_details_batch([uniprot_id])[uniprot_id]
 
 
 def archive_best_results(source_paths, destination_name):
@@ -206,3 +215,7 @@ if __name__ == "__main__":
         print(f"Processing {folder}", flush=True)
         results_csv = RESULTS_ROOT_FOLDER + folder + "_results.csv"
         process_folder(folder, results_csv)
+        if USE_RESULTS_STORE:
+            write_stage("raw_results", pd.read_csv(results_csv), get_superfolder(folder), folder)
+
+    write_perf_report()
@@ -0,0 +1,103 @@
+"""
+Incremental result cache shared by the analysis stages (process_results.py, get_binding_domain.py, calculate_all_clashes.py).
+
+For each stage and screen folder, a manifest in `output_cache/` maps every input (prediction folder or model file) to its fingerprint
+(size and modification time) and its computed result. The manifest file name includes a hash of the parameters the results depend on
+(e.g. DOMAINS_TO_RESIDUES, CLASHES_MODEL, the pLDDT sliding window), so changing them never reuses stale results.
+Only new or changed inputs are recomputed when a stage is run again.
+"""
+
+import os
+import json
+import hashlib
+from screen_archive import get_archive_member, screen_file_exists
+from screen_index import scan_prediction, get_prediction_fingerprint
+from constants import USE_RESULT_CACHE
+
+CACHE_FOLDER = "output_cache/"
+
+
+def get_fingerprint(path):
+    """
+    Size and modification time of a file. For a prediction folder, its fingerprint in the screen index (see `screen_index.get_prediction_fingerprint`),
+    so results are recomputed when a sample is added, removed or rewritten, but not when pLDDT sliding window files are written next to the models. Files of archived screens keep the size and modification time they had on disk.
+    """
+
+    if not os.path.exists(path):
+        member = get_archive_member(path)
+        if member is not None:
+            return [member["size"], member["mtime_ns"]]
+
+    stat = os.stat(path)
+    if not os.path.isdir(path):
+        return [stat.st_size, stat.st_mtime_ns]
+
+    return get_prediction_fingerprint(scan_prediction(path, stat.st_mtime_ns))
+
+
+def get_params_hash(params):
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def load_result_cache(stage, folder, params):
+    """
+    Load the cache manifest of a stage for a screen folder and a set of parameters (an empty cache if there is none, or if caching is disabled).
+    """
+
+    cache_file = os.path.join(CACHE_FOLDER, stage, f"{os.path.basename(os.path.normpath(folder))}_{get_params_hash(params)}.json")
+    entries = {}
+    if USE_RESULT_CACHE and os.path.exists(cache_file):
+        with open(cache_file) as f:
+            entries = json.load(f)["entries"]
+
+    return {"file": cache_file, "params": params, "entries": entries}
+
+
+def get_cached_results(cache, items, fingerprints=None):
+    """
+    Split the items (file or folder paths) into cached results (a dictionary of item -> result) whose fingerprint is unchanged, and the list of items to compute.
+    `fingerprints` (item -> fingerprint, e.g. from the screen index) avoids stat calls for items that were already stat'ed.
+    """
+
+    cached_results = {}
+    missing_items = []
+    for item in items:
+        entry = cache["entries"].get(item)
+        if entry is None:
+            missing_items.append(item)
+        elif entry["fingerprint"] == (fingerprints[item] if fingerprints else get_fingerprint(item) if screen_file_exists(item) else None):
+            cached_results[item] = entry["result"]
+        else:
+            missing_items.append(item)
+
+    print(f"Found {len(cached_results)} cached results, computing {len(missing_items)}", flush=True)
+    return cached_results, missing_items
+
+
+def update_result_cache(cache, items, results, is_valid=lambda result: True, fingerprints=None):
+    """
+    Add newly computed results to the cache and write the manifest. Results for which `is_valid` is False (e.g. failed calculations) are not cached.
+    """
+
+    if not USE_RESULT_CACHE:
+        return
+
+    for item, result in zip(items, results):
+        if is_valid(result):
+            cache["entries"][item] = {"fingerprint": fingerprints[item] if fingerprints else get_fingerprint(item), "result": result}
+
+    os.makedirs(os.path.dirname(cache["file"]), exist_ok=True)
+    temp_file = cache["file"] + ".tmp"
+    with open(temp_file, "w") as f:
+        json.dump({"params": cache["params"], "entries": cache["entries"]}, f, default=str)
+    os.replace(temp_file, cache["file"])
+
+
+def merge_cached_results(items, cached_results, computed_items, computed_results):
+    """
+    Results for all items, in the order of `items`, from the cached results and the newly computed ones.
+    """
+
+    results = dict(cached_results)
+    results.update(zip(computed_items, computed_results))
+    return [results[item] for item in items]
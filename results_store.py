@@ -0,0 +1,160 @@
+"""
+Optional typed columnar store (Parquet, requires `pip install pyarrow`) for the results passed between the pulldown analysis stages,
+as an alternative to re-reading and string-joining the per-stage CSV files.
+
+Every stage ("raw_results", "binding_domain", "clashes", "merged") is one dataset in `output_results_store/<stage>/`, partitioned as
+`superfolder=<superfolder>/folder=<folder>/window=<plddt sliding window>/` (the raw results do not depend on the sliding window and have no window partition).
+Rows carry a stable integer `prediction_key` derived from the model's screen folder, prediction folder and seed/sample folder, which does not depend on the
+sliding window suffix of the model file name, so stages are joined on this key instead of on the model path. Model paths are stored dictionary encoded.
+A partition is written at once by the batch stages (`write_stage`), or grows by one `part-<n>.parquet` file per batch of predictions appended by the watcher (`append_stage`).
+"""
+
+import os
+import glob
+import time
+import hashlib
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = None
+
+STORE_FOLDER = "output_results_store/"
+STAGES = ["raw_results", "binding_domain", "clashes", "merged"]
+PARTITION_FILE = "part-0.parquet"
+PARTITION_FILE_PATTERN = "part-*.parquet"
+PARTITION_COLUMNS = ["superfolder", "folder", "window"]
+
+
+def check_results_store():
+    if pa is None:
+        raise ImportError("use_results_store requires pyarrow, install it with `pip install pyarrow`")
+
+
+def get_prediction_key(model_file):
+    """
+    Stable signed 64-bit key of a model: a hash of `<screen folder>/<prediction folder>/<seed/sample folder>`, the same for every sliding window file of the model.
+    """
+
+    sample_folder = os.path.normpath(os.path.dirname(model_file)).replace(os.sep, "/")
+    key = "/".join(sample_folder.split("/")[-3:])
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little", signed=True)
+
+
+def add_prediction_keys(df):
+    """
+    Add the `prediction_key` column (from the `model` column) to a stage's results, hashing each unique model path once.
+    """
+
+    models = df["model"].astype("category")
+    keys = np.array([get_prediction_key(model) for model in models.cat.categories], dtype=np.int64)
+    df.insert(0, "prediction_key", keys[models.cat.codes.to_numpy()])
+    return df
+
+
+def get_superfolder(folder):
+    from constants import SUPERFOLDER_TO_FOLDER
+
+    for superfolder, folders in SUPERFOLDER_TO_FOLDER.items():
+        if folder in folders:
+            return superfolder
+    raise ValueError(f"Folder {folder} is not in any superfolder of superfolder_to_fasta_and_folder")
+
+
+def get_partition_folder(stage, superfolder, folder, window=None):
+    partition_folder = os.path.join(STORE_FOLDER, stage, f"superfolder={superfolder}", f"folder={folder}")
+    return partition_folder if window is None else os.path.join(partition_folder, f"window={window}")
+
+
+def _to_table(df):
+    df = df.copy()
+    if "prediction_key" not in df.columns:
+        df = add_prediction_keys(df)
+    df["model"] = df["model"].astype("category")
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def _write_partition_file(table, partition_folder, partition_file):
+    os.makedirs(partition_folder, exist_ok=True)
+    # hidden while it is written, so concurrent readers of the dataset do not pick it up
+    temp_file = os.path.join(partition_folder, f".{partition_file}.{os.getpid()}.tmp")
+    pq.write_table(table, temp_file, compression="zstd")
+    os.replace(temp_file, os.path.join(partition_folder, partition_file))
+
+
+def write_stage(stage, df, superfolder, folder, window=None):
+    """
+    Write (replace) the results of a stage for one screen folder and sliding window. A `prediction_key` column is added if missing.
+    """
+
+    check_results_store()
+    partition_folder = get_partition_folder(stage, superfolder, folder, window)
+    _write_partition_file(_to_table(df), partition_folder, PARTITION_FILE)
+    # rows appended by the watcher are part of the replaced results
+    for partition_file in glob.glob(os.path.join(partition_folder, PARTITION_FILE_PATTERN)):
+        if os.path.basename(partition_file) != PARTITION_FILE:
+            os.remove(partition_file)
+
+
+def append_stage(stage, df, superfolder, folder, window=None):
+    """
+    Append results of a stage for one screen folder and sliding window as a new partition file. Rows of the partition with the same prediction keys
+    (e.g. of a prediction that was rewritten and analyzed again) are removed first, so every prediction key has one set of rows.
+    """
+
+    check_results_store()
+    table = _to_table(df)
+    partition_folder = get_partition_folder(stage, superfolder, folder, window)
+    new_keys = pa.array(set(table.column("prediction_key").to_pylist()), type=pa.int64())
+    for partition_file in sorted(glob.glob(os.path.join(partition_folder, PARTITION_FILE_PATTERN))):
+        keys = pq.read_table(partition_file, columns=["prediction_key"]).column("prediction_key")
+        replaced = pc.is_in(keys, value_set=new_keys)
+        if not pc.any(replaced).as_py():
+            continue
+        kept_table = pq.read_table(partition_file).filter(pc.invert(replaced))
+        if kept_table.num_rows == 0:
+            os.remove(partition_file)
+        else:
+            _write_partition_file(kept_table, partition_folder, os.path.basename(partition_file))
+
+    _write_partition_file(table, partition_folder, f"part-{time.time_ns()}.parquet")
+
+
+def read_stage(stage, superfolder=None, folders=None, window=None, columns=None, prediction_keys=None):
+    """
+    Read the results of a stage, optionally only for a superfolder, a list of screen folders, a sliding window, a list of columns and a list of prediction keys.
+    Partition values (`superfolder`, `folder`, `window`) are only returned if they are requested in `columns`.
+    """
+
+    check_results_store()
+    stage_folder = os.path.join(STORE_FOLDER, stage)
+    if not os.path.exists(stage_folder):
+        raise FileNotFoundError(f"No {stage} results in {STORE_FOLDER}, run the {stage} stage with use_results_store enabled first")
+
+    dataset = ds.dataset(stage_folder, format="parquet", partitioning="hive")
+    # appended partition files can have other numeric types than the first file (e.g. integer areas of a single batch), read them with a common schema
+    schemas = [fragment.physical_schema for fragment in dataset.get_fragments()]
+    if any(not schema.equals(schemas[0]) for schema in schemas[1:]):
+        schema = pa.unify_schemas([dataset.schema] + schemas, promote_options="permissive")
+        dataset = ds.dataset(stage_folder, format="parquet", partitioning="hive", schema=schema)
+    if columns is None:
+        columns = [name for name in dataset.schema.names if name not in PARTITION_COLUMNS]
+    condition = None
+    filters = []
+    if superfolder is not None:
+        filters.append(ds.field("superfolder") == superfolder)
+    if folders is not None:
+        filters.append(ds.field("folder").isin(list(folders)))
+    if window is not None:
+        filters.append(ds.field("window") == window)
+    if prediction_keys is not None:
+        filters.append(ds.field("prediction_key").isin(list(prediction_keys)))
+    for expression in filters:
+        condition = expression if condition is None else condition & expression
+
+    table = dataset.to_table(columns=columns, filter=condition)
+    return table.to_pandas()
@@ -0,0 +1,235 @@
+"""
+Single entry point that runs the stages of the pipeline of a config file in dependency order, instead of running every script by hand.
+
+Pulldown stages (each runs its script with the config file passed through the BULKAF3_CONFIG environment variable):
+    generate_inputs (bulkalphafold3.py) -> process_results, sliding_window (files_helper.py) -> binding_domain, clashes -> merge -> analyze
+The AF3 predictions themselves run between generate_inputs and the analysis stages (run the generated scripts, then this again).
+Stages whose dependencies are done run concurrently (binding_domain and clashes both only need the sliding window model files).
+
+A stage is skipped if it is fresh: its outputs and its completion stamp (`output_cache/pipeline/<config name>/<stage>.json`) are newer than the config file,
+its input files, the predictions of the screen folders (the modification times in the screen index) and the stamps of the stages it depends on.
+The complex pipeline only has the generate_inputs stage (generate_protein_complex_combinations.py).
+
+Usage: `python run_pipeline.py <config file> [--stages STAGE ...] [--force] [--dry-run]`
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+CONFIG_ENVIRONMENT_VARIABLE = "BULKAF3_CONFIG"
+STAMP_FOLDER = "output_cache/pipeline/"
+SCRIPT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+
+def get_stages():
+    """
+    The stages of the pipeline of the current config file ({stage: {"script", "depends", "inputs", "screens", "outputs"}}), in dependency order.
+    `inputs` are files the stage reads, `screens` whether it reads the predictions of the screen folders, and `outputs` the files it writes.
+    """
+
+    from constants import CONFIG_FILE, CURRENT_PIPELINE, TEMPLATE_FILE
+
+    if CURRENT_PIPELINE == "complex":
+        from constants import INPUT_FASTA, OUTPUT_FOLDER
+
+        return {
+            "generate_inputs": {
+                "script": "generate_protein_complex_combinations.py",
+                "depends": [],
+                "inputs": [CONFIG_FILE, INPUT_FASTA, TEMPLATE_FILE],
+                "screens": False,
+                "outputs": [f"{OUTPUT_FOLDER}/run_alphafold3.sh"],
+            }
+        }
+
+    from constants import BAIT_FILENAME, FASTA_FILES, FOLDERS, SUPERFOLDER_TO_FOLDER, PLDDT_SLIDING_WINDOW, CLASHES_MODEL
+
+    window = PLDDT_SLIDING_WINDOW
+    stages = {
+        "generate_inputs": {"script": "bulkalphafold3.py", "depends": [], "inputs": [CONFIG_FILE, BAIT_FILENAME, TEMPLATE_FILE] + FASTA_FILES, "screens": False, "outputs": [f"{folder}_RUN.sh" for folder in FOLDERS]},
+        "process_results": {"script": "process_results.py", "depends": ["generate_inputs"], "inputs": [CONFIG_FILE], "screens": True, "outputs": [f"output_raw_results/{folder}_results.csv" for folder in FOLDERS]},
+        "sliding_window": {"script": "files_helper.py", "depends": ["generate_inputs"], "inputs": [CONFIG_FILE], "screens": True, "outputs": []},
+        "binding_domain": {
+            "script": "get_binding_domain.py",
+            "depends": ["sliding_window"],
+            "inputs": [CONFIG_FILE],
+            "screens": True,
+            "outputs": [f"output_binding_domain/{folder}_binding_domain_plddt_window_{window}.csv" for folder in FOLDERS],
+        },
+        "clashes": {
+            "script": "calculate_all_clashes.py",
+            "depends": ["sliding_window"],
+            "inputs": [CONFIG_FILE, CLASHES_MODEL],
+            "screens": True,
+            "outputs": [f"output_all_clashes/{folder}_clashes_plddt_window_{window}.csv" for folder in FOLDERS],
+        },
+        "merge": {
+            "script": "merge_results.py",
+            "depends": ["process_results", "binding_domain", "clashes"],
+            "inputs": [CONFIG_FILE],
+            "screens": False,
+            "outputs": [f"output_merged_results/{superfolder}_merged_plddt_window_{window}.csv" for superfolder in SUPERFOLDER_TO_FOLDER],
+        },
+        "analyze": {
+            "script": "analyze_results.py",
+            "depends": ["merge"],
+            "inputs": [CONFIG_FILE],
+            "screens": False,
+            "outputs": [f"output_analyze_results/{superfolder}_analysis_plddt_window_{window}.csv" for superfolder in SUPERFOLDER_TO_FOLDER],
+        },
+    }
+    if not CLASHES_MODEL:
+        del stages["clashes"]
+        stages["merge"]["depends"].remove("clashes")
+
+    return stages
+
+
+def get_stamp_file(stage):
+    from constants import CONFIG_FILE
+
+    return os.path.join(STAMP_FOLDER, os.path.splitext(os.path.basename(CONFIG_FILE))[0], f"{stage}.json")
+
+
+def get_mtime(path):
+    return os.stat(path).st_mtime if path and os.path.exists(path) else 0.0
+
+
+def get_screens_mtime():
+    """
+    Latest modification time of the prediction folders of all screen folders, from the screen index (a prediction folder changes when AF3 adds
+    a seed/sample folder or the ranking scores, but not when the analysis stages write into its seed/sample folders).
+    """
+
+    from constants import FOLDERS
+    from screen_index import load_screen_index
+
+    mtime_ns = 0
+    for folder in FOLDERS:
+        if os.path.isdir(folder):
+            mtime_ns = max([mtime_ns] + [prediction["mtime_ns"] for prediction in load_screen_index(folder)["predictions"].values()])
+    return mtime_ns / 1e9
+
+
+def is_fresh(stage, stages, screens_mtime):
+    """
+    Whether the outputs and the completion stamp of a stage exist and are newer than all of its inputs.
+    """
+
+    spec = stages[stage]
+    output_files = spec["outputs"] + [get_stamp_file(stage)]
+    if not all(os.path.exists(output_file) for output_file in output_files):
+        return False
+
+    input_mtime = max([get_mtime(input_file) for input_file in spec["inputs"]] + [get_mtime(get_stamp_file(dependency)) for dependency in spec["depends"]])
+    if spec["screens"]:
+        input_mtime = max(input_mtime, screens_mtime)
+    return min(get_mtime(output_file) for output_file in output_files) >= input_mtime
+
+
+def run_stage(stage, spec, config_file):
+    """
+    Run the script of a stage with the config file, prefixing its output with the stage name. Writes the stage's completion stamp if it succeeded.
+    Returns the exit code of the script.
+    """
+
+    started = time.time()
+    env = dict(os.environ, **{CONFIG_ENVIRONMENT_VARIABLE: config_file, "PYTHONUNBUFFERED": "1"})
+    print(f"[{stage}] Running {spec['script']}", flush=True)
+    process = subprocess.Popen([sys.executable, os.path.join(SCRIPT_FOLDER, spec["script"])], env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    for line in process.stdout:
+        print(f"[{stage}] {line}", end="", flush=True)
+    returncode = process.wait()
+    if returncode != 0:
+        print(f"[{stage}] Failed with exit code {returncode}", flush=True)
+        return returncode
+
+    stamp_file = get_stamp_file(stage)
+    os.makedirs(os.path.dirname(stamp_file), exist_ok=True)
+    with open(stamp_file, "w") as f:
+        json.dump({"config": config_file, "script": spec["script"], "started": started, "seconds": round(time.time() - started, 1)}, f)
+    # stamped with the start time, so inputs that changed while the stage was running make it stale
+    os.utime(stamp_file, (started, started))
+    print(f"[{stage}] Done in {time.time() - started:.1f} s", flush=True)
+    return 0
+
+
+def run_pipeline(config_file, selected_stages=None, force=False, dry_run=False):
+    """
+    Run the selected stages (all if None) in dependency order, concurrently where possible, skipping fresh stages unless `force`.
+    Stages that depend on a failed stage are not run. Returns the list of failed stages.
+    """
+
+    from perf_helper import get_run_id
+
+    stages = get_stages()
+    selected_stages = [stage for stage in stages if selected_stages is None or stage in selected_stages]
+    # with perf_report, the stages record into one performance report
+    get_run_id()
+    # the stages do not change the prediction folders, so their modification times are read once
+    screens_mtime = get_screens_mtime() if any(stages[stage]["screens"] for stage in selected_stages) else 0.0
+
+    if dry_run:
+        will_run = set()
+        for stage in selected_stages:
+            stale_dependencies = will_run & set(stages[stage]["depends"])
+            if force or stale_dependencies or not is_fresh(stage, stages, screens_mtime):
+                will_run.add(stage)
+            print(f"{stage}: {'run' if stage in will_run else 'fresh, skip'} ({stages[stage]['script']})", flush=True)
+        return []
+
+    pending = list(selected_stages)
+    finished = set()
+    failed = []
+    running = {}
+    with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+        while pending or running:
+            for stage in list(pending):
+                dependencies = [dependency for dependency in stages[stage]["depends"] if dependency in selected_stages]
+                if any(dependency in failed for dependency in dependencies):
+                    pending.remove(stage)
+                    failed.append(stage)
+                    print(f"[{stage}] Not run, a stage it depends on failed", flush=True)
+                elif all(dependency in finished for dependency in dependencies):
+                    pending.remove(stage)
+                    if not force and is_fresh(stage, stages, screens_mtime):
+                        finished.add(stage)
+                        print(f"[{stage}] Outputs are up to date, skipping", flush=True)
+                    else:
+                        running[executor.submit(run_stage, stage, stages[stage], config_file)] = stage
+
+            if running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    if future.result() == 0:
+                        finished.add(stage)
+                    else:
+                        failed.append(stage)
+
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the stages of the pipeline of a config file in dependency order, skipping stages whose outputs are up to date")
+    parser.add_argument("config_file", help="the YAML config file of the screen")
+    parser.add_argument("--stages", nargs="+", help="only run these stages (default: all stages of the pipeline)")
+    parser.add_argument("--force", action="store_true", help="run the stages even if their outputs are up to date")
+    parser.add_argument("--dry-run", action="store_true", help="print which stages would run and exit")
+    args = parser.parse_args()
+
+    # the stages and their outputs depend on the config, so it has to be set before constants.py is imported
+    os.environ[CONFIG_ENVIRONMENT_VARIABLE] = args.config_file
+    unknown_stages = set(args.stages or []) - set(get_stages())
+    if unknown_stages:
+        parser.error(f"unknown stages {sorted(unknown_stages)}, expected some of {list(get_stages())}")
+
+    failed_stages = run_pipeline(args.config_file, args.stages, args.force, args.dry_run)
+    if failed_stages:
+        print(f"Failed stages: {', '.join(failed_stages)}", flush=True)
+        sys.exit(1)
@@ -0,0 +1,249 @@
+"""
+Schedule the AlphaFold3 jobs of a folder of `*_input.json` files across several GPUs, instead of running them all in one `--gpus all` container.
+
+AF3 pads every input to a token bucket (256, 512, ..., 5120 tokens) and compiles the model once per bucket in each process, so each job is sized by its
+bucket, and the jobs are bin-packed onto the GPUs either longest first or as runs of similar buckets (fewer compilations), whichever finishes first.
+Each GPU gets its own input shard folder (`<folder>_shards/gpu_<i>/`, hard links to the input files) and its own container in the run script (`--gpus device=<i>`),
+all writing their predictions to the original folder. Job runtimes are estimated from the AF3 inference timings on one A100 (GPU inference only, the
+CPU data pipeline is not included), so the printed makespan is meant for comparing plans rather than as an exact prediction.
+
+`python schedule_af3_jobs.py --dry-run` prints the plan of every configured folder without writing anything.
+"""
+
+import os
+import json
+import glob
+import shutil
+import argparse
+import numpy as np
+from af3_input_helper import get_token_count, load_manifest
+from constants import CURRENT_PIPELINE, GPU_COUNT, MODEL_WEIGHTS_FOLDER, DATABASE_FOLDER
+
+# token buckets of run_alphafold.py (its --buckets default), inputs larger than the last bucket are not padded
+AF3_BUCKETS = [256, 512, 768, 1024, 1280, 1536, 2048, 2560, 3072, 3584, 4096, 4608, 5120]
+# AF3 inference seconds per seed (5 diffusion samples) by number of tokens on one A100 80 GB
+INFERENCE_TOKENS = [0, 1024, 2048, 3072, 4096, 5120]
+INFERENCE_SECONDS = [0, 62, 275, 703, 1434, 2547]
+# one JAX compilation of the model for a new bucket
+COMPILE_SECONDS = 120
+SHARDS_SUFFIX = "_shards"
+# where the MSA cache (see msa_cache.py) is mounted in the container for inference-only runs
+MSA_CACHE_MOUNT = "/root/msa_cache"
+
+
+def get_bucket(token_count, buckets=AF3_BUCKETS):
+    """
+    The token bucket AF3 pads an input to (the token count itself above the last bucket).
+    """
+
+    index = np.searchsorted(buckets, token_count)
+    return buckets[index] if index < len(buckets) else token_count
+
+
+def estimate_job_seconds(bucket, num_seeds):
+    """
+    Estimated AF3 inference time of a job (without compilation), interpolated from the A100 timings, and extrapolated with a power law above 5120 tokens.
+    """
+
+    if bucket <= INFERENCE_TOKENS[-1]:
+        seconds = float(np.interp(bucket, INFERENCE_TOKENS, INFERENCE_SECONDS))
+    else:
+        exponent = np.log(INFERENCE_SECONDS[-1] / INFERENCE_SECONDS[-2]) / np.log(INFERENCE_TOKENS[-1] / INFERENCE_TOKENS[-2])
+        seconds = INFERENCE_SECONDS[-1] * (bucket / INFERENCE_TOKENS[-1]) ** exponent
+
+    return seconds * num_seeds
+
+
+def read_jobs(input_folder):
+    """
+    The AF3 jobs of a folder: {"file", "name", "tokens", "bucket", "seconds"} for each job of the folder's input manifest (see af3_input_helper.py),
+    or for each `*_input.json` file if the folder has no manifest.
+    """
+
+    manifest_jobs = load_manifest(input_folder)
+    if manifest_jobs:
+        jobs = [(os.path.join(input_folder, file_name), job["name"], job["tokens"], job["seeds"]) for file_name, job in sorted(manifest_jobs.items())]
+    else:
+        jobs = []
+        for input_file in sorted(glob.glob(os.path.join(input_folder, "*_input.json"))):
+            with open(input_file) as f:
+                af3_input = json.load(f)
+            jobs.append((input_file, af3_input["name"], get_token_count(af3_input), len(af3_input["modelSeeds"])))
+
+    return [
+        {"file": input_file, "name": name, "tokens": token_count, "bucket": get_bucket(token_count), "seconds": estimate_job_seconds(get_bucket(token_count), num_seeds)}
+        for input_file, name, token_count, num_seeds in jobs
+    ]
+
+
+def _add_job(gpu, job):
+    gpu["seconds"] += job["seconds"] + (0 if job["bucket"] in gpu["buckets"] else COMPILE_SECONDS)
+    gpu["buckets"].add(job["bucket"])
+    gpu["jobs"].append(job)
+
+
+def _plan_longest_first(jobs, gpu_count):
+    # longest processing time first, each job on the GPU where it finishes earliest (counting a compilation if its bucket is new to the GPU)
+    gpus = [{"jobs": [], "buckets": set(), "seconds": 0.0} for _ in range(gpu_count)]
+    for job in sorted(jobs, key=lambda job: (job["seconds"], job["bucket"]), reverse=True):
+        finish_times = [gpu["seconds"] + job["seconds"] + (0 if job["bucket"] in gpu["buckets"] else COMPILE_SECONDS) for gpu in gpus]
+        _add_job(gpus[int(np.argmin(finish_times))], job)
+
+    return gpus
+
+
+def _pack_by_bucket(sorted_jobs, gpu_count, capacity):
+    # split the jobs (sorted by bucket) into consecutive runs of at most `capacity` seconds, None if more than `gpu_count` runs are needed
+    gpus = [{"jobs": [], "buckets": set(), "seconds": 0.0}]
+    for job in sorted_jobs:
+        gpu = gpus[-1]
+        if gpu["jobs"] and gpu["seconds"] + job["seconds"] + (0 if job["bucket"] in gpu["buckets"] else COMPILE_SECONDS) > capacity:
+            if len(gpus) == gpu_count:
+                return None
+            gpu = {"jobs": [], "buckets": set(), "seconds": 0.0}
+            gpus.append(gpu)
+        _add_job(gpu, job)
+
+    return gpus + [{"jobs": [], "buckets": set(), "seconds": 0.0} for _ in range(gpu_count - len(gpus))]
+
+
+def _plan_by_bucket(jobs, gpu_count):
+    # the jobs sorted by bucket, split into consecutive runs (so each GPU compiles as few buckets as possible), with the smallest feasible run length (bisection)
+    sorted_jobs = sorted(jobs, key=lambda job: (job["bucket"], job["name"]))
+    low = max([job["seconds"] + COMPILE_SECONDS for job in jobs], default=0.0)
+    high = sum(job["seconds"] for job in jobs) + COMPILE_SECONDS * len(jobs)
+    gpus = _pack_by_bucket(sorted_jobs, gpu_count, high)
+    while high - low > 1.0:
+        capacity = (low + high) / 2
+        packed = _pack_by_bucket(sorted_jobs, gpu_count, capacity)
+        if packed is None:
+            low = capacity
+        else:
+            high, gpus = capacity, packed
+
+    return gpus
+
+
+def plan_jobs(jobs, gpu_count):
+    """
+    Assign the jobs to `gpu_count` GPUs, counting a compilation for every bucket that is new to a GPU. Two plans are compared: longest processing time first
+    (each job on the GPU where it finishes earliest) and consecutive runs of the jobs sorted by bucket (few compilations per GPU), and the plan with the
+    shorter makespan is kept (the bucket runs on a tie). Returns a list of {"jobs", "buckets", "seconds"} per GPU, with each GPU's jobs grouped by bucket.
+    """
+
+    plans = [_plan_by_bucket(jobs, gpu_count), _plan_longest_first(jobs, gpu_count)]
+    gpus = min(plans, key=lambda plan: max(gpu["seconds"] for gpu in plan))
+    for gpu in gpus:
+        gpu["jobs"].sort(key=lambda job: (job["bucket"], job["name"]))
+
+    return gpus
+
+
+def print_plan(input_folder, jobs, plan):
+    total_seconds = sum(job["seconds"] for job in jobs)
+    makespan = max(gpu["seconds"] for gpu in plan)
+    print(f"{input_folder}: {len(jobs)} jobs on {len(plan)} GPUs, {total_seconds / 3600:.1f} GPU hours of inference", flush=True)
+    for i, gpu in enumerate(plan):
+        buckets = ", ".join(f"{bucket}x{sum(job['bucket'] == bucket for job in gpu['jobs'])}" for bucket in sorted(gpu["buckets"]))
+        print(f"  GPU {i}: {len(gpu['jobs'])} jobs, {gpu['seconds'] / 3600:.1f} hours, buckets {buckets or '-'}", flush=True)
+    print(f"  Expected makespan: {makespan / 3600:.1f} hours (single GPU: {(total_seconds + COMPILE_SECONDS * len({job['bucket'] for job in jobs})) / 3600:.1f} hours)", flush=True)
+
+
+def write_shards(plan, shards_folder):
+    """
+    Write one input folder per GPU with links to (or copies of, across filesystems) the input files of its jobs. Previous shards are replaced.
+    """
+
+    if os.path.exists(shards_folder):
+        shutil.rmtree(shards_folder)
+
+    shard_folders = []
+    for i, gpu in enumerate(plan):
+        shard_folder = os.path.join(shards_folder, f"gpu_{i}")
+        os.makedirs(shard_folder)
+        for job in gpu["jobs"]:
+            shard_file = os.path.join(shard_folder, os.path.basename(job["file"]))
+            # hard links rather than symlinks, a symlink would point outside the folder mounted in the container
+            try:
+                os.link(job["file"], shard_file)
+            except OSError:
+                shutil.copy2(job["file"], shard_file)
+        shard_folders.append(shard_folder)
+
+    return shard_folders
+
+
+def get_docker_command(input_folder, output_folder, container_name, gpus="all", msa_cache_folder=None, run_inference=True):
+    """
+    The Docker command running AF3 on the input files of `input_folder`, writing the predictions to `output_folder`.
+    With `msa_cache_folder`, the MSA cache is mounted at MSA_CACHE_MOUNT and the data pipeline is skipped (the inputs refer to the cached MSAs and templates);
+    without `run_inference`, only the data pipeline is run (on the CPU, no GPU is attached).
+    """
+
+    options = [
+        f"--name {container_name}",
+        f"--volume {os.path.abspath(input_folder)}:/root/af_input/{output_folder}",
+        f"--volume {os.path.abspath(output_folder)}:/root/af_output/{output_folder}",
+        f"--volume {MODEL_WEIGHTS_FOLDER}:/root/models",
+        f"--volume {DATABASE_FOLDER}:/root/public_databases",
+    ]
+    if msa_cache_folder is not None:
+        options.append(f"--volume {os.path.abspath(msa_cache_folder)}:{MSA_CACHE_MOUNT}")
+    if run_inference:
+        options.append(f"--gpus {gpus}")
+
+    arguments = [f"--input_dir=/root/af_input/{output_folder}", "--model_dir=/root/models", f"--output_dir=/root/af_output/{output_folder}"]
+    if msa_cache_folder is not None:
+        arguments.append("--norun_data_pipeline")
+    if not run_inference:
+        arguments.append("--norun_inference")
+
+    return " \\\n    ".join(["docker run -it --detach", *options, "alphafold3", "python run_alphafold.py", *arguments]) + "\n"
+
+
+def schedule_folder(input_folder, bash_script_file, gpu_count=GPU_COUNT, dry_run=False, msa_cache_folder=None):
+    """
+    Plan the AF3 jobs of a folder on `gpu_count` GPUs and print the plan. Unless `dry_run`, write the input shards and a run script with one container per GPU
+    (inference only, with the MSA cache mounted, if `msa_cache_folder` is given).
+    """
+
+    jobs = read_jobs(input_folder)
+    plan = plan_jobs(jobs, gpu_count)
+    print_plan(input_folder, jobs, plan)
+    if dry_run:
+        return plan
+
+    shard_folders = write_shards(plan, os.path.normpath(input_folder) + SHARDS_SUFFIX)
+    container_name = f"af3_run_{input_folder.replace('/', '_').replace(' ', '_')}"
+    with open(bash_script_file, "w") as f:
+        for i, (gpu, shard_folder) in enumerate(zip(plan, shard_folders)):
+            if gpu["jobs"]:
+                f.write(get_docker_command(shard_folder, input_folder, f"{container_name}_gpu_{i}", gpus=f"device={i}", msa_cache_folder=msa_cache_folder))
+    print(f"Wrote {bash_script_file}", flush=True)
+
+    return plan
+
+
+def get_run_script_files():
+    """
+    The AF3 input folders of the current config file and the run script of each ({folder: run script file}).
+    """
+
+    if CURRENT_PIPELINE == "complex":
+        from constants import OUTPUT_FOLDER
+
+        return {OUTPUT_FOLDER: f"{OUTPUT_FOLDER}/run_alphafold3.sh"}
+
+    from constants import FOLDERS
+
+    return {folder: folder + "_RUN.sh" for folder in FOLDERS}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bin-pack the AF3 jobs of the configured folders onto several GPUs")
+    parser.add_argument("--gpus", type=int, default=GPU_COUNT, help="Number of GPUs (default: gpu_count from the config file)")
+    parser.add_argument("--dry-run", action="store_true", help="Only print the plan and the expected makespan")
+    args = parser.parse_args()
+
+    for folder, bash_script_file in get_run_script_files().items():
+        schedule_folder(folder, bash_script_file, args.gpus, args.dry_run)
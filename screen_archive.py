@@ -0,0 +1,504 @@
+"""
+Random-access archives of screen folders, written incrementally while the screen is running, so the analysis stages can read the AF3 outputs of an archived
+screen without extracting it first.
+
+Every screen folder is archived to `<screen folder>.zip` (one deflate stream per file, so any file can be decompressed on its own) with an index
+`<screen folder>.zip.index.sqlite` that maps every file to the byte offset, compressed size, compression method and CRC of its data in the archive, and to the
+size and modification time it had in the screen folder. The index is also the manifest of the archived predictions: the screen index entry of every prediction
+(see `screen_index.py`), its fingerprint, number of files, size and SHA-256 checksum. Predictions are appended one batch at a time as AF3 completes them
+(`python screen_archive.py --watch`, alongside the predictions), so archiving overlaps with the GPU time; a final `python screen_archive.py` archives the
+remaining predictions and the other files of the screen folders. Predictions that changed after they were archived are appended again (the index points to
+the latest copy, `--full` rebuilds a compact archive). An archive whose append was interrupted is recovered from its index (the data after the last indexed
+file is dropped and the central directory is written again), and an archive is never written again from scratch while it holds files that are not in the screen
+folder anymore. With `--prune`, redundant files are not archived: the copies of the top sample's model and confidences
+at the top of each prediction folder and the `_plddt_window_N.cif` files. `--verify` checks the archived files against the checksums of the manifest.
+
+Once the prediction folders are removed from the screen folder, `load_screen_index` returns the archived screen index and `open_screen_file` reads the files of
+the screen from the archive with one positional read each, so the analysis stages and their pool workers only read the files they need, concurrently.
+Archived files keep their paths (`<screen folder>/<prediction>/<seed/sample>/<file>`) and fingerprints, so the result caches stay valid after archiving.
+The `_plddt_window_N.cif` files cannot be written next to archived models, so archived screens need `virtual_plddt_windows`, and the ChimeraX backends need
+the model files on disk. The archives are regular zip files (`unzip <screen folder>.zip` restores the screen folder).
+"""
+
+import io
+import os
+import re
+import json
+import time
+import zlib
+import struct
+import sqlite3
+import zipfile
+import hashlib
+import argparse
+import warnings
+from contextlib import closing
+from multiprocessing import Pool
+
+ARCHIVE_SUFFIX = ".zip"
+INDEX_SUFFIX = ".zip.index.sqlite"
+ARCHIVE_INDEX_VERSION = 2
+MEMBER_COLUMNS = ["offset", "compressed_size", "size", "method", "crc", "mtime_ns"]
+# fixed part of a zip local file header, followed by the file name and the extra field, then the file's data
+LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+# zipfile writes no extra field, or a 20 bytes Zip64 extra field, in the local headers, other archivers at most 64 KB
+MAX_LOCAL_EXTRA_LENGTH = 0xFFFF
+# archived files are at most <screen folder>/<prediction>/<seed/sample>/<file>
+MAX_MEMBER_DEPTH = 3
+# files of the screen folder that are not archived (the archive index holds the screen index)
+EXCLUDED_FILES = {"screen_index.json"}
+# number of predictions appended to the archive at once (the zip central directory is rewritten after every batch)
+ARCHIVE_BATCH_SIZE = 64
+# files that --prune does not archive: the copies of the top sample's files at the top of a prediction folder, and the pLDDT sliding window files
+TOP_SAMPLE_COPY_PATTERN = re.compile(r"_(model\.cif|confidences\.json|summary_confidences\.json)$")
+PLDDT_WINDOW_FILE_PATTERN = re.compile(r"_plddt_window_-?\d+\.(cif|npz)$")
+
+# opened archives, per process (file descriptors and SQLite connections are not shared with forked pool workers): (pid, screen folder) -> (fd, connection)
+_archives = {}
+
+
+def get_archive_file(folder):
+    return os.path.normpath(folder) + ARCHIVE_SUFFIX
+
+
+def get_archive_index_file(folder):
+    return os.path.normpath(folder) + INDEX_SUFFIX
+
+
+def _get_member_name(folder, path):
+    return f"{os.path.basename(os.path.normpath(folder))}/{os.path.relpath(path, folder).replace(os.sep, '/')}"
+
+
+def _connect(index_file):
+    connection = sqlite3.connect(index_file, timeout=60)
+    connection.execute(f"CREATE TABLE IF NOT EXISTS members (member TEXT PRIMARY KEY, {', '.join(column + ' INTEGER' for column in MEMBER_COLUMNS)})")
+    connection.execute("CREATE TABLE IF NOT EXISTS predictions (prediction TEXT PRIMARY KEY, entry TEXT, fingerprint TEXT, files_fingerprint TEXT, files INTEGER, size INTEGER, sha256 TEXT, archived REAL)")
+    connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    return connection
+
+
+def _get_data_offset(fd, header_offset):
+    # the file name and extra field lengths of the local header can differ from the central directory's, so they are read from the local header
+    signature, _, _, _, _, _, _, _, _, name_length, extra_length = LOCAL_HEADER.unpack(os.pread(fd, LOCAL_HEADER.size, header_offset))
+    if signature != b"PK\x03\x04":
+        raise ValueError(f"No zip local file header at offset {header_offset}")
+    return header_offset + LOCAL_HEADER.size + name_length + extra_length
+
+
+def _read_member(fd, member, row):
+    data = os.pread(fd, row["compressed_size"], row["offset"])
+    if row["method"] == zipfile.ZIP_DEFLATED:
+        data = zlib.decompress(data, -zlib.MAX_WBITS)
+    elif row["method"] != zipfile.ZIP_STORED:
+        raise ValueError(f"Unsupported compression method {row['method']} of {member}")
+    if zlib.crc32(data) != row["crc"]:
+        raise ValueError(f"CRC mismatch of {member}, the archive does not match its index")
+    return data
+
+
+def is_pruned_file(prediction_path, path):
+    """
+    Whether a file of a prediction folder is redundant: a copy of the top sample's model or confidences at the top of the folder, or a pLDDT sliding window file.
+    """
+
+    return (os.path.dirname(path) == prediction_path and TOP_SAMPLE_COPY_PATTERN.search(path) is not None) or PLDDT_WINDOW_FILE_PATTERN.search(path) is not None
+
+
+def get_prediction_files(folder, prediction_name, prune=False):
+    """
+    Sorted (member name, path) of the files of a prediction folder to archive.
+    """
+
+    prediction_path = os.path.join(folder, prediction_name)
+    files = []
+    for root, _, file_names in os.walk(prediction_path):
+        for file_name in file_names:
+            path = os.path.join(root, file_name)
+            if not (prune and is_pruned_file(prediction_path, path)):
+                files.append((_get_member_name(folder, path), path))
+    return sorted(files)
+
+
+def get_files_fingerprint(files):
+    # names, sizes and modification times of the archived files of a prediction, so files written into its folders that are not archived (e.g. pruned
+    # sliding window files) do not make it archived again
+    return hashlib.sha256(json.dumps([[member, os.stat(path).st_size, os.stat(path).st_mtime_ns] for member, path in files]).encode()).hexdigest()
+
+
+def _append_files(archive, files, compresslevel):
+    """
+    Append files ([(member name, path)]) to an open zip archive. Returns {member: mtime_ns}, the total size and the SHA-256 checksum of the member names and contents.
+    """
+
+    mtimes = {}
+    size = 0
+    checksum = hashlib.sha256()
+    for member, path in files:
+        with open(path, "rb") as f:
+            data = f.read()
+        info = zipfile.ZipInfo.from_file(path, member)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        archive.writestr(info, data, compresslevel=compresslevel)
+        mtimes[member] = os.stat(path).st_mtime_ns
+        size += len(data)
+        checksum.update(member.encode() + b"\0" + data)
+    return mtimes, size, checksum.hexdigest()
+
+
+def _index_members(archive_file, connection, infos, mtimes):
+    fd = os.open(archive_file, os.O_RDONLY)
+    try:
+        rows = [(info.filename, _get_data_offset(fd, info.header_offset), info.compress_size, info.file_size, info.compress_type, info.CRC, mtimes[info.filename]) for info in infos]
+    finally:
+        os.close(fd)
+    connection.executemany(f"INSERT OR REPLACE INTO members VALUES (?, {', '.join('?' * len(MEMBER_COLUMNS))})", rows)
+
+
+def append_predictions(folder, predictions, connection, prune=False, compresslevel=6):
+    """
+    Append predictions ({prediction folder name: screen index entry}) to the archive of a screen folder and add them to its index and manifest.
+    Predictions whose archived files did not change are only updated in the manifest. Returns the number of appended predictions.
+    """
+
+    from screen_index import get_prediction_fingerprint
+
+    archive_file = get_archive_file(folder)
+    archived_files_fingerprints = dict(connection.execute(f"SELECT prediction, files_fingerprint FROM predictions WHERE prediction IN ({', '.join('?' * len(predictions))})", list(predictions)))
+    manifest_rows = []
+    refreshed_rows = []
+    mtimes = {}
+    with warnings.catch_warnings():
+        # predictions that changed after they were archived are appended again under the same names
+        warnings.filterwarnings("ignore", "Duplicate name")
+        with zipfile.ZipFile(archive_file, "a", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+            first_info = len(archive.infolist())
+            for prediction_name, prediction in predictions.items():
+                files = get_prediction_files(folder, prediction_name, prune)
+                files_fingerprint = get_files_fingerprint(files)
+                fingerprint = json.dumps(get_prediction_fingerprint(prediction))
+                if archived_files_fingerprints.get(prediction_name) == files_fingerprint:
+                    refreshed_rows.append((json.dumps(prediction), fingerprint, prediction_name))
+                    continue
+                prediction_mtimes, size, checksum = _append_files(archive, files, compresslevel)
+                mtimes.update(prediction_mtimes)
+                manifest_rows.append((prediction_name, json.dumps(prediction), fingerprint, files_fingerprint, len(files), size, checksum, time.time()))
+            infos = archive.infolist()[first_info:]
+
+    # the index is only updated once the archive (and its central directory) is written, so an interrupted batch is archived again
+    with connection:
+        _index_members(archive_file, connection, infos, mtimes)
+        connection.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?, ?, ?)", manifest_rows)
+        connection.executemany("UPDATE predictions SET entry = ?, fingerprint = ? WHERE prediction = ?", refreshed_rows)
+
+    return len(manifest_rows)
+
+
+def append_screen_files(folder, connection, compresslevel=6):
+    """
+    Append the files at the top of a screen folder (e.g. the AF3 inputs) that are new or changed since they were archived.
+    """
+
+    archived_mtimes = dict(connection.execute("SELECT member, mtime_ns FROM members WHERE member NOT LIKE '%/%/%'"))
+    with os.scandir(folder) as entries:
+        files = sorted(
+            (_get_member_name(folder, entry.path), entry.path)
+            for entry in entries
+            if entry.is_file() and entry.name not in EXCLUDED_FILES and archived_mtimes.get(_get_member_name(folder, entry.path)) != entry.stat().st_mtime_ns
+        )
+    if not files:
+        return 0
+
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", "Duplicate name")
+        with zipfile.ZipFile(get_archive_file(folder), "a", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+            first_info = len(archive.infolist())
+            mtimes, _, _ = _append_files(archive, files, compresslevel)
+            infos = archive.infolist()[first_info:]
+    with connection:
+        _index_members(get_archive_file(folder), connection, infos, mtimes)
+    return len(files)
+
+
+def _is_valid_archive(folder):
+    archive_file, index_file = get_archive_file(folder), get_archive_index_file(folder)
+    if not os.path.exists(archive_file) or not os.path.exists(index_file):
+        return False
+    with closing(sqlite3.connect(index_file)) as connection:
+        version = connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone() if connection.execute("SELECT name FROM sqlite_master WHERE name = 'meta'").fetchone() else None
+    # an archive whose append was interrupted has no valid central directory (zip end record)
+    return version is not None and int(version[0]) == ARCHIVE_INDEX_VERSION and zipfile.is_zipfile(archive_file)
+
+
+def _get_local_header(fd, member, data_offset):
+    """
+    The offset and the fields of the local file header of the member whose data starts at `data_offset`.
+    """
+
+    name = member.encode()
+    for extra_length in (64, MAX_LOCAL_EXTRA_LENGTH):
+        start = max(0, data_offset - LOCAL_HEADER.size - len(name) - extra_length)
+        data = os.pread(fd, data_offset - start, start)
+        position = data.rfind(b"PK\x03\x04")
+        while position >= 0:
+            header_offset = start + position
+            if data[position + LOCAL_HEADER.size : position + LOCAL_HEADER.size + len(name)] == name and _get_data_offset(fd, header_offset) == data_offset:
+                return header_offset, LOCAL_HEADER.unpack(data[position : position + LOCAL_HEADER.size])
+            position = data.rfind(b"PK\x03\x04", 0, position)
+    raise ValueError(f"No zip local file header of {member} before offset {data_offset}")
+
+
+def _recover_archive(folder):
+    """
+    Recover an archive whose append was interrupted from its index: the data after the last indexed member (the interrupted batch, which is not in the index)
+    is dropped, and the central directory of the indexed members is written again. Returns whether the archive was recovered.
+    """
+
+    archive_file, index_file = get_archive_file(folder), get_archive_index_file(folder)
+    if not os.path.exists(archive_file) or not os.path.exists(index_file) or zipfile.is_zipfile(archive_file):
+        return False
+    try:
+        with closing(sqlite3.connect(f"file:{index_file}?mode=ro", uri=True)) as connection:
+            if int(dict(connection.execute("SELECT key, value FROM meta")).get("version", 0)) != ARCHIVE_INDEX_VERSION:
+                return False
+            rows = connection.execute(f"SELECT member, {', '.join(MEMBER_COLUMNS)} FROM members ORDER BY offset").fetchall()
+
+        fd = os.open(archive_file, os.O_RDONLY)
+        try:
+            infos = []
+            for member, offset, compressed_size, size, method, crc, _ in rows:
+                header_offset, (_, _, flag_bits, _, mod_time, mod_date, *_) = _get_local_header(fd, member, offset)
+                info = zipfile.ZipInfo(member, ((mod_date >> 9) + 1980, (mod_date >> 5) & 0xF, mod_date & 0x1F, mod_time >> 11, (mod_time >> 5) & 0x3F, (mod_time & 0x1F) * 2))
+                info.compress_type, info.CRC, info.compress_size, info.file_size = method, crc, compressed_size, size
+                info.header_offset, info.flag_bits, info.external_attr = header_offset, flag_bits, 0o100644 << 16
+                infos.append(info)
+        finally:
+            os.close(fd)
+    except (sqlite3.Error, OSError, ValueError) as e:
+        print(f"Failed to recover the archive of {folder}: {e!r}", flush=True)
+        return False
+
+    os.truncate(archive_file, max((offset + compressed_size for _, offset, compressed_size, *_ in rows), default=0))
+    # the truncated file has no end record, so zipfile appends to it and writes the central directory of the given members at its end
+    with zipfile.ZipFile(archive_file, "a", allowZip64=True) as archive:
+        archive.filelist = infos
+        archive.NameToInfo = {info.filename: info for info in infos}
+    return zipfile.is_zipfile(archive_file)
+
+
+def _get_missing_members(folder):
+    """
+    The archived files that are not in the screen folder anymore (from the archive index, or the archive itself), or None if the archive cannot be read.
+    """
+
+    archive_file, index_file = get_archive_file(folder), get_archive_index_file(folder)
+    try:
+        if os.path.exists(index_file):
+            with closing(sqlite3.connect(f"file:{index_file}?mode=ro", uri=True)) as connection:
+                members = [member for (member,) in connection.execute("SELECT member FROM members")]
+        elif zipfile.is_zipfile(archive_file):
+            with zipfile.ZipFile(archive_file) as archive:
+                members = archive.namelist()
+        else:
+            return [] if not os.path.exists(archive_file) else None
+    except sqlite3.Error:
+        return None
+    return [member for member in members if not os.path.exists(os.path.join(os.path.dirname(folder), member))]
+
+
+def archive_screen(folder, prune=False, compresslevel=6, completed_only=False, rebuild=False):
+    """
+    Append the predictions of a screen folder that are not archived yet (or changed since) to its archive, creating it if needed.
+    With `completed_only`, only the predictions that AF3 completed are archived, and the other files of the screen folder are not.
+    An interrupted append is recovered from the index. With `rebuild`, or if the archive is otherwise invalid (e.g. an outdated index version), the archive is
+    written again from scratch, unless it holds files that are not in the screen folder anymore (ValueError). Returns the number of archived predictions.
+    """
+
+    from screen_index import load_screen_index, get_completed_predictions, get_prediction_fingerprint
+
+    folder = os.path.normpath(folder)
+    if is_archived_screen(folder):
+        return 0
+    if not rebuild and not _is_valid_archive(folder) and _recover_archive(folder):
+        print(f"Recovered the archive of {folder} after an interrupted append", flush=True)
+    if rebuild or not _is_valid_archive(folder):
+        missing = _get_missing_members(folder)
+        if missing is None:
+            raise ValueError(f"The archive of {folder} is invalid and its files cannot be listed, not archiving the screen again: move the archive and its index away first")
+        if missing:
+            raise ValueError(
+                f"The archive of {folder} holds {len(missing)} files that are not in the screen folder anymore (e.g. {missing[0]}), not archiving the screen again: "
+                "restore them (`unzip`) or move the archive and its index away first"
+            )
+        if os.path.exists(get_archive_file(folder)) and not rebuild:
+            print(f"The archive of {folder} is invalid or outdated, archiving the screen again", flush=True)
+        for archive_file in [get_archive_file(folder), get_archive_index_file(folder)]:
+            if os.path.exists(archive_file):
+                os.remove(archive_file)
+
+    index = load_screen_index(folder)
+    predictions = get_completed_predictions(index) if completed_only else index["predictions"]
+    with closing(_connect(get_archive_index_file(folder))) as connection:
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", [("version", str(ARCHIVE_INDEX_VERSION)), ("screen_index_version", str(index["version"]))])
+        archived_fingerprints = dict(connection.execute("SELECT prediction, fingerprint FROM predictions"))
+        pending = [name for name, prediction in predictions.items() if archived_fingerprints.get(name) != json.dumps(get_prediction_fingerprint(prediction))]
+        appended_count = 0
+        for i in range(0, len(pending), ARCHIVE_BATCH_SIZE):
+            appended_count += append_predictions(folder, {name: predictions[name] for name in pending[i : i + ARCHIVE_BATCH_SIZE]}, connection, prune, compresslevel)
+        screen_file_count = 0 if completed_only else append_screen_files(folder, connection, compresslevel)
+        archived_count = connection.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+
+    if appended_count or screen_file_count:
+        print(f"Archived {folder}: {appended_count} predictions appended, {archived_count} of {len(index['predictions'])} archived, {os.path.getsize(get_archive_file(folder)) / 2**30:.2f} GB", flush=True)
+    return appended_count
+
+
+def verify_archive(folder):
+    """
+    Check the archived files of every prediction against the checksum of the manifest. Returns the names of the predictions that do not match.
+    """
+
+    folder = os.path.normpath(folder)
+    failed = []
+    fd = os.open(get_archive_file(folder), os.O_RDONLY)
+    try:
+        with closing(sqlite3.connect(f"file:{get_archive_index_file(folder)}?mode=ro", uri=True)) as connection:
+            for prediction_name, expected_checksum in connection.execute("SELECT prediction, sha256 FROM predictions ORDER BY prediction").fetchall():
+                prefix = _get_member_name(folder, os.path.join(folder, prediction_name)) + "/"
+                rows = connection.execute(f"SELECT member, {', '.join(MEMBER_COLUMNS)} FROM members WHERE substr(member, 1, ?) = ? ORDER BY member", (len(prefix), prefix))
+                checksum = hashlib.sha256()
+                try:
+                    for member, *row in rows:
+                        checksum.update(member.encode() + b"\0" + _read_member(fd, member, dict(zip(MEMBER_COLUMNS, row))))
+                except (ValueError, zlib.error):
+                    checksum = None
+                if checksum is None or checksum.hexdigest() != expected_checksum:
+                    failed.append(prediction_name)
+    finally:
+        os.close(fd)
+
+    print(f"Verified {folder}: {len(failed)} predictions do not match their checksum{': ' + ', '.join(failed) if failed else ''}", flush=True)
+    return failed
+
+
+def is_archived_screen(folder):
+    """
+    Whether the predictions of a screen folder are read from its archive: the archive index exists and the folder has no prediction folders
+    (it can still hold other files, e.g. the pLDDT store).
+    """
+
+    if not os.path.exists(get_archive_index_file(folder)):
+        return False
+    if not os.path.isdir(folder):
+        return True
+    with os.scandir(folder) as entries:
+        return not any(entry.is_dir() for entry in entries)
+
+
+def load_archived_screen_index(folder):
+    with closing(sqlite3.connect(f"file:{get_archive_index_file(folder)}?mode=ro", uri=True)) as connection:
+        meta = dict(connection.execute("SELECT key, value FROM meta"))
+        if int(meta.get("version", 0)) != ARCHIVE_INDEX_VERSION:
+            raise ValueError(f"Unsupported archive index version {meta.get('version')} of {get_archive_index_file(folder)}, archive the screen again")
+        predictions = {prediction_name: json.loads(entry) for prediction_name, entry in connection.execute("SELECT prediction, entry FROM predictions ORDER BY prediction")}
+    return {"version": int(meta["screen_index_version"]), "predictions": predictions}
+
+
+def _open_archive(folder):
+    key = (os.getpid(), folder)
+    if key not in _archives:
+        connection = sqlite3.connect(f"file:{get_archive_index_file(folder)}?mode=ro", uri=True)
+        _archives[key] = (os.open(get_archive_file(folder), os.O_RDONLY), connection)
+    return _archives[key]
+
+
+def get_archive_member(path):
+    """
+    The archive entry ({"fd", "member", "offset", "compressed_size", "size", "method", "crc", "mtime_ns"}) of a file of an archived screen, or None.
+    """
+
+    path = os.path.normpath(path)
+    folder = os.path.dirname(path)
+    for _ in range(MAX_MEMBER_DEPTH):
+        if not folder:
+            break
+        if os.path.exists(get_archive_index_file(folder)):
+            fd, connection = _open_archive(folder)
+            member = _get_member_name(folder, path)
+            row = connection.execute(f"SELECT {', '.join(MEMBER_COLUMNS)} FROM members WHERE member = ?", (member,)).fetchone()
+            return dict(zip(MEMBER_COLUMNS, row), fd=fd, member=member) if row else None
+        folder = os.path.dirname(folder)
+
+    return None
+
+
+def read_screen_file(path):
+    """
+    The content (bytes) of a file of a screen folder, from the file itself or, if it does not exist, from the archive of the screen.
+    """
+
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    member = get_archive_member(path)
+    if member is None:
+        raise FileNotFoundError(f"No such file or archived file: {path}")
+
+    return _read_member(member["fd"], member["member"], member)
+
+
+def open_screen_file(path, mode="r"):
+    """
+    `open` for reading files of screen folders that also reads the files of archived screens (text mode "r", or binary mode "rb").
+    """
+
+    if os.path.exists(path):
+        return open(path, mode)
+
+    data = io.BytesIO(read_screen_file(path))
+    return data if "b" in mode else io.TextIOWrapper(data)
+
+
+def screen_file_exists(path):
+    return os.path.exists(path) or get_archive_member(path) is not None
+
+
+def _archive_screen(args):
+    folder, prune, compresslevel, completed_only, rebuild = args
+    try:
+        return archive_screen(folder, prune, compresslevel, completed_only, rebuild)
+    except Exception as e:
+        # a failing folder (e.g. a full disk) does not stop the archiving of the others
+        print(f"Failed to archive {folder}: {e!r}", flush=True)
+        return 0
+
+
+if __name__ == "__main__":
+    from constants import FOLDERS, PROCESS_COUNT, WATCH_POLL_SECONDS
+
+    parser = argparse.ArgumentParser(description="Archive the screen folders into random-access archives that the analysis stages can read without extracting them")
+    parser.add_argument("--folders", nargs="+", default=FOLDERS, help="screen folders to archive (default: the screen folders of the config)")
+    parser.add_argument("--watch", action="store_true", help="archive the predictions as AF3 completes them, until interrupted")
+    parser.add_argument("--prune", action="store_true", help="do not archive the top sample copies and the pLDDT sliding window files")
+    parser.add_argument("--full", action="store_true", help="write the archives again from scratch")
+    parser.add_argument("--verify", action="store_true", help="check the archived predictions against their checksums and exit")
+    parser.add_argument("--compresslevel", type=int, default=6, help="deflate compression level (0-9)")
+    args = parser.parse_args()
+
+    if args.verify:
+        failed = [prediction for folder in args.folders if os.path.exists(get_archive_index_file(folder)) for prediction in verify_archive(folder)]
+        raise SystemExit(1 if failed else 0)
+
+    folders = [folder for folder in args.folders if os.path.isdir(folder)]
+    with Pool(processes=max(1, min(len(folders), PROCESS_COUNT))) as pool:
+        try:
+            rebuild = args.full
+            while True:
+                pool.map(_archive_screen, [(folder, args.prune, args.compresslevel, args.watch, rebuild) for folder in folders])
+                rebuild = False
+                if not args.watch:
+                    break
+                time.sleep(WATCH_POLL_SECONDS)
+        except KeyboardInterrupt:
+            print("Stopped archiving", flush=True)
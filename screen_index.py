@@ -0,0 +1,188 @@
+"""
+Persisted index of the layout of an AlphaFold3 screen folder, so the analysis stages do not each walk the whole output tree with repeated `os.listdir` calls:
+prediction folder -> ranking scores (seed, sample, ranking_score rows of `<prediction>_ranking_scores.csv`) -> seed/sample folder -> model, confidences and summary confidences files.
+
+The index is stored in `<screen folder>/screen_index.json` and refreshed incrementally with `os.scandir`: a prediction folder is only rescanned when its
+modification time changed (a sample was added or removed), and a seed/sample folder only when its own modification time changed.
+Files rewritten in place do not change their folder's modification time, use `python screen_index.py --full` to rebuild the index after such changes.
+The fingerprint of a prediction (used by the result caches) holds the sizes and modification times of the indexed files of its seed/sample folders rather than
+the folders' modification times, so other files written into these folders (e.g. the `_plddt_window_N.cif` files) do not change it.
+The index of an archived screen (see `screen_archive.py`) is the one stored in its archive index.
+"""
+
+import os
+import csv
+import json
+import argparse
+from screen_archive import is_archived_screen, load_archived_screen_index
+
+SCREEN_INDEX_FILE = "screen_index.json"
+SCREEN_INDEX_VERSION = 2
+SAMPLE_FILE_KEYS = ["model", "confidences", "summary_confidences"]
+
+
+def get_screen_index_file(folder):
+    return os.path.join(folder, SCREEN_INDEX_FILE)
+
+
+def _scan_sample(sample_path):
+    sample = {"mtime_ns": os.stat(sample_path).st_mtime_ns, "model": None, "confidences": None, "summary_confidences": None}
+    with os.scandir(sample_path) as entries:
+        for entry in entries:
+            # compact samples (see `compact_model.py`) have `_model.npz` and `_confidences.npz` files instead
+            if entry.name.endswith(("_model.cif", "_model.npz")):
+                sample["model"] = entry.name
+            elif entry.name.endswith("summary_confidences.json"):
+                sample["summary_confidences"] = entry.name
+            elif entry.name.endswith(("confidences.json", "_confidences.npz")):
+                sample["confidences"] = entry.name
+
+    file_stats = {key: os.stat(os.path.join(sample_path, sample[key])) for key in SAMPLE_FILE_KEYS if sample[key] is not None}
+    sample["files"] = [[sample[key], stat.st_size, stat.st_mtime_ns] for key, stat in file_stats.items()]
+    return sample
+
+
+def _read_ranking_scores(ranking_file):
+    with open(ranking_file, newline="") as f:
+        return [[int(row["seed"]), int(row["sample"]), float(row["ranking_score"])] for row in csv.DictReader(f)]
+
+
+def scan_prediction(prediction_path, mtime_ns, previous=None):
+    """
+    Index one prediction folder, reusing the entries of the seed/sample folders whose modification time did not change since `previous`.
+    """
+
+    previous_samples = previous["samples"] if previous else {}
+    prediction = {"mtime_ns": mtime_ns, "ranking_scores": None, "ranking": [], "samples": {}}
+    with os.scandir(prediction_path) as entries:
+        for entry in entries:
+            if entry.is_dir() and entry.name.startswith("seed-"):
+                cached_sample = previous_samples.get(entry.name)
+                if cached_sample is not None and cached_sample["mtime_ns"] == entry.stat().st_mtime_ns:
+                    prediction["samples"][entry.name] = cached_sample
+                else:
+                    prediction["samples"][entry.name] = _scan_sample(entry.path)
+            elif entry.name.endswith("_ranking_scores.csv"):
+                prediction["ranking_scores"] = entry.name
+
+    if prediction["ranking_scores"] is not None:
+        prediction["ranking"] = _read_ranking_scores(os.path.join(prediction_path, prediction["ranking_scores"]))
+
+    return prediction
+
+
+def _write_screen_index(folder, index):
+    index_file = get_screen_index_file(folder)
+    temp_file = f"{index_file}.{os.getpid()}.tmp"
+    with open(temp_file, "w") as f:
+        json.dump(index, f)
+    os.replace(temp_file, index_file)
+
+
+def load_screen_index(folder, refresh=True, full_refresh=False):
+    """
+    Load the index of a screen folder, refreshing it first (rescanning only the prediction and seed/sample folders that changed) unless `refresh` is False.
+    Returns {"version": ..., "predictions": {prediction folder name: {"mtime_ns", "ranking_scores", "ranking", "samples": {seed/sample folder name: {...}}}}}.
+    """
+
+    if is_archived_screen(folder):
+        return load_archived_screen_index(folder)
+
+    index = None
+    index_file = get_screen_index_file(folder)
+    if not full_refresh and os.path.exists(index_file):
+        with open(index_file) as f:
+            index = json.load(f)
+        if index.get("version") != SCREEN_INDEX_VERSION:
+            index = None
+
+    if index is not None and not refresh:
+        return index
+
+    previous_predictions = index["predictions"] if index is not None else {}
+    predictions = {}
+    rescanned = 0
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+            mtime_ns = entry.stat().st_mtime_ns
+            previous = previous_predictions.get(entry.name)
+            if previous is not None and previous["mtime_ns"] == mtime_ns:
+                predictions[entry.name] = previous
+            else:
+                predictions[entry.name] = scan_prediction(entry.path, mtime_ns, previous)
+                rescanned += 1
+
+    index = {"version": SCREEN_INDEX_VERSION, "predictions": dict(sorted(predictions.items()))}
+    if rescanned > 0 or predictions.keys() != previous_predictions.keys():
+        _write_screen_index(folder, index)
+        print(f"Indexed {folder}: {len(predictions)} predictions, {rescanned} rescanned", flush=True)
+
+    return index
+
+
+def get_prediction_folders(folder, index=None):
+    """
+    Paths of all prediction folders of a screen folder.
+    """
+
+    index = index if index is not None else load_screen_index(folder)
+    return [os.path.join(folder, prediction) for prediction in index["predictions"]]
+
+
+def get_sample_files(folder, prediction_name, sample_name, sample):
+    """
+    Paths of the model, confidences and summary confidences files of an indexed seed/sample folder (None for missing files).
+    """
+
+    sample_path = os.path.join(folder, prediction_name, sample_name)
+    return {key: os.path.join(sample_path, sample[key]) if sample[key] else None for key in SAMPLE_FILE_KEYS}
+
+
+def get_ranked_model_files(folder, prediction_name, prediction, n_model=-1):
+    """
+    Paths of the model files of a prediction, sorted by decreasing ranking score (as in `<prediction>_ranking_scores.csv`), limited to the top `n_model` (-1 for all).
+    """
+
+    if prediction["ranking_scores"] is None:
+        raise FileNotFoundError(f"No ranking scores file found in {os.path.join(folder, prediction_name)}")
+
+    ranking = sorted(prediction["ranking"], key=lambda row: row[2], reverse=True)
+    ranking = ranking[:n_model] if n_model > 0 else ranking
+    model_files = []
+    for seed, sample, _ in ranking:
+        sample_name = f"seed-{seed}_sample-{sample}"
+        sample_entry = prediction["samples"].get(sample_name)
+        if sample_entry is None or sample_entry["model"] is None:
+            raise FileNotFoundError(f"No model file found in {os.path.join(folder, prediction_name, sample_name)}")
+        model_files.append(os.path.join(folder, prediction_name, sample_name, sample_entry["model"]))
+
+    return model_files
+
+
+def get_completed_predictions(index):
+    # AF3 writes the ranking scores after all seeds and samples of a prediction
+    return {prediction_name: prediction for prediction_name, prediction in index["predictions"].items() if prediction["ranking_scores"] is not None}
+
+
+def get_prediction_fingerprint(prediction):
+    """
+    Fingerprint of an indexed prediction folder (modification time of the folder, and sizes and modification times of the model and confidences files of its
+    seed/sample folders), without touching the filesystem. Samples archived by earlier versions have no file fingerprints and use their folder's modification time.
+    """
+
+    return [prediction["mtime_ns"]] + sorted([name, sample.get("files", sample["mtime_ns"])] for name, sample in prediction["samples"].items())
+
+
+if __name__ == "__main__":
+    from constants import FOLDERS
+
+    parser = argparse.ArgumentParser(description="Build or refresh the index of the screen folders")
+    parser.add_argument("--full", action="store_true", help="Rebuild the index from scratch instead of only rescanning changed folders")
+    args = parser.parse_args()
+
+    for folder in FOLDERS:
+        index = load_screen_index(folder, full_refresh=args.full)
+        samples = sum(len(prediction["samples"]) for prediction in index["predictions"].values())
+        print(f"{folder}: {len(index['predictions'])} predictions, {samples} samples", flush=True)
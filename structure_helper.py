@@ -0,0 +1,235 @@
+"""
+Helpers for loading protein structures into NumPy arrays and running vectorized geometry checks (clashes, contacts, buried surface area) on them.
+Used by the native (in-process) backends that replace the ChimeraX subprocess calls.
+"""
+
+import os
+import numpy as np
+from scipy.spatial import cKDTree
+from Bio.PDB import PDBParser
+from mmcif_helper import read_atom_site, get_residue_index, COMPACT_MODEL_EXTENSION
+
+# Van der Waals radii (in Angstroms) per element, approximating the ChimeraX default (implicit hydrogen) radii for heavy atoms.
+VDW_RADII = {"C": 1.80, "N": 1.64, "O": 1.46, "S": 1.78, "SE": 1.90, "P": 1.87, "H": 1.00}
+DEFAULT_VDW_RADIUS = 1.80
+HBOND_ELEMENTS = ("N", "O")
+
+# ChimeraX `clashes` and `contacts` default parameters
+CLASH_OVERLAP_CUTOFF = 0.6
+CLASH_HBOND_ALLOWANCE = 0.4
+CONTACT_OVERLAP_CUTOFF = -0.4
+CONTACT_HBOND_ALLOWANCE = 0.0
+BOND_SEPARATION = 4
+
+# ChimeraX `measure buriedarea` default probe radius, and the number of points per atom sphere for the Shrake-Rupley surface calculation
+PROBE_RADIUS = 1.4
+N_SPHERE_POINTS = 200
+
+BACKBONE_BONDS_TO_N = {"N": 0, "CA": 1, "C": 2, "O": 3, "OXT": 3, "H": 1}
+BACKBONE_BONDS_TO_C = {"N": 2, "CA": 1, "C": 0, "O": 1, "OXT": 1, "H": 3}
+SIDECHAIN_BRANCH_LETTERS = "BGDEZH"
+
+
+def load_atoms(structure_file):
+    """
+    Load the atoms of the first model of a mmCIF or PDB file into a dictionary of NumPy arrays (one entry per atom):
+    `coords`, `element`, `atom_name`, `res_name`, `chain`, `res_seq`, `residue_index`, `bfactor`. mmCIF files only have their `_atom_site` loop read (see `mmcif_helper.py`),
+    which also reads compact models (`.npz`, see `compact_model.py`).
+    """
+
+    if structure_file.lower().endswith(".cif") or structure_file.endswith(COMPACT_MODEL_EXTENSION):
+        atoms = read_atom_site(structure_file)
+        return {key: atoms[key] for key in ("coords", "element", "atom_name", "res_name", "chain", "res_seq", "residue_index", "bfactor")}
+
+    parser = PDBParser(QUIET=True)
+    structure = parser.get_structure("structure", structure_file)
+    model = next(iter(structure))
+
+    coords, element, atom_name, res_name, chain, res_seq, ins_code, bfactor = [], [], [], [], [], [], [], []
+    for atom in model.get_atoms():
+        residue = atom.get_parent()
+        coords.append(atom.get_coord())
+        element.append((atom.element or atom.get_id()[0]).upper())
+        atom_name.append(atom.get_id())
+        res_name.append(residue.get_resname())
+        chain.append(residue.get_parent().id)
+        res_seq.append(residue.get_id()[1])
+        ins_code.append(residue.get_id()[2])
+        bfactor.append(atom.get_bfactor())
+
+    chain, res_seq = np.array(chain, dtype=str), np.array(res_seq, dtype=np.int64)
+    return {
+        "coords": np.array(coords, dtype=np.float64).reshape(-1, 3),
+        "element": np.array(element, dtype=str),
+        "atom_name": np.array(atom_name, dtype=str),
+        "res_name": np.array(res_name, dtype=str),
+        "chain": chain,
+        "res_seq": res_seq,
+        "residue_index": get_residue_index(chain, res_seq, np.array(ins_code, dtype=str)),
+        "bfactor": np.array(bfactor, dtype=np.float64),
+    }
+
+
+def select_atoms(atoms, mask):
+    """
+    Return a new atoms dictionary containing only the atoms where `mask` is True.
+    """
+
+    return {key: value[mask] for key, value in atoms.items()}
+
+
+def get_vdw_radii(atoms):
+    radii = np.full(len(atoms["element"]), DEFAULT_VDW_RADIUS)
+    for element, radius in VDW_RADII.items():
+        radii[atoms["element"] == element] = radius
+    return radii
+
+
+def _bonds_to_backbone(atom_names, backbone_bonds):
+    """
+    Approximate the number of bonds between each atom and a backbone atom of its residue from the atom name
+    (e.g. CB is 1 bond from CA, CG is 2 bonds from CA, ...). Used to skip bonded/near-bonded pairs across the peptide bond.
+    """
+
+    bonds = np.zeros(len(atom_names), dtype=np.int64)
+    for i, name in enumerate(atom_names):
+        if name in backbone_bonds:
+            bonds[i] = backbone_bonds[name]
+        elif len(name) > 1 and name[1] in SIDECHAIN_BRANCH_LETTERS:
+            bonds[i] = SIDECHAIN_BRANCH_LETTERS.index(name[1]) + 2
+        else:
+            bonds[i] = BOND_SEPARATION
+    return bonds
+
+
+def _near_bonded_mask(atoms, i, j, bond_separation=BOND_SEPARATION):
+    """
+    Mask of atom pairs (i, j) within the same molecule that are separated by at most `bond_separation` bonds:
+    pairs in the same residue, and pairs in sequence-adjacent residues that are close to the peptide bond.
+    """
+
+    same_chain = atoms["chain"][i] == atoms["chain"][j]
+    seq_diff = atoms["res_seq"][j] - atoms["res_seq"][i]
+    same_residue = same_chain & (seq_diff == 0)
+
+    adjacent = same_chain & (np.abs(seq_diff) == 1)
+    # order each adjacent pair so that `first` is in residue n and `second` in residue n + 1 (bonded through C(n)-N(n+1))
+    first = np.where(seq_diff > 0, i, j)[adjacent]
+    second = np.where(seq_diff > 0, j, i)[adjacent]
+    bonds = _bonds_to_backbone(atoms["atom_name"][first], BACKBONE_BONDS_TO_C) + 1 + _bonds_to_backbone(atoms["atom_name"][second], BACKBONE_BONDS_TO_N)
+
+    near_bonded = same_residue
+    near_bonded[np.flatnonzero(adjacent)] = bonds <= bond_separation
+    return near_bonded
+
+
+def _overlaps(radii_i, radii_j, elements_i, elements_j, distances, hbond_allowance):
+    allowance = np.where(np.isin(elements_i, HBOND_ELEMENTS) & np.isin(elements_j, HBOND_ELEMENTS), hbond_allowance, 0.0)
+    return radii_i + radii_j - distances - allowance
+
+
+def count_overlaps_within(atoms, overlap_cutoff=CLASH_OVERLAP_CUTOFF, hbond_allowance=CLASH_HBOND_ALLOWANCE, bond_separation=BOND_SEPARATION):
+    """
+    Count atom pairs within one set of atoms whose van der Waals overlap is >= `overlap_cutoff`, mirroring ChimeraX `clashes`/`contacts`
+    (pairs in the same residue or separated by <= `bond_separation` bonds are ignored).
+    """
+
+    if len(atoms["coords"]) < 2:
+        return 0
+
+    radii = get_vdw_radii(atoms)
+    tree = cKDTree(atoms["coords"])
+    pairs = tree.query_pairs(2 * radii.max() - overlap_cutoff, output_type="ndarray")
+    if len(pairs) == 0:
+        return 0
+
+    i, j = pairs[:, 0], pairs[:, 1]
+    distances = np.linalg.norm(atoms["coords"][i] - atoms["coords"][j], axis=1)
+    overlaps = _overlaps(radii[i], radii[j], atoms["element"][i], atoms["element"][j], distances, hbond_allowance)
+    return int(np.count_nonzero((overlaps >= overlap_cutoff) & ~_near_bonded_mask(atoms, i, j, bond_separation)))
+
+
+def count_overlaps_between(atoms_a, atoms_b, overlap_cutoff=CLASH_OVERLAP_CUTOFF, hbond_allowance=CLASH_HBOND_ALLOWANCE):
+    """
+    Count atom pairs (one atom from each set) whose van der Waals overlap is >= `overlap_cutoff`.
+    The two sets are assumed to be different molecules, so no bond separation is applied.
+    """
+
+    if len(atoms_a["coords"]) == 0 or len(atoms_b["coords"]) == 0:
+        return 0
+
+    radii_a, radii_b = get_vdw_radii(atoms_a), get_vdw_radii(atoms_b)
+    max_distance = radii_a.max() + radii_b.max() - overlap_cutoff
+    pairs = cKDTree(atoms_a["coords"]).sparse_distance_matrix(cKDTree(atoms_b["coords"]), max_distance, output_type="ndarray")
+    if len(pairs) == 0:
+        return 0
+
+    i, j = pairs["i"], pairs["j"]
+    overlaps = _overlaps(radii_a[i], radii_b[j], atoms_a["element"][i], atoms_b["element"][j], pairs["v"], hbond_allowance)
+    return int(np.count_nonzero(overlaps >= overlap_cutoff))
+
+
+def atoms_near(atoms_a, atoms_b, distance):
+    """
+    Indices of the atoms in `atoms_a` within `distance` of any atom in `atoms_b`.
+    """
+
+    if len(atoms_a["coords"]) == 0 or len(atoms_b["coords"]) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    nearest_distances, _ = cKDTree(atoms_b["coords"]).query(atoms_a["coords"], distance_upper_bound=distance)
+    return np.flatnonzero(np.isfinite(nearest_distances))
+
+
+def _sphere_points(n_points=N_SPHERE_POINTS):
+    """
+    Roughly evenly distributed points on the unit sphere (golden section spiral).
+    """
+
+    k = np.arange(n_points) + 0.5
+    z = 1 - 2 * k / n_points
+    r = np.sqrt(1 - z * z)
+    phi = np.pi * (3 - np.sqrt(5)) * k
+    return np.column_stack((r * np.cos(phi), r * np.sin(phi), z))
+
+
+def surface_points(atoms, atom_indices, probe_radius=PROBE_RADIUS, n_points=N_SPHERE_POINTS):
+    """
+    Shrake-Rupley surface points of the given atoms (van der Waals radius + probe radius).
+    Returns (points, owner atom index of each point, surface area represented by each point).
+    """
+
+    atom_indices = np.asarray(atom_indices, dtype=np.int64)
+    expanded_radii = get_vdw_radii(atoms)[atom_indices] + probe_radius
+    points = atoms["coords"][atom_indices][:, None, :] + expanded_radii[:, None, None] * _sphere_points(n_points)[None, :, :]
+    owner = np.repeat(atom_indices, n_points)
+    point_areas = np.repeat(4 * np.pi * expanded_radii**2 / n_points, n_points)
+    return points.reshape(-1, 3), owner, point_areas
+
+
+def points_buried_by(points, atoms, probe_radius=PROBE_RADIUS, owner=None):
+    """
+    Mask of the surface points that lie inside any atom of `atoms` (van der Waals radius + probe radius).
+    If the points belong to `atoms`, pass their `owner` indices so a point is not considered buried by its own atom.
+    """
+
+    buried = np.zeros(len(points), dtype=bool)
+    if len(points) == 0 or len(atoms["coords"]) == 0:
+        return buried
+
+    expanded_radii = get_vdw_radii(atoms) + probe_radius
+    pairs = cKDTree(points).sparse_distance_matrix(cKDTree(atoms["coords"]), expanded_radii.max(), output_type="ndarray")
+    inside = pairs["v"] < expanded_radii[pairs["j"]]
+    if owner is not None:
+        inside &= pairs["j"] != owner[pairs["i"]]
+    buried[pairs["i"][inside]] = True
+    return buried
+
+
+def file_fingerprint(path):
+    """
+    Cheap identifier of a file's content state, used to cache parsed structures (e.g. a reference model) per process.
+    """
+
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
@@ -0,0 +1,284 @@
+"""
+Generator of synthetic AlphaFold3 output trees (pulldown screens of a BAIT chain and one PREY chain per prediction), to measure and test the analysis
+scripts without a real screen. Every prediction folder is laid out as AF3 writes it:
+
+    <folder>/<name>/<name>_ranking_scores.csv, <name>_model.cif, <name>_confidences.json, <name>_summary_confidences.json (copies of the top sample)
+    <folder>/<name>/seed-<seed>_sample-<sample>/<name>_seed-<seed>_sample-<sample>_model.cif, ..._confidences.json, ..._summary_confidences.json
+
+The models hold all heavy atoms of both chains (PREY first, as in the pulldown input template), built as compact bundles of helical segments with the PREY
+docked onto a region of the BAIT, and per-residue pLDDT profiles with disordered stretches. The confidences hold the per-atom pLDDTs and N x N token `pae`
+and `contact_probs` matrices consistent with the structure, so the files have the size and layout of real outputs. The structures are not physically
+realistic; use real predictions to validate results, and synthetic ones to measure run time and memory.
+
+Usage: `python synthetic_af3.py <folder> --predictions 100 --bait-length 400 --prey-length 100 800 --seeds 1 --samples 5`
+"""
+
+import os
+import csv
+import json
+import shutil
+import argparse
+import numpy as np
+from multiprocessing import Pool
+
+AMINO_ACIDS = {
+    "ALA": ["CB"],
+    "ARG": ["CB", "CG", "CD", "NE", "CZ", "NH1", "NH2"],
+    "ASN": ["CB", "CG", "OD1", "ND2"],
+    "ASP": ["CB", "CG", "OD1", "OD2"],
+    "CYS": ["CB", "SG"],
+    "GLN": ["CB", "CG", "CD", "OE1", "NE2"],
+    "GLU": ["CB", "CG", "CD", "OE1", "OE2"],
+    "GLY": [],
+    "HIS": ["CB", "CG", "ND1", "CD2", "CE1", "NE2"],
+    "ILE": ["CB", "CG1", "CG2", "CD1"],
+    "LEU": ["CB", "CG", "CD1", "CD2"],
+    "LYS": ["CB", "CG", "CD", "CE", "NZ"],
+    "MET": ["CB", "CG", "SD", "CE"],
+    "PHE": ["CB", "CG", "CD1", "CD2", "CE1", "CE2", "CZ"],
+    "PRO": ["CB", "CG", "CD"],
+    "SER": ["CB", "OG"],
+    "THR": ["CB", "OG1", "CG2"],
+    "TRP": ["CB", "CG", "CD1", "CD2", "NE1", "CE2", "CE3", "CZ2", "CZ3", "CH2"],
+    "TYR": ["CB", "CG", "CD1", "CD2", "CE1", "CE2", "CZ", "OH"],
+    "VAL": ["CB", "CG1", "CG2"],
+}
+RESIDUE_NAMES = sorted(AMINO_ACIDS)
+BACKBONE = [("N", np.array([-1.2, 0.6, 0.0])), ("CA", np.zeros(3)), ("C", np.array([1.2, 0.6, 0.0])), ("O", np.array([1.4, 1.8, 0.0]))]
+ATOM_SITE_COLUMNS = [
+    "group_PDB",
+    "id",
+    "type_symbol",
+    "label_atom_id",
+    "label_alt_id",
+    "label_comp_id",
+    "label_asym_id",
+    "label_entity_id",
+    "label_seq_id",
+    "pdbx_PDB_ins_code",
+    "Cartn_x",
+    "Cartn_y",
+    "Cartn_z",
+    "occupancy",
+    "B_iso_or_equiv",
+    "auth_seq_id",
+    "auth_asym_id",
+    "pdbx_PDB_model_num",
+]
+# helical segments of the bundles: residues per segment, rise and radius of the helix (A), and spacing of the segments (A)
+SEGMENT_LENGTH = 18
+HELIX_RISE = 1.5
+HELIX_RADIUS = 2.3
+SEGMENT_SPACING = 10.0
+
+
+def get_ca_coords(length, rng):
+    """
+    CA coordinates of a chain folded as a square bundle of antiparallel helical segments.
+    """
+
+    residues = np.arange(length)
+    segment, position = np.divmod(residues, SEGMENT_LENGTH)
+    position = np.where(segment % 2 == 0, position, SEGMENT_LENGTH - 1 - position)
+    grid_size = int(np.ceil(np.sqrt(segment.max() + 1)))
+    angle = np.radians(100.0) * residues
+    coords = np.column_stack(
+        [
+            (segment % grid_size) * SEGMENT_SPACING + HELIX_RADIUS * np.cos(angle),
+            (segment // grid_size) * SEGMENT_SPACING + HELIX_RADIUS * np.sin(angle),
+            position * HELIX_RISE,
+        ]
+    )
+    return coords + rng.normal(0, 0.3, coords.shape)
+
+
+def get_plddt_profile(length, rng, disordered_fraction):
+    """
+    Per-residue pLDDT: a smooth confident profile with disordered stretches (low pLDDT), more likely at the termini.
+    """
+
+    plddt = 88 + np.convolve(rng.normal(0, 6, length + 20), np.ones(21) / 21, mode="valid")[:length] * 3
+    stretch_count = rng.poisson(max(1.0, length * disordered_fraction / 30))
+    for _ in range(stretch_count):
+        start = rng.choice([0, length - 1, rng.integers(length)])
+        stretch = rng.integers(5, 40)
+        plddt[max(0, start - stretch // 2) : start + stretch // 2 + 1] = rng.uniform(25, 50)
+    return np.clip(plddt, 15, 98)
+
+
+def build_chain(chain_id, length, origin, rng, disordered_fraction):
+    """
+    A chain: per-atom residue names, atom names, elements, coordinates and residue numbers, and the per-residue CA coordinates and pLDDTs.
+    """
+
+    ca_coords = get_ca_coords(length, rng) + origin
+    residue_plddts = get_plddt_profile(length, rng, disordered_fraction)
+    residue_names = rng.choice(RESIDUE_NAMES, length)
+    atom_names = [[name for name, _ in BACKBONE] + AMINO_ACIDS[residue_name] for residue_name in residue_names]
+    atom_counts = np.array([len(names) for names in atom_names])
+    residue_index = np.repeat(np.arange(length), atom_counts)
+    # position of every atom in its residue: backbone atoms are at fixed offsets from the CA, side chains point away from the bundle's axis
+    atom_index = np.arange(len(residue_index)) - np.repeat(np.cumsum(atom_counts) - atom_counts, atom_counts)
+    outward = np.column_stack([ca_coords[:, :2] - ca_coords[:, :2].mean(axis=0), np.zeros(length)])
+    outward /= np.maximum(np.linalg.norm(outward, axis=1), 1e-6)[:, None]
+    backbone_offsets = np.array([offset for _, offset in BACKBONE])
+    is_backbone = atom_index < len(BACKBONE)
+    offsets = np.where(
+        is_backbone[:, None],
+        backbone_offsets[np.minimum(atom_index, len(BACKBONE) - 1)],
+        outward[residue_index] * 1.5 * (atom_index - len(BACKBONE) + 1)[:, None] + rng.normal(0, 0.4, (len(residue_index), 3)),
+    )
+    atom_names = [name for names in atom_names for name in names]
+
+    return {
+        "id": chain_id,
+        "residue_names": residue_names[residue_index],
+        "atom_names": atom_names,
+        "elements": [name[0] for name in atom_names],
+        "coords": ca_coords[residue_index] + offsets,
+        "residue_numbers": residue_index + 1,
+        "ca_coords": ca_coords,
+        "residue_plddts": residue_plddts,
+    }
+
+
+def write_model_cif(model_file, name, chains, rng):
+    """
+    Write an AF3-like mmCIF model. Returns the per-atom chain ids and pLDDTs (as in the confidences).
+    """
+
+    lines = [f"data_{name}", "#", f"_entry.id {name}", "#", "loop_"] + [f"_atom_site.{column}" for column in ATOM_SITE_COLUMNS]
+    atom_chain_ids = []
+    atom_plddts = []
+    atom_id = 1
+    for entity_id, chain in enumerate(chains, start=1):
+        plddts = np.clip(chain["residue_plddts"][chain["residue_numbers"] - 1] + rng.normal(0, 1.5, len(chain["atom_names"])), 0, 100).round(2).tolist()
+        for residue_name, atom_name, element, (x, y, z), residue_number, plddt in zip(
+            chain["residue_names"], chain["atom_names"], chain["elements"], chain["coords"].tolist(), chain["residue_numbers"].tolist(), plddts
+        ):
+            lines.append(
+                f"ATOM {atom_id:<6} {element} {atom_name:<4} . {residue_name} {chain['id']} {entity_id} {residue_number:<5} ? {x:.3f} {y:.3f} {z:.3f} 1.00 {plddt:.2f} {residue_number:<5} {chain['id']} 1"
+            )
+            atom_id += 1
+        atom_chain_ids += [chain["id"]] * len(plddts)
+        atom_plddts += plddts
+    lines.append("#")
+
+    with open(model_file, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return atom_chain_ids, atom_plddts
+
+
+def write_sample(sample_folder, file_prefix, name, chains, rng):
+    """
+    Write the model, confidences and summary confidences of one seed/sample. Returns its ranking score.
+    """
+
+    os.makedirs(sample_folder, exist_ok=True)
+    atom_chain_ids, atom_plddts = write_model_cif(os.path.join(sample_folder, f"{file_prefix}_model.cif"), name, chains, rng)
+
+    ca_coords = np.concatenate([chain["ca_coords"] for chain in chains])
+    token_plddts = np.concatenate([chain["residue_plddts"] for chain in chains])
+    token_chain_ids = [chain["id"] for chain in chains for _ in chain["ca_coords"]]
+    token_res_ids = [i + 1 for chain in chains for i in range(len(chain["ca_coords"]))]
+    distances = np.linalg.norm(ca_coords[:, None, :] - ca_coords[None, :, :], axis=-1)
+    contact_probs = 1 / (1 + np.exp(distances - 8.0))
+    confidence = (token_plddts[:, None] + token_plddts[None, :]) / 200
+    pae = np.clip(31.75 * (1 - confidence) + distances / 10 + rng.exponential(1.0, distances.shape), 0.25, 31.75)
+    confidences = {
+        "atom_chain_ids": atom_chain_ids,
+        "atom_plddts": atom_plddts,
+        "contact_probs": np.round(contact_probs, 2).tolist(),
+        "pae": np.round(pae, 2).tolist(),
+        "token_chain_ids": token_chain_ids,
+        "token_res_ids": token_res_ids,
+    }
+    with open(os.path.join(sample_folder, f"{file_prefix}_confidences.json"), "w") as f:
+        # json.dumps uses the C encoder, json.dump does not
+        f.write(json.dumps(confidences))
+
+    prey_plddt = chains[0]["residue_plddts"].mean() / 100
+    iptm = float(np.clip(rng.beta(2, 5) + (prey_plddt - 0.6) / 2, 0.05, 0.95))
+    ptm = float(np.clip(iptm + rng.uniform(0.05, 0.2), 0.1, 0.97))
+    ranking_score = round(0.8 * iptm + 0.2 * ptm, 4)
+    summary_confidences = {
+        "chain_iptm": [round(iptm, 2)] * len(chains),
+        "chain_pair_iptm": [[round(iptm, 2)] * len(chains) for _ in chains],
+        "chain_pair_pae_min": [[round(float(pae.min()), 2)] * len(chains) for _ in chains],
+        "chain_ptm": [round(ptm, 2)] * len(chains),
+        "fraction_disordered": round(float((token_plddts < 50).mean()), 2),
+        "has_clash": 0.0,
+        "iptm": round(iptm, 2),
+        "num_recycles": 10.0,
+        "ptm": round(ptm, 2),
+        "ranking_score": ranking_score,
+    }
+    with open(os.path.join(sample_folder, f"{file_prefix}_summary_confidences.json"), "w") as f:
+        json.dump(summary_confidences, f, indent=1)
+
+    return ranking_score
+
+
+def generate_prediction(args):
+    """
+    Write one prediction folder with `seeds` x `samples` seed/sample folders, the ranking scores and the top sample copies.
+    """
+
+    folder, name, bait_length, prey_length, seeds, samples, random_seed, disordered_fraction = args
+    rng = np.random.default_rng(random_seed)
+    prediction_folder = os.path.join(folder, name)
+    bait = build_chain("BAIT", bait_length, np.zeros(3), rng, disordered_fraction)
+    # the PREY bundle sits on top of a random region of the BAIT bundle, so they have an interface
+    interface = bait["ca_coords"][rng.integers(bait_length)]
+    origin = np.array([interface[0] - SEGMENT_SPACING, interface[1] - SEGMENT_SPACING, bait["ca_coords"][:, 2].max() + 6.0])
+
+    ranking = []
+    for seed in range(1, seeds + 1):
+        for sample in range(samples):
+            # every sample is a slightly different model of the same chains
+            prey = build_chain("PREY", prey_length, origin + rng.normal(0, 1.0, 3), rng, disordered_fraction)
+            file_prefix = f"{name}_seed-{seed}_sample-{sample}"
+            sample_folder = os.path.join(prediction_folder, f"seed-{seed}_sample-{sample}")
+            ranking.append([seed, sample, write_sample(sample_folder, file_prefix, name, [prey, bait], rng)])
+
+    seed, sample, _ = max(ranking, key=lambda row: row[2])
+    for suffix in ["model.cif", "confidences.json", "summary_confidences.json"]:
+        shutil.copyfile(os.path.join(prediction_folder, f"seed-{seed}_sample-{sample}", f"{name}_seed-{seed}_sample-{sample}_{suffix}"), os.path.join(prediction_folder, f"{name}_{suffix}"))
+    with open(os.path.join(prediction_folder, f"{name}_ranking_scores.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["seed", "sample", "ranking_score"])
+        writer.writerows(ranking)
+
+    return name
+
+
+def generate_screen(folder, prediction_count, bait_length=400, prey_length_range=(100, 800), seeds=1, samples=5, random_seed=0, disordered_fraction=0.15, process_count=None):
+    """
+    Write `prediction_count` synthetic predictions (`syn<i>_bait`, PREY lengths drawn uniformly from `prey_length_range`) into a screen folder.
+    The output only depends on the parameters, so the same screen is generated on every machine. Returns the prediction names.
+    """
+
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(random_seed)
+    prey_lengths = rng.integers(prey_length_range[0], prey_length_range[1] + 1, prediction_count)
+    jobs = [(folder, f"syn{i:05d}_bait", bait_length, int(prey_length), seeds, samples, [random_seed, i], disordered_fraction) for i, prey_length in enumerate(prey_lengths)]
+    with Pool(processes=process_count) as pool:
+        names = pool.map(generate_prediction, jobs, chunksize=1)
+
+    print(f"Generated {len(names)} synthetic predictions in {folder}", flush=True)
+    return names
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic AlphaFold3 pulldown screen output folder")
+    parser.add_argument("folder", help="output screen folder")
+    parser.add_argument("--predictions", type=int, default=100, help="number of prediction folders")
+    parser.add_argument("--bait-length", type=int, default=400, help="number of residues of the BAIT chain")
+    parser.add_argument("--prey-length", type=int, nargs=2, default=[100, 800], metavar=("MIN", "MAX"), help="range of the number of residues of the PREY chains")
+    parser.add_argument("--seeds", type=int, default=1, help="number of model seeds per prediction")
+    parser.add_argument("--samples", type=int, default=5, help="number of samples per seed")
+    parser.add_argument("--random-seed", type=int, default=0, help="seed of the generator")
+    parser.add_argument("--processes", type=int, default=None, help="number of processes (default: all CPUs)")
+    args = parser.parse_args()
+
+    generate_screen(args.folder, args.predictions, args.bait_length, tuple(args.prey_length), args.seeds, args.samples, args.random_seed, process_count=args.processes)
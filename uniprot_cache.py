@@ -0,0 +1,240 @@
+"""
+Persistent UniProt cache (SQLite, `output_cache/uniprot.sqlite`) for the protein details (id, full name, organism) and the FASTA files of UniProt entries.
+Entries missing from the cache are fetched in batches through the UniProt stream query interface (`<base url>/uniprotkb/stream?query=accession:A OR ...`),
+and only the ids that a batch query did not resolve (e.g. merged or secondary accessions) are fetched one by one.
+Requests run concurrently on a thread pool sharing one pooled session, with retries, exponential backoff and a global rate limit.
+With `uniprot_offline`, only the cache is used and the network is never touched; the base URL can be changed (e.g. to a local stub server) with `uniprot_base_url`.
+"""
+
+import os
+import re
+import time
+import sqlite3
+import threading
+import requests
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from constants import UNIPROT_BASE_URL, UNIPROT_OFFLINE, UNIPROT_MAX_WORKERS, UNIPROT_REQUESTS_PER_SECOND
+
+CACHE_FILE = "output_cache/uniprot.sqlite"
+BATCH_SIZE = 100
+REQUEST_TIMEOUT = 60
+UNIPROT_RETRIES = 5
+RETRY_BACKOFF_FACTOR = 1.0
+# ids that can be used in a batch query (accessions and entry names), anything else is fetched individually
+QUERY_ID_PATTERN = re.compile(r"^[A-Za-z0-9_]+$")
+
+
+def _connect(cache_file=CACHE_FILE):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    connection = sqlite3.connect(cache_file, timeout=60)
+    connection.execute("CREATE TABLE IF NOT EXISTS details (query_id TEXT PRIMARY KEY, found INTEGER, uniprot_id TEXT, full_name TEXT, organism TEXT, updated REAL)")
+    connection.execute("CREATE TABLE IF NOT EXISTS fastas (query_id TEXT PRIMARY KEY, found INTEGER, fasta TEXT, updated REAL)")
+    return connection
+
+
+def _read_cache(connection, table, columns, query_ids):
+    rows = {}
+    query_ids = list(query_ids)
+    for i in range(0, len(query_ids), 500):
+        chunk = query_ids[i : i + 500]
+        placeholders = ",".join("?" * len(chunk))
+        for row in connection.execute(f"SELECT query_id, found, {', '.join(columns)} FROM {table} WHERE query_id IN ({placeholders})", chunk):
+            rows[row[0]] = dict(zip(columns, row[2:])) if row[1] else None
+    return rows
+
+
+def parse_uniprot_details(entry):
+    """
+    The id, full name and organism of a UniProt JSON entry (the full name is the recommended name, or the first submission name).
+    """
+    try:
+        full_name = entry["proteinDescription"]["recommendedName"]["fullName"]["value"]
+    except (KeyError, IndexError, TypeError):
+        full_name = ""
+    if full_name == "":
+        try:
+            full_name = entry["proteinDescription"]["submissionNames"][0]["fullName"]["value"]
+        except (KeyError, IndexError, TypeError):
+            full_name = ""
+
+    return {"id": entry["uniProtkbId"], "full_name": full_name, "organism": entry["organism"]["scientificName"]}
+
+
+def parse_fasta_entries(fasta_text):
+    """
+    Split a multi-entry UniProt FASTA into {accession or entry name: FASTA text of the entry} (headers are `>db|ACCESSION|ENTRY_NAME ...`).
+    """
+    entries = {}
+    for entry in re.split(r"(?m)^(?=>)", fasta_text):
+        if not entry.startswith(">"):
+            continue
+        header_ids = entry[1:].split(maxsplit=1)[0].split("|")
+        for header_id in header_ids[1:]:
+            entries[header_id] = entry
+    return entries
+
+
+class _RateLimiter:
+    """
+    Spaces requests at least 1 / `requests_per_second` apart, across threads.
+    """
+
+    def __init__(self, requests_per_second):
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+def create_session(pool_size=UNIPROT_MAX_WORKERS, retries=UNIPROT_RETRIES):
+    """
+    A requests session with a connection pool shared by the fetching threads, retrying with exponential backoff on connection errors,
+    rate limiting (429, honoring Retry-After) and server errors.
+    """
+    retry = Retry(total=retries, backoff_factor=RETRY_BACKOFF_FACTOR, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"], respect_retry_after_header=True, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _fetch_batch(session, rate_limiter, base_url, batch, kind):
+    """
+    Query a batch of ids through the stream interface. Returns {query id: details or FASTA text} for the ids the query resolved.
+    """
+    query = " OR ".join(f"accession:{query_id} OR id:{query_id}" for query_id in batch)
+    params = {"query": query, "format": "json", "fields": "accession,id,protein_name,organism_name"} if kind == "details" else {"query": query, "format": "fasta"}
+    rate_limiter.wait()
+    try:
+        response = session.get(f"{base_url}/uniprotkb/stream", params=params, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        # a truncated or non-JSON body (e.g. an HTML error page of a proxy) fails the batch like a failed request
+        results = response.json().get("results", []) if kind == "details" else None
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"UniProt batch query failed ({e}), fetching {len(batch)} entries individually", flush=True)
+        return {}
+
+    batch_ids = set(batch)
+    if kind == "fasta":
+        entries = parse_fasta_entries(response.text)
+        return {query_id: entries[query_id] for query_id in batch if query_id in entries}
+
+    fetched = {}
+    for entry in results:
+        try:
+            details = parse_uniprot_details(entry)
+        except (KeyError, TypeError):
+            # an inactive or obsolete entry has no entry name or organism, its ids are fetched individually (and found missing)
+            continue
+        for entry_id in (entry.get("primaryAccession"), entry.get("uniProtkbId")):
+            if entry_id in batch_ids:
+                fetched[entry_id] = details
+    return fetched
+
+
+def _fetch_one(session, rate_limiter, base_url, query_id, kind):
+    """
+    Fetch a single entry. Returns (found, details or FASTA text): found is None if the request failed (the result is then not cached).
+    """
+    rate_limiter.wait()
+    suffix, headers = ("", {"Accept": "application/json"}) if kind == "details" else (".fasta", {})
+    try:
+        response = session.get(f"{base_url}/uniprotkb/{query_id}{suffix}", headers=headers, timeout=REQUEST_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        print(f"Failed to fetch UniProt entry {query_id}: {e}", flush=True)
+        return None, None
+    if response.status_code in (400, 404):
+        return False, None
+    if response.status_code != 200:
+        print(f"Failed to fetch UniProt entry {query_id}: HTTP {response.status_code}", flush=True)
+        return None, None
+    if kind == "fasta":
+        return True, response.text
+    try:
+        entry = response.json()
+    except ValueError as e:
+        print(f"Failed to fetch UniProt entry {query_id}: invalid JSON response ({e})", flush=True)
+        return None, None
+    try:
+        return True, parse_uniprot_details(entry)
+    except (KeyError, TypeError):
+        # an inactive or obsolete entry (no entry name or organism) is treated as not found
+        print(f"UniProt entry {query_id} is inactive or has no entry name or organism, treating it as not found", flush=True)
+        return False, None
+
+
+def _fetch_missing(missing_ids, base_url, kind):
+    """
+    Fetch the details or FASTA files (`kind`) of the ids missing from the cache: first in batches through the stream interface,
+    then the ids the batches did not resolve one by one, with up to UNIPROT_MAX_WORKERS concurrent requests over one pooled session.
+    Returns {query id: value} for the ids that were resolved (None for ids that do not exist).
+    """
+    batch_ids = [query_id for query_id in missing_ids if QUERY_ID_PATTERN.match(query_id)]
+    batches = [batch_ids[i : i + BATCH_SIZE] for i in range(0, len(batch_ids), BATCH_SIZE)]
+    rate_limiter = _RateLimiter(UNIPROT_REQUESTS_PER_SECOND)
+    fetched = {}
+    with create_session() as session, ThreadPoolExecutor(max_workers=UNIPROT_MAX_WORKERS) as executor:
+        for batch_fetched in executor.map(lambda batch: _fetch_batch(session, rate_limiter, base_url, batch, kind), batches):
+            fetched.update(batch_fetched)
+
+        remaining_ids = [query_id for query_id in missing_ids if query_id not in fetched]
+        for query_id, (found, value) in zip(remaining_ids, executor.map(lambda query_id: _fetch_one(session, rate_limiter, base_url, query_id, kind), remaining_ids)):
+            if found is not None:
+                fetched[query_id] = value
+
+    return fetched
+
+
+def get_uniprot_details_batch(query_ids, offline=UNIPROT_OFFLINE, base_url=UNIPROT_BASE_URL, cache_file=CACHE_FILE):
+    """
+    Get {"id", "full_name", "organism"} for each UniProt accession or entry name, from the cache or fetched in batches.
+    Returns {query id: details}, with None for entries that do not exist or could not be fetched (or are not cached, in offline mode).
+    """
+    query_ids = list(dict.fromkeys(query_ids))
+    with closing(_connect(cache_file)) as connection, connection:
+        results = _read_cache(connection, "details", ["uniprot_id", "full_name", "organism"], query_ids)
+        results = {query_id: {"id": row["uniprot_id"], "full_name": row["full_name"], "organism": row["organism"]} if row else None for query_id, row in results.items()}
+        missing_ids = [query_id for query_id in query_ids if query_id not in results]
+        if missing_ids and offline:
+            print(f"Offline mode: {len(missing_ids)} UniProt entries are not cached", flush=True)
+        elif missing_ids:
+            fetched = _fetch_missing(missing_ids, base_url, "details")
+            connection.executemany(
+                "INSERT OR REPLACE INTO details VALUES (?, ?, ?, ?, ?, ?)",
+                [(query_id, details is not None, *((details["id"], details["full_name"], details["organism"]) if details else (None, None, None)), time.time()) for query_id, details in fetched.items()],
+            )
+            results.update(fetched)
+            print(f"Fetched {len(fetched)} of {len(missing_ids)} UniProt entries", flush=True)
+
+    return {query_id: results.get(query_id) for query_id in query_ids}
+
+
+def get_uniprot_fastas(query_ids, offline=UNIPROT_OFFLINE, base_url=UNIPROT_BASE_URL, cache_file=CACHE_FILE):
+    """
+    Get the FASTA file content of each UniProt accession or entry name, from the cache or fetched in batches.
+    Returns {query id: FASTA text}, with None for entries that do not exist or could not be fetched (or are not cached, in offline mode).
+    """
+    query_ids = list(dict.fromkeys(query_ids))
+    with closing(_connect(cache_file)) as connection, connection:
+        results = {query_id: row["fasta"] if row else None for query_id, row in _read_cache(connection, "fastas", ["fasta"], query_ids).items()}
+        missing_ids = [query_id for query_id in query_ids if query_id not in results]
+        if missing_ids and offline:
+            print(f"Offline mode: {len(missing_ids)} UniProt FASTA files are not cached", flush=True)
+        elif missing_ids:
+            fetched = _fetch_missing(missing_ids, base_url, "fasta")
+            connection.executemany("INSERT OR REPLACE INTO fastas VALUES (?, ?, ?, ?)", [(query_id, fasta is not None, fasta, time.time()) for query_id, fasta in fetched.items()])
+            results.update(fetched)
+            print(f"Fetched {len(fetched)} of {len(missing_ids)} UniProt FASTA files", flush=True)
+
+    return {query_id: results.get(query_id) for query_id in query_ids}
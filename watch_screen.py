@@ -0,0 +1,334 @@
+"""
+Watch mode for the pulldown analysis: a long-running process that polls the screen folders and analyzes every prediction as soon as AF3 finishes it,
+so the CPU analysis of a multi-day screen overlaps with the GPU inference instead of starting after it.
+
+Every `watch_poll_seconds`, the screen index of each folder is refreshed (see `screen_index.py`) and the predictions that are complete (their
+`<prediction>_ranking_scores.csv` exists, AF3 writes it last) and were not analyzed yet, or changed since, are pushed through the scores (process_results.py),
+the pLDDT sliding windows, the binding domains (get_binding_domain.py) and the clashes (calculate_all_clashes.py, if `clashes_model` is set).
+The results are added to the result caches of these stages, so their batch runs only recompute what the watcher did not analyze, and the watcher reuses the
+results its stages already have in these caches (e.g. when it starts on a screen analyzed by the batch runs). With `use_results_store`
+the rows are appended to the results store as they finish. The analyzed predictions are tracked in `output_cache/watch/`.
+
+Usage: `python watch_screen.py` (stop it with Ctrl+C), or `python watch_screen.py --once` for a single pass.
+"""
+
+import os
+import json
+import time
+import argparse
+import pandas as pd
+from multiprocessing import Pool
+from af3_input_helper import load_manifest
+from files_helper import process_model_folder, N_MODEL
+from plddt_store import update_plddt_store, get_missing_plddt_windows, PLDDT_STORE_FILE
+from modify_mmcif_plddt import get_plddt_sliding_window_file
+from process_results import process_model_directory, get_result_rows, RESULTS_COLUMNS
+from get_binding_domain import get_binding_domain_stats, get_binding_domain_stats_chimerax_batch, get_binding_domain_columns, get_cache_params as get_binding_domain_cache_params
+from get_binding_domain_combinations import add_binding_domain_bitmask_columns
+from calculate_all_clashes import CLASHES_COLUMNS, PLDDT_WINDOW, get_cache_params as get_clashes_cache_params
+from calculate_clashes import calculate_clashes, calculate_clashes_chimerax_batch
+from result_cache import CACHE_FOLDER, load_result_cache, get_cached_results, update_result_cache, merge_cached_results, get_params_hash
+from screen_index import load_screen_index, get_completed_predictions, get_prediction_fingerprint, get_ranked_model_files
+from results_store import append_stage, get_superfolder, check_results_store
+from perf_helper import write_perf_report, start_perf_run
+from constants import CURRENT_PIPELINE
+
+assert CURRENT_PIPELINE == "pulldown", "This script is only for the pulldown pipeline"
+from constants import (
+    FOLDERS,
+    PLDDT_SLIDING_WINDOW,
+    ALL_PLDDT_WINDOWS,
+    PROCESS_COUNT,
+    BINDING_DOMAIN_BACKEND,
+    CLASHES_MODEL,
+    CLASHES_BACKEND,
+    VIRTUAL_PLDDT_WINDOWS,
+    USE_RESULTS_STORE,
+    WATCH_POLL_SECONDS,
+)
+
+WATCH_FOLDER = os.path.join(CACHE_FOLDER, "watch")
+# number of analyzed predictions written to the caches and the results store at once
+FLUSH_SIZE = 64
+# number of polls covered by one performance report (with `perf_report`), each report starts a new perf run and worker pool
+PERF_REPORT_POLLS = 60
+
+
+def get_watch_params():
+    # the analyzed predictions are tracked per set of analysis parameters, changing them analyzes every prediction again
+    params = {"binding_domain": get_binding_domain_cache_params(), "n_model": N_MODEL, "all_plddt_windows": ALL_PLDDT_WINDOWS, "use_results_store": USE_RESULTS_STORE}
+    if CLASHES_MODEL:
+        params["clashes"] = get_clashes_cache_params()
+    return params
+
+
+def get_watch_state_file(folder):
+    return os.path.join(WATCH_FOLDER, f"{os.path.basename(os.path.normpath(folder))}_{get_params_hash(get_watch_params())}.json")
+
+
+def load_watch_state(folder):
+    """
+    {prediction folder name: fingerprint} of the predictions of a screen folder that were analyzed.
+    """
+
+    state_file = get_watch_state_file(folder)
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file) as f:
+        return json.load(f)["predictions"]
+
+
+def save_watch_state(folder, state):
+    state_file = get_watch_state_file(folder)
+    os.makedirs(WATCH_FOLDER, exist_ok=True)
+    with open(state_file + ".tmp", "w") as f:
+        json.dump({"params": get_watch_params(), "predictions": state}, f, default=str)
+    os.replace(state_file + ".tmp", state_file)
+
+
+def get_sliding_windows():
+    return sorted(set(ALL_PLDDT_WINDOWS) | {PLDDT_SLIDING_WINDOW})
+
+
+def get_prediction_model_files(folder, prediction_name, prediction):
+    """
+    The model files the stages analyze for a prediction (as `process_model_folder` returns them) without computing the pLDDT sliding windows,
+    and whether the sliding windows of all its models are already computed.
+    """
+
+    model_files = []
+    windows_computed = True
+    for model_file in get_ranked_model_files(folder, prediction_name, prediction, N_MODEL):
+        if VIRTUAL_PLDDT_WINDOWS:
+            windows_computed &= not get_missing_plddt_windows(model_file, get_sliding_windows())
+            model_files.append(model_file)
+        else:
+            windows_computed &= all(os.path.exists(get_plddt_sliding_window_file(model_file, window)) for window in get_sliding_windows())
+            model_files.append(get_plddt_sliding_window_file(model_file, PLDDT_SLIDING_WINDOW))
+    return model_files, windows_computed
+
+
+def get_cached_analyses(folder, caches, predictions, fingerprints):
+    """
+    Look up the results of predictions ({prediction folder name: screen index entry}) in the result caches of the stages. Returns the results of the predictions
+    whose stages are all cached and whose sliding windows are computed ({prediction folder name: results, as `analyze_prediction` returns them}), and the
+    cached results of the other predictions ({prediction folder name: {"raw_result", "binding_domain", "clashes"}}), passed to `analyze_prediction`.
+    """
+
+    model_directories = {prediction_name: os.path.join(folder, prediction_name) for prediction_name in predictions}
+    cached_raw_results, _ = get_cached_results(caches["process_results"], list(model_directories.values()), {model_directories[name]: fingerprints[name] for name in predictions})
+
+    prediction_model_files = {}
+    for prediction_name, prediction in predictions.items():
+        try:
+            prediction_model_files[prediction_name] = get_prediction_model_files(folder, prediction_name, prediction)
+        except FileNotFoundError:
+            # missing model files are reported by the analysis of the prediction
+            prediction_model_files[prediction_name] = ([], False)
+    all_model_files = [model_file for model_files, _ in prediction_model_files.values() for model_file in model_files]
+    cached_binding_domain_rows, _ = get_cached_results(caches["binding_domain"], all_model_files)
+    cached_clashes, _ = get_cached_results(caches["clashes"], all_model_files) if CLASHES_MODEL else ({}, [])
+
+    complete, partial = {}, {}
+    for prediction_name, (model_files, windows_computed) in prediction_model_files.items():
+        cached = {
+            "raw_result": cached_raw_results.get(model_directories[prediction_name]),
+            "binding_domain": {model_file: cached_binding_domain_rows[model_file] for model_file in model_files if model_file in cached_binding_domain_rows},
+            "clashes": {model_file: cached_clashes[model_file] for model_file in model_files if model_file in cached_clashes},
+        }
+        if (
+            windows_computed
+            and cached["raw_result"] is not None
+            and len(cached["binding_domain"]) == len(model_files)
+            and (not CLASHES_MODEL or len(cached["clashes"]) == len(model_files))
+        ):
+            complete[prediction_name] = {
+                "raw_result": cached["raw_result"],
+                "model_files": model_files,
+                "plddt_store_entries": {},
+                "binding_domain_rows": [cached["binding_domain"][model_file] for model_file in model_files],
+                "clashes": [cached["clashes"][model_file] for model_file in model_files] if CLASHES_MODEL else [],
+            }
+        else:
+            partial[prediction_name] = cached
+    return complete, partial
+
+
+def analyze_prediction(folder, prediction_name, prediction, cached=None):
+    """
+    Run every analysis stage on one completed prediction, except for the `cached` results of its stages (see `get_cached_analyses`).
+    Returns a dictionary of the results of each stage, or None if the analysis failed (the prediction is then analyzed again on the next poll).
+    """
+
+    cached = cached or {"raw_result": None, "binding_domain": {}, "clashes": {}}
+    try:
+        raw_result = cached["raw_result"] if cached["raw_result"] is not None else process_model_directory(os.path.join(folder, prediction_name), prediction)
+        model_files, plddt_store_entries = process_model_folder(prediction_name, folder, PLDDT_SLIDING_WINDOW, N_MODEL, ALL_PLDDT_WINDOWS, prediction)
+
+        missing_model_files = [model_file for model_file in model_files if model_file not in cached["binding_domain"]]
+        if BINDING_DOMAIN_BACKEND == "chimerax_batch":
+            new_rows = get_binding_domain_stats_chimerax_batch(missing_model_files) if missing_model_files else []
+        else:
+            new_rows = [get_binding_domain_stats(model_file) for model_file in missing_model_files]
+        binding_domain_rows = merge_cached_results(model_files, cached["binding_domain"], missing_model_files, new_rows)
+
+        clashes = []
+        if CLASHES_MODEL:
+            missing_model_files = [model_file for model_file in model_files if model_file not in cached["clashes"]]
+            if CLASHES_BACKEND == "chimerax_batch":
+                new_clashes = calculate_clashes_chimerax_batch(missing_model_files, CLASHES_MODEL, PLDDT_WINDOW) if missing_model_files else []
+            else:
+                new_clashes = [calculate_clashes(model_file, CLASHES_MODEL, CLASHES_BACKEND, PLDDT_WINDOW) for model_file in missing_model_files]
+            clashes = merge_cached_results(model_files, cached["clashes"], missing_model_files, new_clashes)
+    except Exception as e:
+        print(f"Failed to analyze {os.path.join(folder, prediction_name)}: {e!r}", flush=True)
+        return None
+
+    return {"raw_result": raw_result, "model_files": model_files, "plddt_store_entries": plddt_store_entries, "binding_domain_rows": binding_domain_rows, "clashes": clashes}
+
+
+def _analyze_prediction(args):
+    folder, prediction_name, prediction, cached = args
+    return prediction_name, analyze_prediction(folder, prediction_name, prediction, cached)
+
+
+def flush_results(folder, caches, analyzed):
+    """
+    Add the results of analyzed predictions ({prediction folder name: (fingerprint, results)}) to the result caches, the pLDDT store and the results store.
+    """
+
+    model_directories = [os.path.join(folder, prediction_name) for prediction_name in analyzed]
+    fingerprints = {model_directory: fingerprint for model_directory, (fingerprint, _) in zip(model_directories, analyzed.values())}
+    all_results = [results for _, results in analyzed.values()]
+    raw_results = [results["raw_result"] for results in all_results]
+    model_files = [model_file for results in all_results for model_file in results["model_files"]]
+    binding_domain_rows = [row for results in all_results for row in results["binding_domain_rows"]]
+    clashes = [result for results in all_results for result in results["clashes"]]
+
+    update_result_cache(caches["process_results"], model_directories, raw_results, is_valid=lambda result: len(result[1]) > 0, fingerprints=fingerprints)
+    update_result_cache(caches["binding_domain"], model_files, binding_domain_rows, is_valid=lambda row: None not in row)
+    if CLASHES_MODEL:
+        update_result_cache(caches["clashes"], model_files, clashes, is_valid=lambda result: -1 not in result)
+
+    if VIRTUAL_PLDDT_WINDOWS:
+        update_plddt_store(os.path.join(folder, PLDDT_STORE_FILE), {key: array for results in all_results for key, array in results["plddt_store_entries"].items()})
+
+    if USE_RESULTS_STORE:
+        superfolder = get_superfolder(folder)
+        raw_results_df = pd.DataFrame([row for result in raw_results for row in get_result_rows(result)], columns=RESULTS_COLUMNS).astype({"seed": int, "sample": int})
+        append_stage("raw_results", raw_results_df, superfolder, folder)
+        binding_domain_df = pd.DataFrame(binding_domain_rows, columns=get_binding_domain_columns())
+        # failed calculations are None values, numeric (NaN) as when the stage's CSV file is read
+        binding_domain_df = add_binding_domain_bitmask_columns(binding_domain_df.set_index("model").apply(pd.to_numeric).reset_index())
+        append_stage("binding_domain", binding_domain_df, superfolder, folder, PLDDT_SLIDING_WINDOW)
+        if CLASHES_MODEL:
+            clashes_df = pd.DataFrame([[model_file, *result] for model_file, result in zip(model_files, clashes)], columns=CLASHES_COLUMNS)
+            append_stage("clashes", clashes_df, superfolder, folder, PLDDT_SLIDING_WINDOW)
+
+
+def get_stale_predictions(analyzed):
+    """
+    With VIRTUAL_PLDDT_WINDOWS, the analyzed predictions whose models still have no smoothed pLDDT entries for their current fingerprint in the store
+    (e.g. a model rewritten during its analysis): their results may use an outdated pLDDT mask.
+    """
+
+    if not VIRTUAL_PLDDT_WINDOWS:
+        return set()
+    return {
+        prediction_name
+        for prediction_name, (_, results) in analyzed.items()
+        if any(get_missing_plddt_windows(model_file, get_sliding_windows()) for model_file in results["model_files"])
+    }
+
+
+def _flush(folder, caches, state, analyzed):
+    # the state is saved after the results, so an interrupted watcher analyzes the unsaved predictions again
+    flush_results(folder, caches, analyzed)
+    stale = get_stale_predictions(analyzed)
+    for prediction_name in sorted(stale):
+        print(f"The smoothed pLDDT of {os.path.join(folder, prediction_name)} changed during its analysis, analyzing it again on the next poll", flush=True)
+    analyzed = {prediction_name: results for prediction_name, results in analyzed.items() if prediction_name not in stale}
+    state.update({prediction_name: fingerprint for prediction_name, (fingerprint, _) in analyzed.items()})
+    save_watch_state(folder, state)
+    return len(analyzed)
+
+
+def watch_folder(folder, pool):
+    """
+    Analyze the completed predictions of a screen folder that are new or changed since the last poll. Returns the number of analyzed predictions.
+    """
+
+    state = load_watch_state(folder)
+    completed = get_completed_predictions(load_screen_index(folder))
+    fingerprints = {prediction_name: get_prediction_fingerprint(prediction) for prediction_name, prediction in completed.items()}
+    pending = [prediction_name for prediction_name in completed if state.get(prediction_name) != fingerprints[prediction_name]]
+
+    analyzed_count = 0
+    failed_count = 0
+    if pending:
+        caches = {"process_results": load_result_cache("process_results", folder, {}), "binding_domain": load_result_cache("binding_domain", folder, get_binding_domain_cache_params())}
+        if CLASHES_MODEL:
+            caches["clashes"] = load_result_cache("clashes", folder, get_clashes_cache_params())
+
+        # the predictions whose results are all cached are not analyzed again, the others only compute their stages that are not cached
+        complete, partial = get_cached_analyses(folder, caches, {prediction_name: completed[prediction_name] for prediction_name in pending}, fingerprints)
+        analyzed = {}
+        for prediction_name, results in complete.items():
+            analyzed[prediction_name] = (fingerprints[prediction_name], results)
+            if len(analyzed) >= FLUSH_SIZE:
+                analyzed_count += _flush(folder, caches, state, analyzed)
+                analyzed = {}
+        for prediction_name, results in pool.imap_unordered(_analyze_prediction, [(folder, prediction_name, completed[prediction_name], cached) for prediction_name, cached in partial.items()]):
+            if results is None:
+                failed_count += 1
+                continue
+            analyzed[prediction_name] = (fingerprints[prediction_name], results)
+            if len(analyzed) >= FLUSH_SIZE:
+                analyzed_count += _flush(folder, caches, state, analyzed)
+                analyzed = {}
+        if analyzed:
+            analyzed_count += _flush(folder, caches, state, analyzed)
+
+    done_count = sum(state.get(prediction_name) == fingerprint for prediction_name, fingerprint in fingerprints.items())
+    # the job manifest of the AF3 inputs gives the total number of predictions of the screen
+    job_count = len(load_manifest(folder))
+    print(f"{folder}: {analyzed_count} predictions analyzed, {failed_count} failed, {done_count}{f' of {job_count}' if job_count else ''} done", flush=True)
+    return analyzed_count
+
+
+def watch(folders, poll_seconds=WATCH_POLL_SECONDS, once=False):
+    """
+    Poll the screen folders and analyze their completed predictions, until interrupted (or after one pass with `once`).
+    """
+
+    if USE_RESULTS_STORE:
+        check_results_store()
+
+    while True:
+        try:
+            with Pool(processes=PROCESS_COUNT) as pool:
+                for _ in range(PERF_REPORT_POLLS):
+                    for folder in folders:
+                        if os.path.isdir(folder):
+                            watch_folder(folder, pool)
+                    if once:
+                        break
+                    time.sleep(poll_seconds)
+        finally:
+            # also when interrupted, so the report covers the polls since the previous one
+            write_perf_report()
+        if once:
+            break
+        # the records of a run are aggregated by every report, a new run keeps the cost of the next report independent of the uptime
+        start_perf_run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analyze the predictions of the screen folders as AF3 finishes them")
+    parser.add_argument("--once", action="store_true", help="analyze the completed predictions once and exit instead of polling")
+    args = parser.parse_args()
+
+    try:
+        watch(FOLDERS, once=args.once)
+    except KeyboardInterrupt:
+        print("Stopped watching", flush=True)